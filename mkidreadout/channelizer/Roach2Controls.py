@@ -46,6 +46,7 @@ List of Functions:
     setLOFreq -                     Defines LO frequency as an attribute, self.LOFreq
     loadLOFreq -                    Loads the LO frequency to the IF board
     generateTones -                 Returns a list of I,Q time series for each frequency provided
+    generateToneComb -              Returns the sum of the I,Q time series for the frequencies provided
     generateDacComb -               Returns a single I,Q time series representing the DAC freq comb
     loadDacLut -                    Loads the freq comb from generateDacComb() into the LUT
     generateDdsTones -              Defines interweaved tones for dds
@@ -94,9 +95,10 @@ import struct
 import sys
 import time
 import warnings
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from socket import inet_aton
 
-import casperfpga
 import numpy as np
 import scipy.special
 
@@ -104,21 +106,31 @@ from mkidcore.corelog import getLogger
 from mkidcore.readdict import ReadDict
 from mkidreadout.channelizer.adcTools import checkSpectrumForSpikes, streamSpectrum
 from mkidreadout.channelizer.binTools import castBin
+from mkidreadout.channelizer.phasestream import N_PHASES_PER_WORD, PhaseStreamReceiver, decodePhaseWords
+from mkidreadout.channelizer.simfpga import SimulatedFpga
 from mkidreadout.configuration import sweepdata
 
+try:
+    import casperfpga
+except ImportError:  # only a simulated FPGA can be used
+    getLogger(__name__).warning('Could not find casperfpga module')
+
 
 #from mkidreadout.channelizer.Roach2Utils import cy_generateTones
 
 
 class Roach2Controls(object):
     def __init__(self, ip, paramFile='', feedline=1, range='a', num=None, verbose=False, debug=False,
-                 freqListFile=''):
+                 freqListFile='', simulate=False):
         """
         Input:
             ip - ip address string of ROACH2
             paramFile - param object or directory string to dictionary containing important info
             verbose - show print statements
             debug - Save some things to disk for debugging
+            simulate - talk to an in-process simulated FPGA instead of the ROACH2 at ip (see simfpga.py).
+                       True for the default simulator, a dict of SimulatedFpga keyword arguments, or
+                       a SimulatedFpga instance
         """
         # np.random.seed(1) #Make the random phase values always the same
         self.verbose = verbose
@@ -132,6 +144,7 @@ class Roach2Controls(object):
         self.freqListFile = freqListFile.format(feedline=feedline, range=range, num=num)
 
         self.ip = ip
+        self.simulate = simulate
         try:
             paramFile = paramFile if paramFile else os.path.join(os.path.dirname(__file__), 'darknessfpga.param')
             getLogger(__name__).info('Loading params from {}'.format(paramFile))
@@ -156,8 +169,15 @@ class Roach2Controls(object):
         self.thresholdList = -np.pi * np.ones(1024)
 
     def connect(self):
-        self.fpga = casperfpga.katcp_fpga.KatcpFpga(self.ip, timeout=3.)
-        time.sleep(.1)
+        if isinstance(self.simulate, SimulatedFpga):
+            self.fpga = self.simulate
+        elif self.simulate:
+            simArgs = self.simulate if isinstance(self.simulate, dict) else {}
+            self.fpga = SimulatedFpga(self.params, host=self.ip, **simArgs)
+            getLogger(__name__).info('r{}: using simulated FPGA'.format(self.num))
+        else:
+            self.fpga = casperfpga.katcp_fpga.KatcpFpga(self.ip, timeout=3.)
+            time.sleep(.1)
         self.fpga._timeout = 50.
         if not self.fpga.is_running():
             getLogger(__name__).error('Firmware is not running. Start firmware, calibrate, '
@@ -524,13 +544,13 @@ class Roach2Controls(object):
         format values and write them to bram
         
         """
+        memValues = np.array(valuesToWrite, dtype=np.uint64)  # cast signed values
         if nBytesPerSample == 4:
-            formatChar = 'L'
+            if np.any(memValues >> np.uint64(32)):
+                raise ValueError('Values do not fit in 32 bit bram words')
+            toWriteStr = memValues.astype('>u4').tobytes()
         elif nBytesPerSample == 8:
-            formatChar = 'Q'
-        memValues = np.array(valuesToWrite, dtype=np.uint64)  # cast signed values
-        nValues = len(valuesToWrite)
-        toWriteStr = struct.pack('>{}{}'.format(nValues, formatChar), *memValues)
+            toWriteStr = memValues.astype('>u8').tobytes()
         self.fpga.blindwrite(memName, toWriteStr, start)
 
     def writeQdr(self, memName, valuesToWrite, start=0, bQdrFlip=True, nQdrRows=2 ** 20):
@@ -546,19 +566,16 @@ class Roach2Controls(object):
         
         INPUTS:
         """
-        nBytesPerSample = 8
-        formatChar = 'Q'
         memValues = np.array(valuesToWrite, dtype=np.uint64)  # cast signed values
-        nValues = len(valuesToWrite)
         if bQdrFlip:  # For some reason, on Roach2 with the current qdr calibration, the 64 bit word seen in firmware
             # has the first and second 32 bit chunks swapped compared to the 64 bit word sent by katcp, so to accommodate
             # we swap those chunks here, so they will be in the right order in firmware
-            mask32 = int('1' * 32, 2)
-            memValues = (memValues >> 32) + ((memValues & mask32) << 32)
+            shift32 = np.uint64(32)
+            memValues = (memValues >> shift32) | (memValues << shift32)
             # Unfortunately, with the current qdr calibration, the addresses in katcp and firmware are shifted (rolled) relative to each other
             # so to compensate we roll the values to write here
             memValues = np.roll(memValues, -1)
-        toWriteStr = struct.pack('>{}{}'.format(nValues, formatChar), *memValues)
+        toWriteStr = memValues.astype('>u8').tobytes()  # big endian 64 bit words
         self.fpga.blindwrite(memName, toWriteStr, start)
 
     def formatWaveForMem(self, iVals, qVals, nBitsPerSamplePair=32, nSamplesPerCycle=4096, nMems=3, nBitsPerMemRow=64,
@@ -566,30 +583,55 @@ class Roach2Controls(object):
         """
         put together IQ values from tones to be loaded to a firmware memory LUT
         
+        Each row of nSamplesPerCycle IQ pairs is summed into one (signed) number with each pair shifted up by
+        nBitsPerSamplePair bits, and the nMems*nBitsPerMemRow least significant bits of it (two's complement)
+        are split into nMems memory rows. This is done in uint64 lanes, carrying between them, rather than with
+        python longs.
+        
         INPUTS:
             iVals - time series of I values
             qVals - 
             
+        OUTPUTS:
+            memRowVals - uint64 array [nRows, nMems]. Each column contains the values for one memory,
+                         column 0 has the most significant bits
         """
-        nBitsPerSampleComponent = nBitsPerSamplePair / 2
+        if nBitsPerMemRow != 64:
+            raise ValueError('Only 64 bit memory rows are supported')
+        nBitsPerSampleComponent = nBitsPerSamplePair // 2
         # I vals and Q vals are 12 bits, combine them into 24 bit vals
-        iqVals = (iVals << nBitsPerSampleComponent) + qVals
+        iqVals = (np.asarray(iVals, dtype=np.int64) << nBitsPerSampleComponent) + np.asarray(qVals, dtype=np.int64)
         iqRows = np.reshape(iqVals, (-1, nSamplesPerCycle))
-        # we need to set dtype to object to use python's native long type
-        colBitShifts = nBitsPerSamplePair * (np.arange(nSamplesPerCycle, dtype=object))
+        colBitShifts = nBitsPerSamplePair * np.arange(nSamplesPerCycle)
         if earlierSampleIsMsb:
             # reverse order so earlier (more left) columns are shifted to more significant bits
             colBitShifts = colBitShifts[::-1]
 
-        iqRowVals = np.sum(iqRows << colBitShifts, axis=1)  # shift each col by specified amount, and sum each row
-        # Now we have 2**20 row values, each is 192 bits and contain 8 IQ pairs
-        # next we divide these 192 bit rows into three 64-bit qdr rows
+        # limbs[:, k] holds bits 64k to 64k+63 of each row value, least significant first
+        limbs = np.zeros((len(iqRows), nMems), dtype=np.uint64)
+        for col in np.where(colBitShifts < nMems * nBitsPerMemRow)[0]:
+            shift = colBitShifts[col]
+            firstLimb, bitShift = shift // 64, np.uint64(shift % 64)
+            values = iqRows[:, col].view(np.uint64)
+            signExt = (iqRows[:, col] >> 63).view(np.uint64)  # 0 or all 1s, the bits above the value
+            carry = np.zeros(len(iqRows), dtype=np.uint64)
+            for k in range(firstLimb, nMems):
+                if k == firstLimb:
+                    term = values << bitShift
+                elif k == firstLimb + 1 and bitShift:
+                    term = (values >> (np.uint64(64) - bitShift)) | (signExt << bitShift)
+                else:
+                    term = signExt
+                # add with carry, wrapping mod 2**64
+                total = limbs[:, k] + term
+                newCarry = (total < term).astype(np.uint64)
+                total += carry
+                newCarry |= (total < carry).astype(np.uint64)
+                limbs[:, k] = total
+                carry = newCarry
 
         # Mem0 has the most significant bits
-        memRowBitmask = int('1' * nBitsPerMemRow, 2)
-        memMaskShifts = nBitsPerMemRow * np.arange(nMems, dtype=object)[::-1]
-        # now do bitwise_and each value with the mask, and shift back down
-        memRowVals = (iqRowVals[:, np.newaxis] >> memMaskShifts) & memRowBitmask
+        memRowVals = limbs[:, ::-1]
 
         # now each column contains the 64-bit qdr values to be sent to a particular qdr
         return memRowVals
@@ -654,8 +696,8 @@ class Roach2Controls(object):
             else:
                 iqList = memVals[self.lut_dump_buffer_size / 2 * i:len(memVals)]
 
-            iqList = iqList.astype(np.int16)
-            toWriteStr = struct.pack('<{}{}'.format(len(iqList), 'h'), *iqList)
+            iqList = iqList.astype('<i2')  # little endian int16
+            toWriteStr = iqList.tobytes()
             # getLogger(__name__).info('To Write Str Length: ', str(len(toWriteStr)))
             # getLogger(__name__).info(iqList.dtype)
             # getLogger(__name__).info(iqList)
@@ -1123,7 +1165,7 @@ class Roach2Controls(object):
             phaseList - list of phases for each complex signal. If None, generates random phases.
             iqRatioList -
             iqPhaseOffsList -
-            avoidSpikes - If True, loop the generateTones() function with random phases to avoid a 90+ percentile spike in the comb
+            avoidSpikes - If True, loop the generateToneComb() function with random phases to avoid a 90+ percentile spike in the comb
             
         OUTPUTS:
             dictionary with keywords
@@ -1221,9 +1263,9 @@ class Roach2Controls(object):
 
         # Generate and add up individual tone time series.
         # This part takes the longest
-        toneDict = self.generateTones(**toneParams)
-        iValues=np.sum(toneDict['I'],axis=0)
-        qValues=np.sum(toneDict['Q'],axis=0)
+        toneDict = self.generateToneComb(**toneParams)
+        iValues=toneDict['I']
+        qValues=toneDict['Q']
 
         # check that we are utilizing the dynamic range of the DAC correctly
         sig_i = np.std(iValues)
@@ -1233,9 +1275,9 @@ class Roach2Controls(object):
             while max(1.0*np.abs(iValues).max()/sig_i, 1.0*np.abs(qValues).max()/sig_q)>=expectedHighestVal_sig:
                 getLogger(__name__).warning("The freq comb's relative phases may have added up sub-optimally. Calculating with new random phases")
                 toneParams['phaseList']=None    # If it was defined before it didn't work. So do random ones this time
-                toneDict = self.generateTones(**toneParams)
-                iValues=np.sum(toneDict['I'],axis=0)
-                qValues=np.sum(toneDict['Q'],axis=0)
+                toneDict = self.generateToneComb(**toneParams)
+                iValues=toneDict['I']
+                qValues=toneDict['Q']
 
         np.random.set_state(rstate)
 
@@ -1311,17 +1353,8 @@ class Roach2Controls(object):
             quantizedFreqList - list of frequencies after digitial quantiziation
             phaseList - list of phases for each frequency
         """
-        if amplitudeList is None:
-            amplitudeList = np.asarray([1.] * len(freqList))
-        if phaseList is None:
-            phaseList = np.random.uniform(0., 2. * np.pi, len(freqList))
-        if iqRatioList is None:
-            iqRatioList = np.ones(len(freqList))
-        if iqPhaseOffsList is None:
-            iqPhaseOffsList = np.zeros(len(freqList))
-        if len(freqList) != len(amplitudeList) or len(freqList) != len(phaseList) or len(freqList) != len(
-                iqRatioList) or len(freqList) != len(iqPhaseOffsList):
-            raise ValueError("Need exactly one phase, amplitude, and IQ correction value for each resonant frequency!")
+        amplitudeList, phaseList, iqRatioList, iqPhaseOffsList = self._toneParams(freqList, amplitudeList, phaseList,
+                                                                                  iqRatioList, iqPhaseOffsList)
 
         #ts=time.time()
         #dict_py = generateTones_py(freqList, nSamples, sampleRate, amplitudeList, phaseList, iqRatioList, iqPhaseOffsList)
@@ -1341,14 +1374,10 @@ class Roach2Controls(object):
         dt = 1. / sampleRate
         t = dt * np.arange(nSamples)
         for i in range(len(quantizedFreqList)):
-            phi = 2. * np.pi * quantizedFreqList[i] * t
-            expValues = amplitudeList[i] * np.exp(1.j * (phi + phaseList[i]))
-            # getLogger(__name__).info('Rotating ch'+str(i)+' to '+str(phaseList[i]*180./np.pi)+' deg')
-            iScale = np.sqrt(2.) * iqRatioList[i] / np.sqrt(1. + iqRatioList[i] ** 2)
-            qScale = np.sqrt(2.) / np.sqrt(1. + iqRatioList[i] ** 2)
-            iValList.append(iScale * (np.cos(iqPhaseOffsRadList[i]) * np.real(expValues) +
-                                      np.sin(iqPhaseOffsRadList[i]) * np.imag(expValues)))
-            qValList.append(qScale * np.imag(expValues))
+            iVals, qVals = self._toneIQ(t, quantizedFreqList[i], amplitudeList[i], phaseList[i], iqRatioList[i],
+                                        iqPhaseOffsRadList[i])
+            iValList.append(iVals)
+            qValList.append(qVals)
         '''
         if self.debug:
             plt.figure()
@@ -1360,6 +1389,91 @@ class Roach2Controls(object):
         return {'I': np.asarray(iValList), 'Q': np.asarray(qValList), 'quantizedFreqList': quantizedFreqList,
                 'phaseList': phaseList}
 
+    def generateToneComb(self, freqList, nSamples, sampleRate, amplitudeList=None, phaseList=None, iqRatioList=None,
+                         iqPhaseOffsList=None, nSamplesPerChunk=2 ** 14, nThreads=None):
+        """
+        Generate the sum of complex signals with amplitudes and phases specified and frequencies quantized
+
+        This gives exactly (bit for bit) the sum over tones of generateTones(), but the time series is made in
+        chunks of nSamplesPerChunk samples, spread over a pool of threads. Each chunk of every tone stays in cache
+        and only the comb is held in memory, instead of nTones full time series.
+
+        INPUTS:
+            freqList - list of resonator frequencies
+            nSamples - Number of time samples
+            sampleRate - Used to quantize the frequencies
+            amplitudeList - list of amplitudes. If None, use 1.
+            phaseList - list of phases. If None, use random phase
+            nSamplesPerChunk - number of time samples made at once by a thread
+            nThreads - number of threads. If None, use one per cpu
+
+        OUTPUTS:
+            dictionary with keywords
+            I - I(t) values for the frequency comb
+            Q - Q(t)
+            quantizedFreqList - list of frequencies after digitial quantiziation
+            phaseList - list of phases for each frequency
+        """
+        amplitudeList, phaseList, iqRatioList, iqPhaseOffsList = self._toneParams(freqList, amplitudeList, phaseList,
+                                                                                  iqRatioList, iqPhaseOffsList)
+        freqResolution = sampleRate / nSamples
+        quantizedFreqList = np.round(freqList / freqResolution) * freqResolution
+        iqPhaseOffsRadList = np.deg2rad(iqPhaseOffsList)
+
+        iValues = np.zeros(nSamples)
+        qValues = np.zeros(nSamples)
+        dt = 1. / sampleRate
+
+        def makeChunk(start):
+            stop = min(start + nSamplesPerChunk, nSamples)
+            t = dt * np.arange(start, stop)
+            # add the tones in order, like np.sum(generateTones()['I'], axis=0)
+            for i in range(len(quantizedFreqList)):
+                iVals, qVals = self._toneIQ(t, quantizedFreqList[i], amplitudeList[i], phaseList[i], iqRatioList[i],
+                                            iqPhaseOffsRadList[i])
+                iValues[start:stop] += iVals
+                qValues[start:stop] += qVals
+
+        pool = ThreadPool(cpu_count() if nThreads is None else nThreads)
+        try:
+            pool.map(makeChunk, range(0, nSamples, nSamplesPerChunk))
+        finally:
+            pool.close()
+            pool.join()
+
+        return {'I': iValues, 'Q': qValues, 'quantizedFreqList': quantizedFreqList, 'phaseList': phaseList}
+
+    def _toneParams(self, freqList, amplitudeList=None, phaseList=None, iqRatioList=None, iqPhaseOffsList=None):
+        """
+        Fill in the defaults of generateTones() and check there is one of each value per frequency
+        """
+        if amplitudeList is None:
+            amplitudeList = np.asarray([1.] * len(freqList))
+        if phaseList is None:
+            phaseList = np.random.uniform(0., 2. * np.pi, len(freqList))
+        if iqRatioList is None:
+            iqRatioList = np.ones(len(freqList))
+        if iqPhaseOffsList is None:
+            iqPhaseOffsList = np.zeros(len(freqList))
+        if len(freqList) != len(amplitudeList) or len(freqList) != len(phaseList) or len(freqList) != len(
+                iqRatioList) or len(freqList) != len(iqPhaseOffsList):
+            raise ValueError("Need exactly one phase, amplitude, and IQ correction value for each resonant frequency!")
+        return amplitudeList, phaseList, iqRatioList, iqPhaseOffsList
+
+    @staticmethod
+    def _toneIQ(t, quantizedFreq, amplitude, phase, iqRatio, iqPhaseOffsRad):
+        """
+        I(t) and Q(t) of a single tone at times t, with IQ imbalance correction
+        """
+        phi = 2. * np.pi * quantizedFreq * t
+        expValues = amplitude * np.exp(1.j * (phi + phase))
+        # getLogger(__name__).info('Rotating ch'+str(i)+' to '+str(phase*180./np.pi)+' deg')
+        iScale = np.sqrt(2.) * iqRatio / np.sqrt(1. + iqRatio ** 2)
+        qScale = np.sqrt(2.) / np.sqrt(1. + iqRatio ** 2)
+        iVals = iScale * (np.cos(iqPhaseOffsRad) * np.real(expValues) + np.sin(iqPhaseOffsRad) * np.imag(expValues))
+        qVals = qScale * np.imag(expValues)
+        return iVals, qVals
+
     def generateResonatorChannels(self, freqList, order='F'):
         """
         Algorithm for deciding which resonator frequencies are assigned to which stream and channel number.
@@ -1930,12 +2044,15 @@ class Roach2Controls(object):
         """
         self.fpga.write_int(self.params['phaseDumpEn_reg'], 0)
 
-    def recvPhaseStream(self, channel=0, duration=60, pktsPerFrame=100, host='10.0.0.50', port=50000):
+    def recvPhaseStream(self, channel=0, duration=60, pktsPerFrame=100, host='10.0.0.50', port=50000, decoder=None,
+                        callback=None, chunkFrames=1000):
         """
-        Recieves phase timestream data over ethernet, writes it to a file.  Must call
+        Recieves phase timestream data over ethernet.  Must call
         startPhaseStream first to initiate phase stream.
         
-        The data is saved in self.phaseTimeStreamData
+        Frames are received with recv_into into a buffer preallocated for duration seconds of stream.
+        The data is saved in self.phaseTimeStreamData. Use iterPhaseStream() or phasestream.recordPhaseStreams()
+        for captures too long to hold in memory.
         
         INPUTS:
             channel - stream/channel. The first two bits indicate the stream, last 8 bits for the channel
@@ -1944,76 +2061,95 @@ class Roach2Controls(object):
             host - IP address of computer receiving packets 
                 (represented as a string)
             port
+            decoder - PhaseStreamDecoder that decodes each chunk as it arrives. None to only keep the packet data
+            callback - called with the decoded phases of each chunk as it arrives
+            chunkFrames - number of frames per chunk passed to decoder and callback
         
         OUTPUTS:
-            self.phaseTimeStreamData - phase packet data. See parsePhaseStream()
+            self.phaseTimeStreamData - phase packet data (uint8 array). See parsePhaseStream()
         """
-        # d = datetime.datetime.today()
-        # filename = ('phase_dump_pixel_' + str(channel) + '_' + str(d.day) + '_' + str(d.month) + '_' +
-        #    str(d.year) + '_' + str(d.hour) + '_' + str(d.minute) + str('.bin'))
-
         getLogger(__name__).debug('host ' + host)
         getLogger(__name__).debug('port ' + str(port))
         getLogger(__name__).debug('duration ' + str(duration))
 
-        # create dgram udp socket
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            receiver = PhaseStreamReceiver(host, port, pktsPerFrame, timeout=duration * 2)
         except socket.error:
-            getLogger(__name__).error('Failed to create socket')
+            getLogger(__name__).error('Failed to create or bind socket', exc_info=True)
             raise
-        getLogger(__name__).info('Created socket')
-
-        # Bind socket to local host and port
-        try:
-            sock.bind((host, port))
-        except socket.error as msg:
-            getLogger(__name__).info('Bind failed. Error Code : ' + str(msg[0]) + ' Message ' + msg[1])
-            sock.close()
-            raise
-        sock.settimeout(duration * 2)
         getLogger(__name__).info('Socket bind complete')
 
-        bufferSize = int(8 * pktsPerFrame)  # Each photon word is 8 bytes
-        iFrame = 0
-        nFramesLost = 0
-        lastPack = -1
-        expectedPackDiff = -1
-        frameData = ''
-
-        # dumpFile = open(filename, 'w')
-
-        # self.lastPhaseDumpFile = filename
+        def passChunk(data):
+            if decoder is not None:
+                phases = decoder.decode(data)
+            elif callback is not None:
+                phases = decodePhaseWords(data)
+            if callback is not None:
+                callback(phases)
+
+        frameBytes = receiver.frameBytes
+        phaseRate = self.params['fpgaClockRate'] / self.params['nChannelsPerStream']
+        nFramesExpected = int(1.05 * duration * phaseRate / N_PHASES_PER_WORD / pktsPerFrame) + chunkFrames
+        frameData = np.empty(nFramesExpected * frameBytes, dtype=np.uint8)
+        nFilled = 0
+        chunkStart = 0
 
         startTime = time.time()
         try:
             while (time.time() - startTime) < duration:
-                frame = sock.recvfrom(bufferSize)
-                frameData += frame[0]
-                iFrame += 1
-                if iFrame % 1000 == 0:
-                    getLogger(__name__).debug(iFrame)
+                if nFilled + frameBytes > len(frameData):
+                    frameData = np.concatenate((frameData[:nFilled], np.empty(len(frameData) // 2, dtype=np.uint8)))
+                nFilled += receiver.recvInto(frameData[nFilled:])
+                if receiver.nFrames % chunkFrames == 0:
+                    passChunk(frameData[chunkStart:nFilled])
+                    chunkStart = nFilled
+                    getLogger(__name__).debug(receiver.nFrames)
+            passChunk(frameData[chunkStart:nFilled])
 
         except KeyboardInterrupt:
             getLogger(__name__).info('Exiting on KeyboardInterrupt')
-            sock.close()
-            self.phaseTimeStreamData = frameData
-            # dumpFile.write(frameData)
-            # dumpFile.close()
+            receiver.close()
+            self.phaseTimeStreamData = frameData[:nFilled]
             return
         except socket.timeout:
             getLogger(__name__).error('Exiting on timeout')
-            sock.close()
-            self.phaseTimeStreamData = frameData
+            receiver.close()
+            self.phaseTimeStreamData = frameData[:nFilled]
             raise
 
-        # getLogger(__name__).info('Exiting')
-        sock.close()
-        self.phaseTimeStreamData = frameData
-        # dumpFile.write(frameData)
-        # dumpFile.close()
+        receiver.close()
+        self.phaseTimeStreamData = frameData[:nFilled]
         return self.phaseTimeStreamData
 
+    def iterPhaseStream(self, selChanIndex=0, duration=2, pktsPerFrame=100, fabric_port=50000, hostIP='10.0.0.50',
+                        chunkFrames=1000):
+        """
+        Streams phase timestream data from the specified channel, yielding it in decoded chunks as it arrives.
+        Memory use does not grow with duration.
+        
+        INPUTS:
+            selChanIndex - stream/channel. The first two bits indicate the stream, last 8 bits for the channel
+            duration - duration (in seconds) of stream
+            pktsPerFrame - number of 8 byte photon words per ethernet frame
+            fabric_port - port the stream is sent to
+            hostIP - IP address of computer receiving stream
+            chunkFrames - number of frames per chunk
+        
+        OUTPUTS:
+            yields arrays of phases in radians
+        """
+        receiver = PhaseStreamReceiver(hostIP, fabric_port, pktsPerFrame, timeout=duration * 2)
+        try:
+            self.startPhaseStream(selChanIndex, pktsPerFrame, fabric_port, hostIP)
+            for phases in receiver.chunks(duration, chunkFrames):
+                yield phases
+        except socket.timeout:
+            getLogger(__name__).error('Exiting on timeout')
+            raise
+        finally:
+            receiver.close()
+            self.stopStream()
+
     def takePhaseStreamDataOfFreqChannel(self, freqChan=0, duration=2, pktsPerFrame=100, fabric_port=50000,
                                          hostIP='10.0.0.50'):
         """
@@ -2052,14 +2188,21 @@ class Roach2Controls(object):
             phases - a list of phases in radians
         """
 
-        self.startPhaseStream(selChanIndex, pktsPerFrame, fabric_port, hostIP)
         getLogger(__name__).debug("Collecting phase time stream...")
-        # self.recvPhaseStream(selChanIndex, duration, pktsPerFrame, '10.0.0.'+str(destIPID), fabric_port)
-        phaseTimeStreamData = self.recvPhaseStream(selChanIndex, duration, pktsPerFrame, hostIP, fabric_port)
-        self.stopStream()
+        phaseRate = self.params['fpgaClockRate'] / self.params['nChannelsPerStream']
+        phases = np.empty(int(1.05 * duration * phaseRate))
+        nPhases = 0
+        try:
+            for chunk in self.iterPhaseStream(selChanIndex, duration, pktsPerFrame, fabric_port, hostIP):
+                if nPhases + len(chunk) > len(phases):
+                    phases = np.concatenate((phases[:nPhases], np.empty(max(len(chunk), len(phases) // 2))))
+                phases[nPhases:nPhases + len(chunk)] = chunk
+                nPhases += len(chunk)
+        except KeyboardInterrupt:
+            getLogger(__name__).info('Exiting on KeyboardInterrupt')
         getLogger(__name__).info("...Done!")
 
-        return self.parsePhaseStream(phaseTimeStreamData, pktsPerFrame)
+        return phases[:nPhases]
 
     # def parsePhaseStream(self, phaseDumpFile=None, pktsPerFrame=100):
     def parsePhaseStream(self, phaseTimeStreamData=None, pktsPerFrame=100):
@@ -2085,49 +2228,8 @@ class Roach2Controls(object):
         if phaseTimeStreamData is None:
             data = self.phaseTimeStreamData
 
-        nBytes = len(data)
-        nWords = nBytes / 8  # 64 bit words
-        # break into 64 bit words
-        words = np.array(struct.unpack('>{:d}Q'.format(nWords), data), dtype=object)
-
-        # remove headers
-        headerFirstByte = 0xff
-        firstBytes = words >> (64 - 8)
-        headerIdx = np.where(firstBytes == headerFirstByte)[0]
-        words = np.delete(words, headerIdx)
-
-        nBitsPerPhase = 12
-        binPtPhase = 9
-        nPhasesPerWord = 5
-        # to parse out the 5 12-bit values, we'll shift down the bits we don't want for each value, then apply a bitmask to take out
-        # bits higher than the 12 we want
-        # The least significant bits in the word should be the earliest phase, so the first column should have zero bitshift
-        bitmask = int('1' * nBitsPerPhase, 2)
-        bitshifts = nBitsPerPhase * np.arange(nPhasesPerWord)
-
-        # add an axis so we can broadcast
-        # and shift away the bits we don't keep for each row
-        # getLogger(__name__).info(np.shape(words[:,np.newaxis]),words.dtype)
-        # getLogger(__name__).info(bitshifts)
-        # getLogger(__name__).info(words[0:10])
-        phases = (words[:, np.newaxis]) >> bitshifts
-        phases = phases & bitmask
-
-        # now we have a nWords x nPhasesPerWord array
-
-        # flatten so that the phases are in order
-        phases = phases.flatten(order='C')
-        phases = np.array(phases, dtype=np.uint64)
-        signBits = np.array(phases / (2 ** (nBitsPerPhase - 1)), dtype=np.bool)
-        # getLogger(__name__).info(signBits[0:10])
-
-        # check the sign bits to see what values should be negative
-        # for the ones that should be negative undo the 2's complement, and flip the sign
-        phases[signBits] = ((~phases[signBits]) & bitmask) + 1
-        phases = np.array(phases, dtype=np.double)
-        phases[signBits] = -phases[signBits]
-        # now shift down to the binary point
-        phases = phases / 2 ** binPtPhase
+        # headers are dropped and the 5 12-bit phases in each word unpacked in order, see phasestream.py
+        phases = decodePhaseWords(data)
 
         return phases
         # convert from radians to degrees
@@ -2146,7 +2248,7 @@ class Roach2Controls(object):
 
         # plt.show()
 
-    def performIQSweep(self, startLOFreq, stopLOFreq, stepLOFreq):
+    def performIQSweep(self, startLOFreq, stopLOFreq, stepLOFreq, concurrentReads=False, pipelined=True):
         """
         Performs a sweep over the LO frequency.  Records 
         one IQ point per channel per freqeuency; stores in
@@ -2158,20 +2260,16 @@ class Roach2Controls(object):
                      Get one per stream (4 streams for all thousand resonators)
                      Formatted using formatIQSweepData then stored in self.iqSweepData
         
-        The logic is as follows:
-            set LO
-            Arm the snapshot block
-            trigger write enable - This grabs the first set of 256 I, 256 Q points
-            disable the writeEnable
-            set LO
-            trigger write enable - This grabs the a second set of 256 I, 256 Q points
-            read snapshot block - read 1024 points from mem
-            disable writeEnable
+        The snapshot sequence is run by acquireIQSnapshots(), which loads the next LO frequency
+        while the previous pair of steps is read out of the snapshot blocks.
+        Per step timings are left in self.iqSnapshotTiming
 
         INPUTS:
             startLOFreq - starting sweep frequency [MHz]
             stopLOFreq - final sweep frequency [MHz]
             stepLOFreq - frequency sweep step size [MHz]
+            concurrentReads - read the snapshot blocks of all streams in parallel
+            pipelined - overlap snapshot readout with setting the next LO frequencies
         OUTPUTS:
             iqSweepData - Dictionary with following keywords
                           I - 2D array with shape = [nFreqs, nLOsteps]
@@ -2180,39 +2278,13 @@ class Roach2Controls(object):
             
         """
         LOFreqs = np.arange(startLOFreq, stopLOFreq, stepLOFreq)
-        nStreams = self.params['nChannels'] / self.params['nChannelsPerStream']
-        iqData = np.empty([nStreams, 0])
-
-        # The magic number 4 below is the number of IQ points per read
-        # We get two I points and two Q points every read
-        iqPt = np.empty([nStreams, self.params['nChannelsPerStream'] * 4])
-        self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
-
-        for i in range(len(LOFreqs)):
-            getLogger(__name__).debug('Sweeping LO ' + str(LOFreqs[i]) + ' MHz')
-            self.loadLOFreq(LOFreqs[i])
-            # time.sleep(0.01)    # I dunno how long it takes to set the LO
-            if i % 2 == 0:
-                for stream in range(nStreams):
-                    self.fpga.snapshots[self.params['iqSnp_regs'][stream]].arm(man_valid=False, man_trig=False)
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 1)
-            time.sleep(0.001)  # takes nChannelsPerStream/fpgaClockRate seconds to load all the values
-            if i % 2 == 1:
-                for stream in range(nStreams):
-                    iqPt[stream] = \
-                    self.fpga.snapshots[self.params['iqSnp_regs'][stream]].read(timeout=10, arm=False)['data']['iq']
-                iqData = np.append(iqData, iqPt, 1)
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
 
-        # if odd number of LO steps then we still need to read out half of the last buffer
-        if len(LOFreqs) % 2 == 1:
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 1)
-            time.sleep(0.001)
-            for stream in range(nStreams):
-                iqPt[stream] = \
-                self.fpga.snapshots[self.params['iqSnp_regs'][stream]].read(timeout=10, arm=False)['data']['iq']
-            iqData = np.append(iqData, iqPt[:, :self.params['nChannelsPerStream'] * 2], 1)
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
+        def setLO(step):
+            getLogger(__name__).debug('Sweeping LO ' + str(LOFreqs[step]) + ' MHz')
+            self.loadLOFreq(LOFreqs[step])
+
+        iqData = self.acquireIQSnapshots(len(LOFreqs), prepareStep=setLO, concurrentReads=concurrentReads,
+                                         pipelined=pipelined)
 
         self.loadLOFreq()  # reloads initial lo freq
         self.iqSweepData = self.formatIQSweepData(iqData)
@@ -2220,6 +2292,122 @@ class Roach2Controls(object):
         # self.iqSweepData = iqData
         return self.iqSweepData
 
+    def acquireIQSnapshots(self, nSteps, prepareStep=None, concurrentReads=False, pipelined=True, accTime=0.001):
+        """
+        Takes one IQ point per channel at each of nSteps steps with the IQ snapshot blocks
+
+        Each snapshot block holds two steps, so the logic is:
+            prepare step (eg. set LO)
+            trigger write enable - This grabs the first set of 256 I, 256 Q points
+            prepare next step
+            trigger write enable - This grabs the a second set of 256 I, 256 Q points
+            read snapshot blocks and rearm them
+        When pipelined, the readout of a pair of steps runs in a worker thread while the
+        main thread prepares the next step, and is only waited on before the next trigger.
+
+        INPUTS:
+            nSteps - number of IQ points to take
+            prepareStep - called with the step index before each step is triggered. None to do nothing
+            concurrentReads - read the snapshot blocks of all streams in parallel
+            pipelined - overlap snapshot readout with prepareStep()
+            accTime - seconds to wait after triggering for the IQ values to be loaded
+        OUTPUTS:
+            iqData - 2D array with shape [nStreams, (nChannelsPerStream+nChannelsPerStream) * nSteps]
+                     (see performIQSweep)
+
+        Assigned Attributes:
+            self.iqSnapshotTiming - dictionary of arrays [nSteps] with the seconds spent on each step in
+                                    prepare - prepareStep()
+                                    wait - waiting for the readout of the previous pair of steps
+                                    arm - arming the snapshot blocks (when not rearmed by the readout)
+                                    trigger - triggering the snapshot blocks
+                                    read - reading out the snapshot blocks, in the step that completes a pair
+        """
+        nStreams = int(self.params['nChannels'] / self.params['nChannelsPerStream'])
+        nPerStep = 2 * self.params['nChannelsPerStream']  # 256 I + 256 Q
+        snapshots = [self.fpga.snapshots[self.params['iqSnp_regs'][stream]] for stream in range(nStreams)]
+        iqData = np.empty([nStreams, nPerStep * nSteps])
+        timing = dict((key, np.zeros(nSteps)) for key in ('prepare', 'wait', 'arm', 'trigger', 'read'))
+        self.iqSnapshotTiming = timing
+
+        def readStreams(streams, firstStep, nValid, rearm):
+            for stream in streams:
+                iq = snapshots[stream].read(timeout=10, arm=False)['data']['iq']
+                iqData[stream, firstStep * nPerStep:(firstStep + nValid) * nPerStep] = iq[:nValid * nPerStep]
+                if rearm:
+                    snapshots[stream].arm(man_valid=False, man_trig=False)
+
+        def readout(firstStep, nValid, rearm):
+            tic = time.time()
+            if concurrentReads:
+                pending = [pool.apply_async(readStreams, ([stream], firstStep, nValid, rearm))
+                           for stream in range(nStreams)]
+                for result in pending:
+                    result.get()
+            else:
+                readStreams(range(nStreams), firstStep, nValid, rearm)
+            timing['read'][firstStep + nValid - 1] = time.time() - tic
+
+        # concurrent reads are submitted from the pipeline thread, so need their own workers
+        pool = ThreadPool(nStreams) if concurrentReads else None
+        pipeline = ThreadPool(1) if pipelined else None
+        readPending = None
+        armed = False
+        try:
+            self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
+            for step in range(nSteps):
+                tic = time.time()
+                if prepareStep is not None:
+                    prepareStep(step)
+                timing['prepare'][step] = time.time() - tic
+
+                tic = time.time()
+                if readPending is not None:
+                    readPending.get()
+                    readPending = None
+                timing['wait'][step] = time.time() - tic
+
+                tic = time.time()
+                if not armed:
+                    for snapshot in snapshots:
+                        snapshot.arm(man_valid=False, man_trig=False)
+                    armed = True
+                timing['arm'][step] = time.time() - tic
+
+                tic = time.time()
+                self.fpga.write_int(self.params['iqSnpStart_reg'], 1)
+                time.sleep(accTime)  # takes nChannelsPerStream/fpgaClockRate seconds to load all the values
+                self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
+                timing['trigger'][step] = time.time() - tic
+
+                # the snapshot blocks are full after every second step, and after the last one
+                if step % 2 == 1 or step == nSteps - 1:
+                    if step % 2 == 0:
+                        # odd number of steps: trigger again so the last buffer fills and can be read out
+                        tic = time.time()
+                        self.fpga.write_int(self.params['iqSnpStart_reg'], 1)
+                        time.sleep(accTime)
+                        self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
+                        timing['trigger'][step] += time.time() - tic
+                    firstStep = step - step % 2
+                    rearm = step < nSteps - 1
+                    if pipelined:
+                        readPending = pipeline.apply_async(readout, (firstStep, step - firstStep + 1, rearm))
+                    else:
+                        readout(firstStep, step - firstStep + 1, rearm)
+                    armed = rearm
+            if readPending is not None:
+                readPending.get()
+        finally:
+            for threadPool in (pipeline, pool):
+                if threadPool is not None:
+                    threadPool.close()
+                    threadPool.join()
+
+        getLogger(__name__).debug('r{}: {} IQ steps, seconds spent in '.format(self.num, nSteps) +
+                                  ', '.join('{} {:.3f}'.format(key, val.sum()) for key, val in timing.items()))
+        return iqData
+
     def formatIQSweepData(self, iqDataStreams):
         """
         Reshapes the iqdata into a usable format
@@ -2336,47 +2524,20 @@ class Roach2Controls(object):
             streamCoordBits = np.array(streamCoordBits)
             self.writeBram(memName=self.params['pixelnames_bram'][stream], valuesToWrite=streamCoordBits)
 
-    def takeAvgIQData(self, numPts=100):
+    def takeAvgIQData(self, numPts=100, concurrentReads=False):
         """
         Take IQ data with the LO fixed (at self.LOFreq)
 
         INPUTS:
             numPts - Number of IQ points to take 
+            concurrentReads - read the snapshot blocks of all streams in parallel
         
         OUTPUTS:
             iqSweepData - Dictionary with following keywords
                           I - 2D array with shape = [nFreqs, nLOsteps]
                           Q - 2D array with shape = [nFreqs, nLOsteps]
         """
-
-        counter = np.arange(numPts)
-        nStreams = self.params['nChannels'] / self.params['nChannelsPerStream']
-        iqData = np.empty([nStreams, 0])
-        self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
-        iqPt = np.empty([nStreams, self.params['nChannelsPerStream'] * 4])
-
-        for i in counter:
-            getLogger(__name__).debug('IQ point #' + str(i))
-            if i % 2 == 0:
-                for stream in range(nStreams):
-                    self.fpga.snapshots[self.params['iqSnp_regs'][stream]].arm(man_valid=False, man_trig=False)
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 1)
-            time.sleep(0.001)  # takes nChannelsPerStream/fpgaClockRate seconds to load all the values
-            if i % 2 == 1:
-                for stream in range(nStreams):
-                    iqPt[stream] = self.fpga.snapshots[self.params['iqSnp_regs'][stream]].read(timeout=10, arm=False)['data']['iq']
-                iqData = np.append(iqData, iqPt, 1)
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
-
-        # if odd number of steps then we still need to read out half of the last buffer
-        if len(counter) % 2 == 1:
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 1)
-            time.sleep(0.001)
-            for stream in range(nStreams):
-                iqPt[stream] = self.fpga.snapshots[self.params['iqSnp_regs'][stream]].read(timeout=10, arm=False)['data']['iq']
-            iqData = np.append(iqData, iqPt[:, :self.params['nChannelsPerStream'] * 2], 1)
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
-
+        iqData = self.acquireIQSnapshots(numPts, concurrentReads=concurrentReads, pipelined=False)
         self.iqToneData = self.formatIQSweepData(iqData)
         # self.iqToneDataRaw = iqData
         return self.iqToneData
@@ -107,9 +107,12 @@ class RoachStateMachine(QtCore.QObject):  # Extends QObject for use with QThread
         fl = self.config.roaches.get('r{}.feedline'.format(self.num))
         range = self.config.roaches.get('r{}.range'.format(self.num))
         ip = self.config.roaches.get('r{}.ip'.format(self.num))
+        simulate = self.config.roaches.get('r{}.simulate'.format(self.num), False)
+        if simulate:
+            simulate = {'latency': self.config.roaches.get('r{}.sim_katcp_latency'.format(self.num), 0.5e-3)}
 
         self.roachController = Roach2Controls(ip, FPGAParamFile, feedline=fl, num=self.num,
-                                              range=range, verbose=True, debug=False)
+                                              range=range, verbose=True, debug=False, simulate=simulate)
 
     def addCommands(self, command):
         """
@@ -0,0 +1,58 @@
+"""
+Times generateToneComb() against summing the tones from generateTones(), the way generateDacComb() used to make
+the DAC comb, and checks that the comb and its quantized LUT values are identical.
+
+Usage: python dacCombBenchmark.py [nTones] [nSamplesPerChunk] [nThreads]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from mkidreadout.channelizer.Roach2Controls import Roach2Controls
+
+
+def timeit(func, *args, **kwargs):
+    tic = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - tic
+
+
+if __name__ == '__main__':
+    nTones = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    nSamplesPerChunk = int(sys.argv[2]) if len(sys.argv) > 2 else 2 ** 14
+    nThreads = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    roach = Roach2Controls('10.0.0.112', simulate=True)
+    roach.connect()
+    params = roach.params
+
+    nSamples = params['nDacSamplesPerCycle'] * params['nLutRowsToUse']
+    sampleRate = params['dacSampleRate']
+    maxAmp = 2 ** (params['nBitsPerSamplePair'] // 2 - 1) - 1
+    toneParams = {'freqList': np.sort(np.random.uniform(0, sampleRate, nTones)),
+                  'nSamples': nSamples,
+                  'sampleRate': sampleRate,
+                  'amplitudeList': maxAmp * 10 ** (-np.random.uniform(0, 10, nTones) / 20.) / np.sqrt(nTones),
+                  'phaseList': np.random.uniform(0., 2. * np.pi, nTones),
+                  'iqRatioList': np.random.uniform(0.9, 1.1, nTones),
+                  'iqPhaseOffsList': np.random.uniform(-5, 5, nTones)}
+
+    def sumTones():
+        toneDict = roach.generateTones(**toneParams)
+        return np.sum(toneDict['I'], axis=0), np.sum(toneDict['Q'], axis=0)
+
+    (iRef, qRef), tRef = timeit(sumTones)
+    combDict, tComb = timeit(roach.generateToneComb, nSamplesPerChunk=nSamplesPerChunk, nThreads=nThreads,
+                             **toneParams)
+
+    print('{} tones of {} samples'.format(nTones, nSamples))
+    print('{:<22} {:>10} {:>12} {:>10}'.format('', 'seconds', 'MB of tones', 'speedup'))
+    print('{:<22} {:>10.2f} {:>12.0f} {:>10.1f}'.format('sum of generateTones', tRef, 2 * nTones * nSamples * 8 / 1.e6,
+                                                         1.))
+    print('{:<22} {:>10.2f} {:>12.0f} {:>10.1f}'.format('generateToneComb', tComb, 2 * nSamples * 8 / 1.e6,
+                                                         tRef / tComb))
+    print('identical: comb {} quantized {}'.format(
+        np.array_equal(iRef, combDict['I']) and np.array_equal(qRef, combDict['Q']),
+        np.array_equal(np.round(iRef).astype(int), np.round(combDict['I']).astype(int)) and
+        np.array_equal(np.round(qRef).astype(int), np.round(combDict['Q']).astype(int))))
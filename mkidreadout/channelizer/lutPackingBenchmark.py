@@ -0,0 +1,84 @@
+"""
+Times formatWaveForMem() and writeQdr() for a full DDS QDR LUT against the original python long / struct
+implementations, and checks that the bytes written to the (simulated) QDR are identical.
+
+Usage: python lutPackingBenchmark.py [nQdrRows]
+"""
+
+import struct
+import sys
+import time
+
+import numpy as np
+
+from mkidreadout.channelizer.Roach2Controls import Roach2Controls
+from mkidreadout.channelizer.simfpga import SimulatedFpga
+
+
+def formatWaveForMemReference(iVals, qVals, nBitsPerSamplePair=32, nSamplesPerCycle=4096, nMems=3,
+                              nBitsPerMemRow=64, earlierSampleIsMsb=False):
+    """
+    The original formatWaveForMem(), with object arrays of python longs
+    """
+    nBitsPerSampleComponent = nBitsPerSamplePair // 2
+    iqVals = (iVals << nBitsPerSampleComponent) + qVals
+    iqRows = np.reshape(iqVals, (-1, nSamplesPerCycle))
+    colBitShifts = nBitsPerSamplePair * (np.arange(nSamplesPerCycle, dtype=object))
+    if earlierSampleIsMsb:
+        colBitShifts = colBitShifts[::-1]
+    iqRowVals = np.sum(iqRows.astype(object) << colBitShifts, axis=1)
+    memRowBitmask = int('1' * nBitsPerMemRow, 2)
+    memMaskShifts = nBitsPerMemRow * np.arange(nMems, dtype=object)[::-1]
+    return (iqRowVals[:, np.newaxis] >> memMaskShifts) & memRowBitmask
+
+
+def writeQdrReference(fpga, memName, valuesToWrite, start=0):
+    """
+    The original writeQdr(), packing with struct
+    """
+    memValues = np.array([int(v) for v in valuesToWrite], dtype=np.uint64)
+    mask32 = int('1' * 32, 2)
+    memValues = np.array([(int(v) >> 32) + ((int(v) & mask32) << 32) for v in memValues], dtype=np.uint64)
+    memValues = np.roll(memValues, -1)
+    fpga.blindwrite(memName, struct.pack('>{}Q'.format(len(memValues)), *memValues), start)
+
+
+def timeit(func, *args, **kwargs):
+    tic = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - tic
+
+
+if __name__ == '__main__':
+    nQdrRows = int(sys.argv[1]) if len(sys.argv) > 1 else 2 ** 20
+    fpga = SimulatedFpga(latency=0, bandwidth=None)
+    roach = Roach2Controls('10.0.0.112', simulate=fpga)
+    roach.connect()
+    params = roach.params
+
+    # a DDS stream as generateDdsTones() makes it
+    maxValue = 2 ** (params['nBitsPerDdsSamplePair'] // 2 - 1) - 1
+    nSamples = nQdrRows * params['nDdsSamplesPerCycle']
+    iVals = np.random.randint(-maxValue, maxValue + 1, nSamples)
+    qVals = np.random.randint(-maxValue, maxValue + 1, nSamples)
+    formatArgs = {'nBitsPerSamplePair': params['nBitsPerDdsSamplePair'],
+                  'nSamplesPerCycle': params['nDdsSamplesPerCycle'], 'nMems': 1,
+                  'nBitsPerMemRow': params['nBytesPerQdrSample'] * 8, 'earlierSampleIsMsb': True}
+
+    refVals, tRefFormat = timeit(formatWaveForMemReference, iVals, qVals, **formatArgs)
+    memVals, tFormat = timeit(roach.formatWaveForMem, iVals, qVals, **formatArgs)
+    _, tRefWrite = timeit(writeQdrReference, fpga, 'reference', refVals[:, 0])
+    _, tWrite = timeit(roach.writeQdr, 'qdr0_memory', memVals[:, 0])
+
+    # the general case, 3 memories of several samples each
+    iSmall, qSmall = iVals[:8 * 4096], qVals[:8 * 4096]
+    wideArgs = {'nBitsPerSamplePair': 24, 'nSamplesPerCycle': 8, 'nMems': 3}
+    wideSame = np.array_equal(formatWaveForMemReference(iSmall % 2 ** 11 - 2 ** 10, qSmall % 2 ** 11, **wideArgs),
+                              roach.formatWaveForMem(iSmall % 2 ** 11 - 2 ** 10, qSmall % 2 ** 11, **wideArgs))
+
+    print('DDS LUT of {} QDR rows ({:.1f} MB)'.format(nQdrRows, nQdrRows * 8 / 1.e6))
+    print('{:<18} {:>12} {:>12} {:>10}'.format('', 'python long', 'uint64', 'speedup'))
+    print('{:<18} {:>12.3f} {:>12.3f} {:>10.1f}'.format('formatWaveForMem', tRefFormat, tFormat, tRefFormat / tFormat))
+    print('{:<18} {:>12.3f} {:>12.3f} {:>10.1f}'.format('writeQdr', tRefWrite, tWrite, tRefWrite / tWrite))
+    print('identical: values {} qdr bytes {} 3 memory layout {}'.format(
+        np.array_equal(refVals, memVals), fpga.memories['reference'] == fpga.memories['qdr0_memory'], wideSame))
@@ -0,0 +1,79 @@
+"""
+Compares the phase stream decoding in phasestream.py with the original struct/object array
+implementation of Roach2Controls.parsePhaseStream on a synthetic stream, and checks they agree.
+
+Usage: python phaseStreamBenchmark.py [seconds of stream] [pktsPerFrame]
+"""
+
+import struct
+import sys
+import time
+
+import numpy as np
+
+from mkidreadout.channelizer.phasestream import N_BITS_PER_PHASE, N_PHASES_PER_WORD, PhaseStreamDecoder, \
+    decodePhaseWords
+
+PHASE_SAMPLE_RATE = 250.e6 / 256  # one phase every nChannelsPerStream/fpgaClockRate seconds
+
+
+def parsePhaseStreamReference(data):
+    """
+    The decoding parsePhaseStream() used to do, with python longs in an object array
+    """
+    nWords = len(data) // 8
+    words = np.array(struct.unpack('>{:d}Q'.format(nWords), data), dtype=object)
+    firstBytes = words >> (64 - 8)
+    words = np.delete(words, np.where(firstBytes == 0xff)[0])
+    bitmask = int('1' * N_BITS_PER_PHASE, 2)
+    bitshifts = N_BITS_PER_PHASE * np.arange(N_PHASES_PER_WORD)
+    phases = (words[:, np.newaxis]) >> bitshifts
+    phases = phases & bitmask
+    phases = np.array(phases.flatten(order='C'), dtype=np.uint64)
+    signBits = np.array(phases // (2 ** (N_BITS_PER_PHASE - 1)), dtype=bool)
+    phases[signBits] = ((~phases[signBits]) & bitmask) + 1
+    phases = np.array(phases, dtype=np.double)
+    phases[signBits] = -phases[signBits]
+    return phases / 2 ** 9
+
+
+def makeStream(duration, pktsPerFrame):
+    """
+    Random phase words in frames that start with a header word
+    """
+    nFrames = int(duration * PHASE_SAMPLE_RATE / N_PHASES_PER_WORD / (pktsPerFrame - 1))
+    fields = np.random.randint(0, 2 ** N_BITS_PER_PHASE, (nFrames, pktsPerFrame - 1, N_PHASES_PER_WORD))
+    words = np.zeros((nFrames, pktsPerFrame), dtype=np.uint64)
+    for i in range(N_PHASES_PER_WORD):
+        words[:, 1:] |= fields[:, :, i].astype(np.uint64) << np.uint64(N_BITS_PER_PHASE * i)
+    words[:, 0] = np.uint64(0xff) << np.uint64(56)
+    return words.astype('>u8').tobytes()
+
+
+def timeit(func, *args):
+    tic = time.time()
+    result = func(*args)
+    return result, time.time() - tic
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 2.
+    pktsPerFrame = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    data = makeStream(duration, pktsPerFrame)
+    frameBytes = 8 * pktsPerFrame
+
+    def decodeFrames():
+        decoder = PhaseStreamDecoder()
+        for i in range(0, len(data), frameBytes):
+            decoder.decode(data[i:i + frameBytes])
+        return decoder.phases()
+
+    reference, tRef = timeit(parsePhaseStreamReference, data)
+    phases, tVec = timeit(decodePhaseWords, data)
+    streamed, tStream = timeit(decodeFrames)
+
+    print('{:.1f} s of phase stream, {:.1f} MB, {} phases'.format(duration, len(data) / 1.e6, len(reference)))
+    print('{:<28} {:>10} {:>10}'.format('', 'seconds', 'speedup'))
+    for name, t in (('object array (old)', tRef), ('decodePhaseWords', tVec), ('PhaseStreamDecoder, per frame', tStream)):
+        print('{:<28} {:>10.3f} {:>10.1f}'.format(name, t, tRef / t))
+    print('identical: {} {}'.format(np.array_equal(reference, phases), np.array_equal(reference, streamed)))
@@ -0,0 +1,234 @@
+"""
+Receiving and decoding of the phase timestream the firmware sends over the 1Gbit ethernet (see
+Roach2Controls.startPhaseStream)
+
+Each ethernet frame holds pktsPerFrame big endian 64 bit words. Words whose first byte is 0xff are
+headers, every other word packs 5 signed 12 bit phases (9 bits after the binary point, radians) with
+the earliest phase in the least significant bits.
+
+Frames are received with recv_into into preallocated buffers. PhaseStreamReceiver.chunks() yields the
+stream in decoded chunks as it arrives, and recordPhaseStreams() writes the packet data of several
+streams (eg. one channel on each of several roaches) to disk at once, for long captures that should not
+be held in memory. Such files are read back with readPhaseFile().
+"""
+
+import errno
+import select
+import socket
+import time
+
+import numpy as np
+
+from mkidcore.corelog import getLogger
+
+HEADER_FIRST_BYTE = 0xff
+N_BITS_PER_PHASE = 12
+BIN_PT_PHASE = 9
+N_PHASES_PER_WORD = 5
+
+# socket receive buffer, enough for ~5 s of a phase stream (1.6 MB/s) if we fall behind
+RECV_BUFFER_BYTES = 8 * 1024 * 1024
+
+_PHASE_MASK = np.uint64(2 ** N_BITS_PER_PHASE - 1)
+_PHASE_SHIFTS = (N_BITS_PER_PHASE * np.arange(N_PHASES_PER_WORD)).astype(np.uint64)
+
+
+def decodePhaseWords(data):
+    """
+    Decodes phase stream packet data into phases
+
+    INPUTS:
+        data - bytes of whole 64 bit words (a trailing partial word is ignored)
+
+    OUTPUTS:
+        phases - array of phases in radians, in the order they were taken
+    """
+    words = np.frombuffer(data, dtype='>u8', count=len(data) // 8)
+    words = words[(words >> np.uint64(56)) != HEADER_FIRST_BYTE]
+
+    # nWords x nPhasesPerWord array of the 12 bit fields, flattened so that the phases are in order
+    fields = ((words[:, np.newaxis] >> _PHASE_SHIFTS) & _PHASE_MASK).astype(np.int32).ravel()
+    # sign extend the 12 bit two's complement values
+    fields = (fields ^ 2 ** (N_BITS_PER_PHASE - 1)) - 2 ** (N_BITS_PER_PHASE - 1)
+    return fields / 2. ** BIN_PT_PHASE
+
+
+class PhaseStreamDecoder(object):
+    """
+    Decodes a phase stream frame by frame as it is received
+
+    decode() returns the phases in each chunk of data and keeps them, phases() returns everything decoded
+    so far. Bytes of a word split across chunks are carried over to the next chunk.
+    """
+
+    def __init__(self, keep=True):
+        """
+        INPUTS:
+            keep - keep the decoded chunks for phases(). False if the caller consumes them itself
+        """
+        self.keep = keep
+        self.nBytes = 0
+        self._partial = np.empty(0, dtype=np.uint8)
+        self._chunks = []
+
+    def decode(self, data):
+        """
+        INPUTS:
+            data - next chunk of packet data, eg. one ethernet frame
+        OUTPUTS:
+            phases - array of phases in radians in the complete words received so far
+        """
+        data = np.frombuffer(data, dtype=np.uint8)
+        self.nBytes += len(data)
+        if len(self._partial):
+            data = np.concatenate((self._partial, data))
+        nWhole = len(data) - len(data) % 8
+        self._partial = data[nWhole:].copy()
+        phases = decodePhaseWords(data[:nWhole])
+        if self.keep:
+            self._chunks.append(phases)
+        return phases
+
+    def phases(self):
+        """
+        All phases decoded so far
+        """
+        if len(self._chunks) != 1:
+            self._chunks = [np.concatenate(self._chunks) if self._chunks else np.empty(0)]
+        return self._chunks[0]
+
+
+class PhaseStreamReceiver(object):
+    """
+    UDP socket receiving a phase stream into preallocated buffers with recv_into
+    """
+
+    def __init__(self, host, port, pktsPerFrame=100, timeout=None):
+        """
+        INPUTS:
+            host - IP address of the interface receiving the stream
+            port - port the roach sends the stream to
+            pktsPerFrame - number of 8 byte words per ethernet frame
+            timeout - seconds to wait for a frame before socket.timeout is raised. None waits forever
+        """
+        self.host = host
+        self.port = port
+        self.frameBytes = 8 * pktsPerFrame
+        self.nFrames = 0
+        self.nBytes = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_BYTES)
+        except socket.error:
+            getLogger(__name__).debug('Could not enlarge the socket receive buffer')
+        try:
+            self.sock.bind((host, port))
+        except socket.error:
+            self.sock.close()
+            raise
+        self.sock.settimeout(timeout)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    def recvInto(self, view):
+        """
+        Receives one frame into the writable buffer view (eg. a uint8 array), returns the number of bytes received
+        """
+        nBytes = self.sock.recv_into(view, self.frameBytes)
+        self.nFrames += 1
+        self.nBytes += nBytes
+        return nBytes
+
+    def chunks(self, duration, chunkFrames=1000, decode=True):
+        """
+        Generator over the stream received in the next duration seconds
+
+        INPUTS:
+            duration - seconds to receive for
+            chunkFrames - number of frames per chunk
+            decode - yield decoded phases. If False, yield uint8 arrays of the packet data, which are
+                     only valid until the next chunk is requested
+        OUTPUTS:
+            yields arrays of phases in radians (or packet data) every chunkFrames frames and at the end
+        """
+        buf = np.empty(chunkFrames * self.frameBytes, dtype=np.uint8)
+        nFilled = 0
+        startTime = time.time()
+        while (time.time() - startTime) < duration:
+            nFilled += self.recvInto(buf[nFilled:])
+            if nFilled + self.frameBytes > len(buf):
+                yield decodePhaseWords(buf[:nFilled]) if decode else buf[:nFilled]
+                nFilled = 0
+        if nFilled:
+            yield decodePhaseWords(buf[:nFilled]) if decode else buf[:nFilled]
+
+
+def recordPhaseStreams(receivers, paths, duration, chunkFrames=1000):
+    """
+    Writes the packet data of several phase streams to disk as they are received
+
+    Streams are received concurrently (one select loop) into a preallocated buffer each, which is
+    appended to its file every chunkFrames frames, so memory use does not grow with duration.
+
+    INPUTS:
+        receivers - list of PhaseStreamReceivers
+        paths - file to write each receiver's packet data to
+        duration - seconds to record for
+        chunkFrames - number of frames buffered per stream between writes
+    OUTPUTS:
+        list with the number of bytes written for each stream
+    """
+    bufs = [np.empty(chunkFrames * r.frameBytes, dtype=np.uint8) for r in receivers]
+    nFilled = [0] * len(receivers)
+    nWritten = [0] * len(receivers)
+    files = [open(path, 'wb') for path in paths]
+    try:
+        startTime = time.time()
+        while (time.time() - startTime) < duration:
+            try:
+                ready, _, _ = select.select(receivers, [], [], max(duration - (time.time() - startTime), 0))
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for receiver in ready:
+                i = receivers.index(receiver)
+                nFilled[i] += receiver.recvInto(bufs[i][nFilled[i]:])
+                if nFilled[i] + receiver.frameBytes > len(bufs[i]):
+                    bufs[i][:nFilled[i]].tofile(files[i])
+                    nWritten[i] += nFilled[i]
+                    nFilled[i] = 0
+        for i in range(len(receivers)):
+            bufs[i][:nFilled[i]].tofile(files[i])
+            nWritten[i] += nFilled[i]
+    finally:
+        for f in files:
+            f.close()
+    return nWritten
+
+
+def readPhaseFile(path, chunkBytes=None):
+    """
+    Phases from a file written by recordPhaseStreams()
+
+    INPUTS:
+        path - file of phase stream packet data
+        chunkBytes - if given, return a generator over chunks of the decoded stream instead of one array
+    """
+    if chunkBytes is None:
+        return decodePhaseWords(np.fromfile(path, dtype=np.uint8))
+
+    def chunks():
+        decoder = PhaseStreamDecoder(keep=False)
+        with open(path, 'rb') as f:
+            data = f.read(chunkBytes)
+            while data:
+                yield decoder.decode(data)
+                data = f.read(chunkBytes)
+
+    return chunks()
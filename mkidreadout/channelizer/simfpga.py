@@ -0,0 +1,456 @@
+"""
+In-process stand-in for a casperfpga KatcpFpga talking to a ROACH2 running the darkquad firmware.
+
+SimulatedFpga implements the part of the casperfpga interface that Roach2Controls uses (write_int,
+read_int, blindwrite, read, listdev, snapshots[...].arm/read, ...) on top of plain python state so the
+full HighTemplar bring-up can be run, profiled and regression-tested without hardware:
+
+    registers -     dictionary of software registers. Writes are remembered, unknown registers read 0
+    memories -      BRAM/QDR contents as bytearrays, filled by blindwrite()
+    MicroBlaze -    the UART protocol to the V7 is decoded so v7_ready handshakes, LO frequency,
+                    attenuator settings and the DAC LUT dump behave like on the board
+    snapshots -     the IQ accumulator, phase and ADC snapshot blocks return data generated by
+                    SimResonatorModel for the current LO frequency and attenuations
+
+Every katcp request sleeps for a configurable latency (plus an optional per byte transfer time) and is
+counted in callStats, so the cost of a setup sequence on real hardware can be estimated and optimized:
+
+    roach = Roach2Controls('10.0.0.112', simulate={'latency': 0.5e-3})
+    roach.connect()
+    ...
+    print roach.fpga.statsSummary()
+"""
+
+import os
+import time
+
+import numpy as np
+
+from mkidcore.corelog import getLogger
+from mkidcore.readdict import ReadDict
+
+# katcp round trip to a ROACH2 over the control network. write_int() without blindwrite reads the
+# register back, so costs two of these
+DEFAULT_KATCP_LATENCY = 0.5e-3
+# approximate throughput of ?write/?read requests for large memories, bytes/s
+DEFAULT_KATCP_BANDWIDTH = 4.e6
+
+ADC_FULL_SCALE = 2 ** 11
+# the IQ accumulator snapshot is full (and can be read) after this many write enables
+IQ_SNAPSHOT_TRIGGERS = 2
+ADC_SNAPSHOTS = {'adc_in_snp_cal0_ss': (0, 1), 'adc_in_snp_cal1_ss': (2, 3),
+                 'adc_in_snp_cal2_ss': (4, 5), 'adc_in_snp_cal3_ss': (6, 7)}
+
+
+class SimResonatorModel(object):
+    """
+    Synthetic resonator response seen by each firmware channel.
+
+    Every stream:channel gets a resonator whose resonant frequency is offset from its tone (at the
+    reference LO frequency) by a random detuning, so an LO sweep around the reference traces out an IQ
+    loop per channel much like a real power sweep. Channels that were never loaded into the channel
+    selector only return noise.
+    """
+
+    def __init__(self, nStreams=4, nChannelsPerStream=256, detuningSpread=50.e3, qcRange=(2.e4, 5.e4),
+                 qiRange=(3.e4, 2.e5), iqAmplitude=2. ** 14, iqNoise=50., cableDelay=50.e-9, attenRef=40.,
+                 phaseNoise=0.05, pulseRate=500., pulseHeightRange=(0.3, 1.2), pulseDecayTime=30.e-6,
+                 adcRms=0.8, seed=None):
+        """
+        INPUTS:
+            nStreams, nChannelsPerStream - firmware channel layout
+            detuningSpread - rms offset [Hz] of each resonance from its tone at the reference LO
+            qcRange, qiRange - coupling and internal quality factors are drawn uniformly from these ranges
+            iqAmplitude - IQ loop radius (off resonance) in accumulator units at attenRef total attenuation
+            iqNoise - rms noise on each IQ point
+            cableDelay - [s] rotates the loops with LO frequency
+            attenRef - total IF board attenuation [dB] at which the IQ amplitude is iqAmplitude
+            phaseNoise - rms phase noise [radians] in phase snapshots
+            pulseRate - photon rate [counts/s] in phase snapshots
+            pulseHeightRange - photon pulse heights [radians], drawn uniformly
+            pulseDecayTime - [s] exponential decay of photon pulses
+            adcRms - ADC rms, in units of full scale, with 0 dB ADC attenuation
+            seed - random seed, for reproducible runs
+        """
+        self.nStreams = nStreams
+        self.nChannelsPerStream = nChannelsPerStream
+        self.iqAmplitude = iqAmplitude
+        self.iqNoise = iqNoise
+        self.cableDelay = cableDelay
+        self.attenRef = attenRef
+        self.phaseNoise = phaseNoise
+        self.pulseRate = pulseRate
+        self.pulseHeightRange = pulseHeightRange
+        self.pulseDecayTime = pulseDecayTime
+        self.adcRms = adcRms
+        self.rng = np.random.RandomState(seed)
+
+        shape = (nStreams, nChannelsPerStream)
+        self.detuning = self.rng.normal(0, detuningSpread, shape)
+        self.qc = self.rng.uniform(qcRange[0], qcRange[1], shape)
+        self.qi = self.rng.uniform(qiRange[0], qiRange[1], shape)
+        self.qr = 1. / (1. / self.qc + 1. / self.qi)
+        self.rotation = np.exp(1.j * self.rng.uniform(0, 2 * np.pi, shape))
+
+    def iq(self, loOffset, resFreq, totalAtten, loaded):
+        """
+        Complex IQ point of every channel
+
+        INPUTS:
+            loOffset - LO frequency minus the reference LO frequency [Hz]
+            resFreq - approximate resonant frequency [Hz], sets the loop width together with Qr
+            totalAtten - sum of the IF board attenuators [dB]
+            loaded - boolean array [nStreams, nChannelsPerStream] of channels with a tone
+        OUTPUTS:
+            complex array [nStreams, nChannelsPerStream]
+        """
+        x = (loOffset - self.detuning) / resFreq
+        s21 = 1. - (self.qr / self.qc) / (1. + 2.j * self.qr * x)
+        amplitude = self.iqAmplitude * 10 ** (-(totalAtten - self.attenRef) / 20.)
+        iq = amplitude * s21 * self.rotation * np.exp(-2.j * np.pi * loOffset * self.cableDelay)
+        iq = np.where(loaded, iq, 0)
+        noise = self.rng.normal(0, self.iqNoise, (2,) + iq.shape)
+        return iq + noise[0] + 1.j * noise[1]
+
+    def phaseTimestream(self, nSamples, dt):
+        """
+        Phase timestream [radians] with photon pulses
+
+        OUTPUTS:
+            phase - array of nSamples phases
+            trig - boolean array, True at the first sample of each pulse
+        """
+        phase = self.rng.normal(0, self.phaseNoise, nSamples)
+        trig = np.zeros(nSamples, dtype=bool)
+        nPulses = self.rng.poisson(self.pulseRate * nSamples * dt)
+        t = np.arange(nSamples)
+        for start in self.rng.randint(0, nSamples, nPulses):
+            height = self.rng.uniform(*self.pulseHeightRange)
+            pulse = -height * np.exp(-(t[start:] - start) * dt / self.pulseDecayTime)
+            phase[start:] += pulse
+            trig[start] = True
+        return phase, trig
+
+    def adcSamples(self, nSamples, adcAtten):
+        """
+        I and Q ADC samples in ADC units, clipped to the ADC range
+        """
+        rms = self.adcRms * ADC_FULL_SCALE * 10 ** (-adcAtten / 20.)
+        samples = np.round(self.rng.normal(0, rms, (2, nSamples)))
+        return np.clip(samples, -ADC_FULL_SCALE, ADC_FULL_SCALE - 1).astype(np.int16)
+
+
+class SimSnapshot(object):
+    """
+    Snapshot block as seen through casperfpga's fpga.snapshots[name]
+    """
+
+    def __init__(self, fpga, name):
+        self.fpga = fpga
+        self.name = name
+        self.armed = False
+        self.captures = []
+
+    def arm(self, man_trig=False, man_valid=False, **kwargs):
+        self.fpga._request('snapshot_arm', nRequests=2)
+        self.armed = True
+        self.captures = []
+        if man_trig:
+            self.trigger()
+
+    def trigger(self):
+        if self.armed:
+            self.captures.append(self.fpga._snapshotData(self.name))
+
+    def read(self, timeout=5, arm=True, man_trig=False, man_valid=False, **kwargs):
+        if arm:
+            self.arm(man_trig=True)
+        elif self.name in self.fpga.params['iqSnp_regs'] and len(self.captures) < IQ_SNAPSHOT_TRIGGERS:
+            # the block never fills, so on the board the read times out (raised here without the wait)
+            raise RuntimeError('{}: snapshot not full after {} s, {} of {} triggers since arm()'.format(
+                self.name, timeout, len(self.captures), IQ_SNAPSHOT_TRIGGERS))
+        if not self.captures:  # nothing triggered since the last arm, return whatever is in the buffer
+            self.captures.append(self.fpga._snapshotData(self.name))
+        data = self.fpga._formatSnapshot(self.name, self.captures)
+        nBytes = sum(np.asarray(v).size for v in data.values()) * 4
+        self.fpga._request('snapshot_read', nBytes=nBytes, nRequests=3)
+        self.armed = False
+        self.captures = []
+        return {'data': data, 'extra_value': None}
+
+
+class SimSnapshots(object):
+    """
+    The fpga.snapshots container
+    """
+
+    def __init__(self, fpga, names):
+        self._snapshots = dict((name, SimSnapshot(fpga, name)) for name in names)
+
+    def names(self):
+        return list(self._snapshots.keys())
+
+    def __getitem__(self, name):
+        return self._snapshots[name]
+
+    def __contains__(self, name):
+        return name in self._snapshots
+
+    def __iter__(self):
+        return iter(self._snapshots.values())
+
+
+class SimulatedFpga(object):
+    """
+    Drop in replacement for casperfpga.katcp_fpga.KatcpFpga, see the module docstring.
+
+    Useful attributes:
+        registers - dictionary of register values
+        memories - dictionary of bytearrays written with blindwrite()
+        dacLut - bytes of the DAC LUT received by the MicroBlaze in the last loadDacLUT()
+        loFreq - LO frequency [Hz] last set over UART
+        attens - dictionary of attenuator ID -> attenuation [dB]
+        callStats - dictionary of request name -> [number of calls, seconds spent]
+    """
+
+    def __init__(self, params=None, model=None, latency=DEFAULT_KATCP_LATENCY, bandwidth=DEFAULT_KATCP_BANDWIDTH,
+                 firmware='darkquad', ddsLag=76, referenceLO=None, phaseSnapLength=2 ** 14, adcSnapLength=2 ** 11,
+                 host='simulated'):
+        """
+        INPUTS:
+            params - Roach2Controls parameter dictionary (or path to a .param file) naming the registers
+            model - SimResonatorModel, a default one is made if None
+            latency - [s] per katcp request. 0 to run as fast as possible
+            bandwidth - [bytes/s] for memory and snapshot transfers. None for no transfer time
+            firmware - 'darkquad' or 'qdrloop', decides the ADC snapshot trigger register
+            ddsLag - true delay between the dds lut and the fft, found by Roach2Controls.checkDdsShift()
+            referenceLO - [Hz] LO frequency at which the tones sit on their resonators.
+                          If None, the first LO frequency loaded over UART
+            phaseSnapLength - number of samples in a phase snapshot
+            adcSnapLength - number of samples per ADC lane in an ADC snapshot
+        """
+        if params is None or isinstance(params, str):
+            params = ReadDict(file=params or os.path.join(os.path.dirname(__file__), 'darknessfpga.param'))
+        self.params = params
+        self.host = host
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.firmware = firmware
+        self.ddsLag = ddsLag
+        self.referenceLO = referenceLO
+        self.phaseSnapLength = phaseSnapLength
+        self.adcSnapLength = adcSnapLength
+        self._timeout = 3.
+
+        self.nStreams = params['nChannels'] // params['nChannelsPerStream']
+        self.nChannelsPerStream = params['nChannelsPerStream']
+        self.model = model if model is not None else SimResonatorModel(self.nStreams, self.nChannelsPerStream)
+
+        self.registers = {}
+        self.memories = {}
+        self.chanLoaded = np.zeros((self.nStreams, self.nChannelsPerStream), dtype=bool)
+        self.loFreq = referenceLO
+        self.attens = {1: 0., 2: 0., 3: 0., 4: 0.}
+        self.dacLut = b''
+        self._lutMode = False
+        self._uartCmd = None
+        self._uartBytes = []
+        self._v7Ready = 1
+        self.callStats = {}
+
+        trigReg = 'adc_in_trig' if firmware == 'darkquad' else 'trig_qdr'
+        snapNames = list(params['iqSnp_regs']) + [params['phaseSnapshot']] + list(ADC_SNAPSHOTS.keys())
+        self.snapshots = SimSnapshots(self, snapNames)
+        self.registers[trigReg] = 0
+
+    # casperfpga interface
+
+    def is_running(self):
+        self._request('is_running')
+        return True
+
+    def is_connected(self):
+        return True
+
+    def get_system_information(self, *args, **kwargs):
+        self._request('get_system_information', nRequests=4)
+
+    def estimate_fpga_clock(self):
+        self._request('estimate_fpga_clock', nRequests=2)
+        return self.params['fpgaClockRate'] / 1.e6
+
+    def upload_to_ram_and_program(self, *args, **kwargs):
+        self._request('upload_to_ram_and_program')
+        return True
+
+    def listdev(self):
+        self._request('listdev')
+        return sorted(set(self.registers) | set(self.memories) | set(self.snapshots.names()))
+
+    @property
+    def qdrs(self):
+        return []
+
+    def write_int(self, device_name, integer, blindwrite=False, word_offset=0):
+        self._request('write_int', nRequests=1 if blindwrite else 2)
+        old = self.registers.get(device_name, 0)
+        self.registers[device_name] = int(integer)
+        self._registerWritten(device_name, old, int(integer))
+
+    def read_int(self, device_name, word_offset=0):
+        self._request('read_int')
+        if device_name == self.params['v7Ready_reg']:
+            return self._v7Ready
+        if device_name == self.params['lutDumpBusy_reg']:
+            return 0
+        return self.registers.get(device_name, 0)
+
+    def read_uint(self, device_name, word_offset=0):
+        return self.read_int(device_name, word_offset) & 0xffffffff
+
+    def blindwrite(self, device_name, data, offset=0):
+        self._request('blindwrite', nBytes=len(data))
+        mem = self.memories.setdefault(device_name, bytearray())
+        if len(mem) < offset + len(data):
+            mem.extend(b'\x00' * (offset + len(data) - len(mem)))
+        mem[offset:offset + len(data)] = data
+
+    def write(self, device_name, data, offset=0):
+        self.blindwrite(device_name, data, offset)
+        self._request('read', nBytes=len(data))
+
+    def read(self, device_name, size, offset=0):
+        self._request('read', nBytes=size)
+        mem = self.memories.get(device_name, bytearray())
+        chunk = bytes(mem[offset:offset + size])
+        return chunk + b'\x00' * (size - len(chunk))
+
+    # latency model and statistics
+
+    def _request(self, name, nBytes=0, nRequests=1):
+        """
+        Charge the latency of nRequests katcp round trips carrying nBytes of payload
+        """
+        cost = nRequests * self.latency
+        if self.bandwidth:
+            cost += float(nBytes) / self.bandwidth
+        if cost > 0:
+            time.sleep(cost)
+        stats = self.callStats.setdefault(name, [0, 0.])
+        stats[0] += nRequests
+        stats[1] += cost
+
+    def resetStats(self):
+        self.callStats = {}
+
+    def statsSummary(self):
+        """
+        Table of katcp requests and the time spent in them, most expensive first
+        """
+        lines = ['{:<26} {:>9} {:>10}'.format('request', 'calls', 'seconds')]
+        for name, (nCalls, seconds) in sorted(self.callStats.items(), key=lambda x: -x[1][1]):
+            lines.append('{:<26} {:>9} {:>10.3f}'.format(name, nCalls, seconds))
+        lines.append('{:<26} {:>9} {:>10.3f}'.format('total', sum(s[0] for s in self.callStats.values()),
+                                                     sum(s[1] for s in self.callStats.values())))
+        return '\n'.join(lines)
+
+    # firmware behaviour
+
+    def _registerWritten(self, name, old, new):
+        params = self.params
+        rising = new and not old
+        if name == params['chanSelLoad_reg'] and new & 1:
+            ch = (new >> 1) & 0xff
+            for stream in range(self.nStreams):
+                self.chanLoaded[stream, ch] = self.registers.get(params['chanSel_regs'][stream], 0) != 0
+        elif name == params['checkLag_reg'] and rising:
+            dataCh = 17
+            ddsShift = self.registers.get(params['ddsShift_reg'], 0)
+            self.registers[params['lagData_reg']] = dataCh
+            self.registers[params['lagDds_reg']] = (dataCh + self.ddsLag - ddsShift - 1) % self.nChannelsPerStream
+        elif name == params['iqSnpStart_reg'] and rising:
+            for snpName in params['iqSnp_regs']:
+                self.snapshots[snpName].trigger()
+        elif name == params['phaseSnpTrig_reg'] and rising:
+            self.snapshots[params['phaseSnapshot']].trigger()
+        elif name in ('adc_in_trig', 'trig_qdr') and rising:
+            for snpName in ADC_SNAPSHOTS:
+                self.snapshots[snpName].trigger()
+        elif name == params['resetUART_reg'] and rising:
+            self._uartCmd = None
+            self._uartBytes = []
+            self._lutMode = False
+            self._v7Ready = 1
+        elif name == params['enBRAMDump_reg'] and not new and old:
+            self._lutMode = False
+            self._v7Ready = 1
+        elif name == params['txEnUART_reg'] and rising:
+            self._uartByte(self.registers.get(params['inByteUART_reg'], 0) & 0xff)
+
+    def _uartByte(self, byte):
+        """
+        MicroBlaze side of the UART protocol used by Roach2Controls
+        """
+        params = self.params
+        if self._lutMode:
+            lutBuf = self.memories.get(params['lutBramAddr_reg'], bytearray())
+            self.dacLut += bytes(lutBuf[:self.registers.get(params['lutBufferSize_reg'], 0)])
+            self._v7Ready = params['v7LUTReady']
+            return
+
+        self._v7Ready = 1
+        if self._uartCmd is not None:
+            self._uartBytes.append(byte)
+            if self._uartCmd == params['mbRecvLO'] and len(self._uartBytes) == 4:
+                b = self._uartBytes
+                self.loFreq = ((b[0] + (b[1] << 8)) + (b[2] + (b[3] << 8)) / 2. ** 16) * 1.e6
+                if self.referenceLO is None:
+                    self.referenceLO = self.loFreq
+                getLogger(__name__).debug('{}: LO set to {} Hz'.format(self.host, self.loFreq))
+                self._uartCmd = None
+            elif self._uartCmd == params['mbChangeAtten'] and len(self._uartBytes) == 2:
+                self.attens[self._uartBytes[0]] = self._uartBytes[1] / 4.
+                self._uartCmd = None
+        elif byte in (params['mbRecvLO'], params['mbChangeAtten']):
+            self._uartCmd = byte
+            self._uartBytes = []
+        elif byte == params['mbRecvDACLUT']:
+            self._lutMode = True
+            self.dacLut = b''
+            self._v7Ready = params['v7LUTReady']
+
+    def _snapshotData(self, name):
+        """
+        One trigger worth of data for snapshot block name
+        """
+        params = self.params
+        if name in params['iqSnp_regs']:
+            stream = list(params['iqSnp_regs']).index(name)
+            loFreq = self.loFreq if self.loFreq is not None else 0.
+            refLO = self.referenceLO if self.referenceLO is not None else loFreq
+            iq = self.model.iq(loFreq - refLO, max(refLO, 1.e9), sum(self.attens.values()), self.chanLoaded)[stream]
+            return np.round(np.concatenate((iq.real, iq.imag)))
+        if name == params['phaseSnapshot']:
+            dt = float(params['nChannelsPerStream']) / params['fpgaClockRate']
+            phase, trig = self.model.phaseTimestream(self.phaseSnapLength, dt)
+            return {'phase': phase, 'trig': np.roll(trig, 2)}  # firmware delays we_out by 2 cycles
+        i, q = self.model.adcSamples(2 * self.adcSnapLength, self.attens[3] + self.attens[4])
+        lanes = ADC_SNAPSHOTS[name]
+        data = {}
+        for n, lane in enumerate(lanes):
+            data['data_i{}'.format(lane)] = i[n::2]
+            data['data_q{}'.format(lane)] = q[n::2]
+        return data
+
+    def _formatSnapshot(self, name, captures):
+        """
+        Assemble the captures since the last arm() into what snapshot.read()['data'] returns
+        """
+        if name in self.params['iqSnp_regs']:
+            # the accumulator snapshot holds two triggers of nChannelsPerStream I then Q values
+            nPerCapture = 2 * self.nChannelsPerStream
+            iq = np.zeros(IQ_SNAPSHOT_TRIGGERS * nPerCapture)
+            for n, capture in enumerate(captures[:IQ_SNAPSHOT_TRIGGERS]):
+                iq[n * nPerCapture:(n + 1) * nPerCapture] = capture
+            return {'iq': iq}
+        return dict(captures[0])
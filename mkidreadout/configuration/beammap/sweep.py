@@ -57,13 +57,21 @@ import mkidreadout.config
 from mkidreadout.configuration.beammap import aligngrid as bmap_align
 from mkidreadout.configuration.beammap import clean as bmap_clean
 import mkidreadout.configuration.beammap.utils as bmu
+from mkidreadout.readout.binfile import BinIndex, findBin, readBin
 from mkidreadout.configuration.beammap.flags import timestream_flags
 
 
+def _parseBin(binfile):
+    """ Photons in binfile, compressed (.binz) files are read with mkidreadout.readout.binfile """
+    binfile = findBin(binfile)
+    if binfile.endswith('.binz'):
+        return readBin(binfile, useIndex=False)
+    return parse(binfile)
+
 def bin2imgs((binfile, nrows, ncols)):
     """ Grab both intensity and phase maps from bin data """
     log.info("Making intensity and phase maps for {}".format(binfile))
-    photons = parse(binfile)
+    photons = _parseBin(binfile)
 
     intensitymap = np.zeros((nrows, ncols))
     phasemap = np.zeros((nrows, ncols))
@@ -75,9 +83,17 @@ def bin2imgs((binfile, nrows, ncols)):
     return intensitymap, phasemap
 
 def bin2img((binfile, nrows, ncols)):
-    """ Grab intensity maps from bin data """
+    """ Grab intensity maps from bin data, straight from the .bin index if there is one """
+    try:
+        index = BinIndex(binfile)
+        if index.matchesFile() and (index.nRows, index.nCols) == (nrows, ncols):
+            log.info("Using index intensity map for {}".format(binfile))
+            return index.counts.astype(float)
+    except IOError:
+        pass
+
     log.info("Making intensity map for {}. discarding phase info".format(binfile))
-    photons = parse(binfile)
+    photons = _parseBin(binfile)
 
     intensitymap = np.histogram2d(photons['y'], photons['x'], bins=[range(nrows + 1), range(ncols + 1)])[0]
 
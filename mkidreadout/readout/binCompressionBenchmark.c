@@ -0,0 +1,244 @@
+/*
+ * File:      binCompressionBenchmark.c
+ *
+ * Compression ratio and throughput of the .binz block compression (compressBinBlock) on a
+ * recorded .bin file, for several zlib levels with and without the word shuffle, on one
+ * and on nThreads threads. Every block is decompressed and checked against the original.
+ * Without a file (or with -) a synthetic second of data from a 10 roach array is used.
+ *
+ * Compile with
+ * gcc -O2 -std=gnu11 binCompressionBenchmark.c pmthreads.c mkidshm/mkidshm.c -Imkidshm -o binCompressionBenchmark -lrt -lpthread -lm -lz
+ *
+ * Usage: ./binCompressionBenchmark [binfile] [blockMB] [nThreads]
+ */
+#include "pmthreads.h"
+
+#define BENCH_NROACH 10
+#define BENCH_PHOTONS_PER_PACKET 100
+#define BENCH_PACKETS_PER_ROACH 2500
+#define BENCH_MAX_THREADS 64
+
+typedef struct{
+    BIN_WRITE_BLOCK *blocks;
+    int nBlocks;
+    int level;
+    int shuffle;
+    int firstBlock;
+    int step;
+
+} BENCH_JOB;
+
+static void compressUnshuffled(BIN_WRITE_BLOCK *block, int level){
+    BINZ_FRAME_HEADER *frame = (BINZ_FRAME_HEADER*)block->compData;
+    uLongf compBytes = compressBound(block->nBytes);
+
+    compress2(block->compData + sizeof(BINZ_FRAME_HEADER), &compBytes, block->data, block->nBytes, level);
+    frame->rawBytes = block->nBytes;
+    frame->compBytes = compBytes;
+    frame->flags = 0;
+    block->compBytes = sizeof(BINZ_FRAME_HEADER) + compBytes;
+
+}
+
+static void *compressJob(void *prms){
+    BENCH_JOB *job = (BENCH_JOB*)prms;
+    uint8_t *shuffleBuf = (uint8_t*)malloc(job->blocks[0].nBytes);
+    int i;
+
+    for(i=job->firstBlock; i<job->nBlocks; i+=job->step){
+        if(job->shuffle)
+            compressBinBlock(job->blocks + i, shuffleBuf, job->level);
+        else
+            compressUnshuffled(job->blocks + i, job->level);
+
+    }
+    free(shuffleBuf);
+    return NULL;
+
+}
+
+// Decompresses every block and compares it with the original, returns the number that differ
+static int checkBlocks(BIN_WRITE_BLOCK *blocks, int nBlocks, uint64_t blockSize){
+    uint8_t *raw = (uint8_t*)malloc(blockSize);
+    uint8_t *words = (uint8_t*)malloc(blockSize);
+    BINZ_FRAME_HEADER *frame;
+    uLongf rawBytes;
+    uint64_t j, k, nWords;
+    int i, nBad = 0;
+
+    for(i=0; i<nBlocks; i++){
+        frame = (BINZ_FRAME_HEADER*)blocks[i].compData;
+        if(frame->flags & BINZ_FRAME_STORED){
+            if(memcmp(blocks[i].compData + sizeof(BINZ_FRAME_HEADER), blocks[i].data, blocks[i].nBytes) != 0)
+                nBad++;
+            continue;
+
+        }
+        rawBytes = blockSize;
+        if(uncompress(raw, &rawBytes, blocks[i].compData + sizeof(BINZ_FRAME_HEADER), frame->compBytes) != Z_OK
+                || rawBytes != blocks[i].nBytes){
+            nBad++;
+            continue;
+
+        }
+        if(frame->flags & BINZ_FRAME_SHUFFLED){
+            nWords = rawBytes/8;
+            for(j=0; j<8; j++)
+                for(k=0; k<nWords; k++)
+                    words[8*k + j] = raw[j*nWords + k];
+            memcpy(words + 8*nWords, raw + 8*nWords, rawBytes - 8*nWords);
+            memcpy(raw, words, rawBytes);
+
+        }
+        if(memcmp(raw, blocks[i].data, rawBytes) != 0)
+            nBad++;
+
+    }
+    free(words);
+    free(raw);
+    return nBad;
+
+}
+
+static double runBench(BIN_WRITE_BLOCK *blocks, int nBlocks, int level, int shuffle, int nThreads,
+        uint64_t *compBytes){
+    pthread_t threads[BENCH_MAX_THREADS];
+    BENCH_JOB jobs[BENCH_MAX_THREADS];
+    struct timespec startSpec, stopSpec;
+    int i;
+
+    clock_gettime(CLOCK_MONOTONIC, &startSpec);
+    for(i=0; i<nThreads; i++){
+        jobs[i].blocks = blocks;
+        jobs[i].nBlocks = nBlocks;
+        jobs[i].level = level;
+        jobs[i].shuffle = shuffle;
+        jobs[i].firstBlock = i;
+        jobs[i].step = nThreads;
+        pthread_create(threads + i, NULL, compressJob, jobs + i);
+
+    }
+    for(i=0; i<nThreads; i++)
+        pthread_join(threads[i], NULL);
+    clock_gettime(CLOCK_MONOTONIC, &stopSpec);
+
+    *compBytes = 0;
+    for(i=0; i<nBlocks; i++)
+        *compBytes += blocks[i].compBytes;
+    return (stopSpec.tv_sec - startSpec.tv_sec) + (stopSpec.tv_nsec - startSpec.tv_nsec)/1.e9;
+
+}
+
+// One second of packets from nRoach roaches, headers every 0.5 ms, random pixels and phases
+static char *makeSyntheticBin(uint64_t *nBytes){
+    int packSize = 8*(BENCH_PHOTONS_PER_PACKET + 1);
+    uint64_t word, nPackets = BENCH_NROACH*BENCH_PACKETS_PER_ROACH;
+    char *data = (char*)malloc(nPackets*packSize);
+    uint64_t *out = (uint64_t*)data;
+    STREAM_HEADER *header = (STREAM_HEADER*)&word;
+    PHOTON_WORD *photon = (PHOTON_WORD*)&word;
+    int i, j, roach;
+
+    srand(1);
+    for(i=0; i<BENCH_PACKETS_PER_ROACH; i++){
+        for(roach=0; roach<BENCH_NROACH; roach++){
+            word = 0;
+            header->start = 0xff;
+            header->roach = roach;
+            header->frame = i%4096;
+            header->timestamp = 2000*(uint64_t)13699200 + i/5; //June 8 2019 UTC, in 2019 ticks
+            *out++ = __bswap_64(word);
+            for(j=0; j<BENCH_PHOTONS_PER_PACKET; j++){
+                word = 0;
+                photon->xcoord = 14*(roach/2) + rand()%14;
+                photon->ycoord = 73*(roach%2) + rand()%73;
+                photon->timestamp = (j*500/BENCH_PHOTONS_PER_PACKET + rand()%5)%500;
+                photon->phase = -(int)((40 + 100.*rand()/RAND_MAX)/RAD_TO_DEG*PHASE_BIN_PT);
+                photon->baseline = -(int)((5.*rand()/RAND_MAX)/RAD_TO_DEG*PHASE_BIN_PT);
+                *out++ = __bswap_64(word);
+
+            }
+
+        }
+
+    }
+    *nBytes = nPackets*packSize;
+    return data;
+
+}
+
+static char *readBinFile(char *path, uint64_t *nBytes){
+    FILE *f = fopen(path, "rb");
+    char *data;
+
+    if(f == NULL)
+        return NULL;
+    fseek(f, 0, SEEK_END);
+    *nBytes = ftell(f);
+    fseek(f, 0, SEEK_SET);
+    data = (char*)malloc(*nBytes);
+    if(fread(data, 1, *nBytes, f) != *nBytes){
+        free(data);
+        data = NULL;
+
+    }
+    fclose(f);
+    return data;
+
+}
+
+int main(int argc, char **argv){
+    char *path = argc > 1 && strcmp(argv[1], "-") != 0 ? argv[1] : NULL;
+    uint64_t blockSize = (uint64_t)(argc > 2 ? atof(argv[2]) : 8)*1024*1024;
+    int nThreads = argc > 3 ? atoi(argv[3]) : 4;
+    int levels[] = {1, 3, 6, 9};
+    int nLevels = sizeof(levels)/sizeof(levels[0]);
+    int i, l, shuffle, threads, nBlocks, nBad = 0;
+    uint64_t nBytes, compBytes;
+    double t, t1;
+    char *data;
+    BIN_WRITE_BLOCK *blocks;
+
+    if(nThreads > BENCH_MAX_THREADS)
+        nThreads = BENCH_MAX_THREADS;
+    data = path != NULL ? readBinFile(path, &nBytes) : makeSyntheticBin(&nBytes);
+    if(data == NULL || nBytes == 0){
+        printf("Error reading %s\n", path);
+        return 1;
+
+    }
+
+    nBlocks = (nBytes + blockSize - 1)/blockSize;
+    blocks = (BIN_WRITE_BLOCK*)calloc(nBlocks, sizeof(BIN_WRITE_BLOCK));
+    for(i=0; i<nBlocks; i++){
+        blocks[i].data = (uint8_t*)data + i*blockSize;
+        blocks[i].nBytes = i < nBlocks - 1 ? blockSize : nBytes - i*blockSize;
+        blocks[i].compData = (uint8_t*)malloc(sizeof(BINZ_FRAME_HEADER) + compressBound(blockSize));
+
+    }
+
+    printf("%s: %.1f MB in %d blocks of %.1f MB\n", path != NULL ? path : "synthetic", nBytes/1.e6,
+            nBlocks, blockSize/1.e6);
+    printf("level shuffle    ratio   1 thread MB/s   %2d threads MB/s\n", nThreads);
+    for(l=0; l<nLevels; l++){
+        for(shuffle=0; shuffle<2; shuffle++){
+            t1 = runBench(blocks, nBlocks, levels[l], shuffle, 1, &compBytes);
+            nBad += checkBlocks(blocks, nBlocks, blockSize);
+            threads = nThreads < nBlocks ? nThreads : nBlocks;
+            t = runBench(blocks, nBlocks, levels[l], shuffle, threads, &compBytes);
+            nBad += checkBlocks(blocks, nBlocks, blockSize);
+            printf("%5d %7s %8.2f %15.1f %17.1f\n", levels[l], shuffle ? "yes" : "no",
+                    (double)nBytes/compBytes, nBytes/t1/1.e6, nBytes/t/1.e6);
+
+        }
+
+    }
+    printf("blocks failing the round trip: %d\n", nBad);
+
+    for(i=0; i<nBlocks; i++)
+        free(blocks[i].compData);
+    free(blocks);
+    free(data);
+    return nBad != 0;
+
+}
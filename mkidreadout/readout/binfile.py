@@ -0,0 +1,446 @@
+"""
+Reads the 1 second .bin files written by packetmaster's binWriter.
+
+Alongside each <ts>.bin the writer saves a <ts>.idx sidecar (BIN_INDEX in pmthreads.h)
+holding per pixel photon counts, the roach each pixel's photons came from, and the
+offset of every run of packets from one roach with the same header timestamp. readBin
+and readBins use it to read only the parts of a file covering a time range or set of
+pixels; files without an index are parsed in full.
+
+If the writer compresses its output the files are <ts>.binz instead (BINZ_FILE_HEADER in
+pmthreads.h): independently deflated frames of up to blockSize raw bytes. BinzFile decodes
+them as a stream or frame by frame for a byte range, and everything here that takes a .bin
+path accepts the matching .binz.
+
+Photon times are microseconds since the Unix epoch. Packet header timestamps count 0.5 ms
+ticks from the start of the UTC year (see tsOffset), which for a file is taken to be the
+year of the second in its name. Phase and baseline are in degrees.
+"""
+from __future__ import division
+
+import calendar
+import os
+import time
+import zlib
+
+import numpy as np
+
+from mkidcore.corelog import getLogger
+
+TICKS_PER_SEC = 2000
+RAD_TO_DEG = 57.2957795131
+PHASE_BIN_PT = 32768.
+
+BIN_INDEX_MAGIC = 0x49424b4d
+BIN_INDEX_VERSION = 1
+NO_ROACH = 0xff
+
+BINZ_MAGIC = 0x5a424b4d
+BINZ_VERSION = 1
+BINZ_CODEC_ZLIB = 1
+BINZ_FRAME_STORED = 1
+BINZ_FRAME_SHUFFLED = 2
+
+INDEX_HEADER_DTYPE = np.dtype([('magic', '<u4'), ('version', '<u4'), ('nRows', '<u4'), ('nCols', '<u4'),
+                               ('nEntries', '<u8'), ('fileBytes', '<u8'), ('nPhotons', '<u8'),
+                               ('firstTimestamp', '<u8'), ('lastTimestamp', '<u8'), ('reserved', '<u8')])
+INDEX_ENTRY_DTYPE = np.dtype([('offset', '<u8'), ('timestamp', '<u8'), ('nBytes', '<u4'),
+                              ('nPhotons', '<u4'), ('roach', '<u4'), ('reserved', '<u4')])
+PHOTON_DTYPE = np.dtype([('time', '<u8'), ('x', '<u2'), ('y', '<u2'), ('phase', '<f4'),
+                         ('baseline', '<f4'), ('roach', 'u1')])
+BINZ_FILE_HEADER_DTYPE = np.dtype([('magic', '<u4'), ('version', '<u4'), ('codec', '<u4'), ('blockSize', '<u4')])
+BINZ_FRAME_HEADER_DTYPE = np.dtype([('rawBytes', '<u4'), ('compBytes', '<u4'), ('flags', '<u4'),
+                                    ('reserved', '<u4')])
+
+_U = np.uint64
+
+
+def tsOffset(unixTime=None):
+    """
+    Unix time of the start of the UTC year containing unixTime (default now). Packet header
+    timestamps, and shared image start times, count from here.
+    """
+    year = time.gmtime(unixTime).tm_year
+    return calendar.timegm((year, 1, 1, 0, 0, 0))
+
+
+def fileTsOffset(binfile):
+    """ tsOffset for the photons in binfile, from the Unix second it is named for """
+    try:
+        return tsOffset(int(os.path.splitext(os.path.basename(binfile))[0]))
+    except ValueError:
+        return tsOffset()
+
+
+def indexFile(binfile):
+    """ Path of the sidecar index for binfile """
+    return os.path.splitext(binfile)[0] + '.idx'
+
+
+def findBin(binfile):
+    """ Returns binfile, or the compressed (or uncompressed) version of it if binfile doesn't exist """
+    if os.path.exists(binfile):
+        return binfile
+    root, ext = os.path.splitext(binfile)
+    other = root + ('.bin' if ext == '.binz' else '.binz')
+    return other if os.path.exists(other) else binfile
+
+
+def unshuffleWords(data):
+    """ Inverse of shuffleWords in pmthreads.c """
+    nWords = len(data)//8
+    shuffled = np.frombuffer(data, dtype=np.uint8)
+    words = shuffled[:8*nWords].reshape(8, nWords).T.tobytes()
+    return words + shuffled[8*nWords:].tobytes()
+
+
+class BinzFile(object):
+    """
+    Decoder for compressed <ts>.binz files. Reads the frame table on open; frames are only
+    decompressed when their bytes are requested.
+
+    Usage:
+        with BinzFile(path) as f:
+            for block in f:  # decoded bytes, frame by frame
+                ...
+            data = f.read(start, stop)  # raw .bin bytes [start, stop)
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        header = np.frombuffer(self._file.read(BINZ_FILE_HEADER_DTYPE.itemsize), BINZ_FILE_HEADER_DTYPE)
+        if len(header) != 1 or header[0]['magic'] != BINZ_MAGIC or header[0]['version'] != BINZ_VERSION:
+            self._file.close()
+            raise IOError('{} is not a version {} .binz file'.format(path, BINZ_VERSION))
+        if header[0]['codec'] != BINZ_CODEC_ZLIB:
+            self._file.close()
+            raise IOError('{} uses unknown codec {}'.format(path, header[0]['codec']))
+        self.blockSize = int(header[0]['blockSize'])
+
+        # frame table: where each frame's data starts in the file and in the raw stream
+        frames = []
+        fileOffset = BINZ_FILE_HEADER_DTYPE.itemsize
+        rawOffset = 0
+        fileSize = os.path.getsize(path)
+        while fileOffset + BINZ_FRAME_HEADER_DTYPE.itemsize <= fileSize:
+            self._file.seek(fileOffset)
+            frame = np.frombuffer(self._file.read(BINZ_FRAME_HEADER_DTYPE.itemsize), BINZ_FRAME_HEADER_DTYPE)[0]
+            fileOffset += BINZ_FRAME_HEADER_DTYPE.itemsize
+            if fileOffset + frame['compBytes'] > fileSize:
+                getLogger(__name__).warning('{} is truncated'.format(path))
+                break
+            frames.append((fileOffset, rawOffset, frame['rawBytes'], frame['compBytes'], frame['flags']))
+            fileOffset += int(frame['compBytes'])
+            rawOffset += int(frame['rawBytes'])
+        self.frames = np.array(frames, dtype=[('fileOffset', '<u8'), ('rawOffset', '<u8'), ('rawBytes', '<u8'),
+                                              ('compBytes', '<u8'), ('flags', '<u4')])
+        self.rawBytes = rawOffset
+        self._cached = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def frame(self, i):
+        """ Decoded bytes of frame i """
+        if self._cached[0] == i:
+            return self._cached[1]
+        frame = self.frames[i]
+        self._file.seek(int(frame['fileOffset']))
+        data = self._file.read(int(frame['compBytes']))
+        if not frame['flags'] & BINZ_FRAME_STORED:
+            data = zlib.decompress(data)
+            if frame['flags'] & BINZ_FRAME_SHUFFLED:
+                data = unshuffleWords(data)
+        if len(data) != frame['rawBytes']:
+            raise IOError('Frame {} of {} is corrupt'.format(i, self.path))
+        self._cached = (i, data)
+        return data
+
+    def __iter__(self):
+        for i in range(len(self.frames)):
+            yield self.frame(i)
+
+    def read(self, start=0, stop=None):
+        """ Raw .bin bytes [start, stop), decoding only the frames they span """
+        stop = self.rawBytes if stop is None else min(stop, self.rawBytes)
+        if start >= stop:
+            return b''
+        ends = self.frames['rawOffset'] + self.frames['rawBytes']
+        first = np.searchsorted(ends, start, side='right')
+        last = np.searchsorted(self.frames['rawOffset'], stop, side='left')
+        data = b''.join(self.frame(i) for i in range(first, last))
+        offset = start - int(self.frames['rawOffset'][first])
+        return data[offset:offset + stop - start]
+
+
+class _PlainBin(object):
+    """ Same interface as BinzFile for uncompressed .bin files """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.rawBytes = os.path.getsize(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def read(self, start=0, stop=None):
+        self._file.seek(start)
+        return self._file.read(-1 if stop is None else stop - start)
+
+
+def openBin(binfile):
+    """ Opens a .bin or .binz file (see findBin) for reading raw .bin bytes """
+    binfile = findBin(binfile)
+    return BinzFile(binfile) if binfile.endswith('.binz') else _PlainBin(binfile)
+
+
+def decompressBin(binzfile, binfile=None):
+    """ Writes the raw .bin for a .binz file, one frame at a time. Returns the .bin path """
+    if binfile is None:
+        binfile = os.path.splitext(binzfile)[0] + '.bin'
+    with BinzFile(binzfile) as src, open(binfile, 'wb') as dest:
+        for block in src:
+            dest.write(block)
+    return binfile
+
+
+def _signed(raw, nBits):
+    raw = raw.astype(np.int64)
+    raw[raw >= 2**(nBits-1)] -= 2**nBits
+    return raw
+
+
+def parseWords(data, tsOffs=None):
+    """
+    Parses raw .bin data into a PHOTON_DTYPE array.
+
+    Parameters
+    ----------
+        data: str/bytes or buffer
+            Packet data, starting at a packet header. Photons before the first header and
+            any trailing partial word are dropped.
+        tsOffs: int
+            Unix time the header timestamps count from, tsOffset() if None. See fileTsOffset.
+    """
+    if tsOffs is None:
+        tsOffs = tsOffset()
+    words = np.frombuffer(data, dtype='>u8', count=len(data)//8).astype(np.uint64)
+    isHeader = (words >> _U(56)) == _U(0xff)
+    hdrInd = np.cumsum(isHeader) - 1
+    keep = ~isHeader & (hdrInd >= 0)
+    headers = words[isHeader]
+    photons = words[keep]
+    hdrInd = hdrInd[keep]
+
+    hdrTs = headers & _U((1 << 36) - 1)
+    hdrRoach = (headers >> _U(48)) & _U(0xff)
+
+    parsed = np.empty(len(photons), dtype=PHOTON_DTYPE)
+    parsed['time'] = _U(500)*(_U(TICKS_PER_SEC*tsOffs) + hdrTs[hdrInd]) + ((photons >> _U(35)) & _U(0x1ff))
+    parsed['x'] = photons >> _U(54)
+    parsed['y'] = (photons >> _U(44)) & _U(0x3ff)
+    parsed['phase'] = _signed((photons >> _U(17)) & _U(0x3ffff), 18)*RAD_TO_DEG/PHASE_BIN_PT
+    parsed['baseline'] = _signed(photons & _U(0x1ffff), 17)*RAD_TO_DEG/PHASE_BIN_PT
+    parsed['roach'] = hdrRoach[hdrInd]
+    return parsed
+
+
+class BinIndex(object):
+    """
+    Sidecar index of a .bin file.
+
+    Attributes
+    ----------
+        counts: (nRows, nCols) array of photons per pixel, i.e. the file's intensity image
+        pixelRoach: (nRows, nCols) array of the roach that sent each pixel's photons, NO_ROACH
+            for pixels without photons
+        entries: INDEX_ENTRY_DTYPE array of packet runs in file order
+    """
+    def __init__(self, binfile):
+        self.binfile = binfile
+        self.indexfile = indexFile(binfile)
+        self.tsOffs = fileTsOffset(binfile)
+        with open(self.indexfile, 'rb') as f:
+            raw = f.read()
+
+        if len(raw) < INDEX_HEADER_DTYPE.itemsize:
+            raise IOError('{} is not a .bin index'.format(self.indexfile))
+        self.header = np.frombuffer(raw, INDEX_HEADER_DTYPE, count=1)[0]
+        if self.header['magic'] != BIN_INDEX_MAGIC or self.header['version'] != BIN_INDEX_VERSION:
+            raise IOError('{} is not a version {} .bin index'.format(self.indexfile, BIN_INDEX_VERSION))
+
+        nPix = self.nRows*self.nCols
+        offset = INDEX_HEADER_DTYPE.itemsize
+        self.counts = np.frombuffer(raw, '<u4', nPix, offset).reshape(self.nRows, self.nCols)
+        offset += 4*nPix
+        self.pixelRoach = np.frombuffer(raw, 'u1', nPix, offset).reshape(self.nRows, self.nCols)
+        offset += nPix + (-nPix) % 8
+        self.entries = np.frombuffer(raw, INDEX_ENTRY_DTYPE, int(self.header['nEntries']), offset)
+
+    @property
+    def nRows(self):
+        return int(self.header['nRows'])
+
+    @property
+    def nCols(self):
+        return int(self.header['nCols'])
+
+    @property
+    def nPhotons(self):
+        return int(self.header['nPhotons'])
+
+    @property
+    def fileBytes(self):
+        return int(self.header['fileBytes'])
+
+    @property
+    def startTime(self):
+        """ Unix time of the first packet header """
+        return self.tsOffs + self.header['firstTimestamp']/TICKS_PER_SEC
+
+    @property
+    def stopTime(self):
+        """ Unix time of the end of the last packet header's 0.5 ms frame """
+        return self.tsOffs + (self.header['lastTimestamp'] + 1)/TICKS_PER_SEC
+
+    def matchesFile(self):
+        """ False if the .bin file changed since the index was written """
+        with openBin(self.binfile) as f:
+            return f.rawBytes == self.fileBytes
+
+    def select(self, startTime=None, stopTime=None, pixelMask=None):
+        """
+        Returns the entries that may hold photons in [startTime, stopTime) (Unix seconds) from
+        the pixels in pixelMask ((nRows, nCols) bool array).
+        """
+        keep = np.ones(len(self.entries), dtype=bool)
+        ticks = self.entries['timestamp'].astype(np.float64)
+        if startTime is not None:
+            keep &= ticks + 1 > (startTime - self.tsOffs)*TICKS_PER_SEC
+        if stopTime is not None:
+            keep &= ticks < (stopTime - self.tsOffs)*TICKS_PER_SEC
+        if pixelMask is not None:
+            roaches = np.unique(self.pixelRoach[pixelMask & (self.counts > 0)])
+            keep &= np.isin(self.entries['roach'], roaches[roaches != NO_ROACH])
+        return self.entries[keep]
+
+
+def _pixelMask(pixels, nRows, nCols):
+    pixels = np.asarray(pixels)
+    if pixels.dtype == bool:
+        if pixels.shape != (nRows, nCols):
+            raise ValueError('pixel mask must have shape {}'.format((nRows, nCols)))
+        return pixels
+    mask = np.zeros((nRows, nCols), dtype=bool)
+    xy = pixels.reshape(-1, 2)
+    inside = (xy[:, 0] >= 0) & (xy[:, 0] < nCols) & (xy[:, 1] >= 0) & (xy[:, 1] < nRows)
+    mask[xy[inside, 1], xy[inside, 0]] = True
+    return mask
+
+
+def _readEntries(binfile, entries):
+    """ Parses the packet runs in entries, reading adjacent runs in one go """
+    if len(entries) == 0:
+        return np.empty(0, dtype=PHOTON_DTYPE)
+    starts = entries['offset']
+    ends = starts + entries['nBytes']
+    breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+    rangeStarts = starts[np.concatenate(([0], breaks))]
+    rangeEnds = ends[np.concatenate((breaks - 1, [len(entries) - 1]))]
+
+    parsed = []
+    with openBin(binfile) as f:
+        for start, end in zip(rangeStarts, rangeEnds):
+            parsed.append(parseWords(f.read(int(start), int(end)), fileTsOffset(binfile)))
+    return np.concatenate(parsed)
+
+
+def readBin(binfile, startTime=None, stopTime=None, pixels=None, useIndex=True):
+    """
+    Loads photons from a .bin file, optionally restricted to a time range and set of pixels.
+
+    Parameters
+    ----------
+        binfile: string
+            Path to a <ts>.bin or <ts>.binz file
+        startTime, stopTime: float
+            Unix times, only photons in [startTime, stopTime) are returned. Either may be None.
+        pixels: (N, 2) array of (x, y) pixel coordinates, or an (nRows, nCols) bool mask.
+            Only photons from these pixels are returned. A mask is required to select
+            pixels from a file without an index.
+        useIndex: bool
+            Use the file's sidecar index, if present, to read only the packets that may
+            hold the requested photons.
+
+    Returns
+    -------
+        PHOTON_DTYPE array in file order
+    """
+    binfile = findBin(binfile)
+    index = None
+    if useIndex:
+        try:
+            index = BinIndex(binfile)
+            if not index.matchesFile():
+                getLogger(__name__).warning('{} does not match {}, ignoring it'.format(index.indexfile, binfile))
+                index = None
+        except IOError:
+            pass
+
+    pixelMask = None
+    if pixels is not None:
+        if index is not None:
+            pixelMask = _pixelMask(pixels, index.nRows, index.nCols)
+        elif np.asarray(pixels).dtype == bool:
+            pixelMask = np.asarray(pixels)
+        else:
+            raise ValueError('pixels must be a mask when {} has no index'.format(binfile))
+
+    if index is None:
+        with openBin(binfile) as f:
+            photons = parseWords(f.read(), fileTsOffset(binfile))
+    else:
+        photons = _readEntries(binfile, index.select(startTime, stopTime, pixelMask))
+
+    keep = np.ones(len(photons), dtype=bool)
+    if startTime is not None:
+        keep &= photons['time'] >= np.uint64(round(startTime*1e6))
+    if stopTime is not None:
+        keep &= photons['time'] < np.uint64(round(stopTime*1e6))
+    if pixelMask is not None:
+        inside = (photons['x'] < pixelMask.shape[1]) & (photons['y'] < pixelMask.shape[0])
+        keep &= inside
+        keep[inside] &= pixelMask[photons['y'][inside], photons['x'][inside]]
+    return photons if keep.all() else photons[keep]
+
+
+def readBins(binDir, startTime, stopTime, pixels=None, useIndex=True):
+    """
+    Loads photons in [startTime, stopTime) (Unix seconds) from the .bin/.binz files in binDir.
+
+    Files are named for the second the writer opened them, so a photon can land in the
+    file after the one matching its timestamp; both are checked. See readBin for pixels.
+    Returns a PHOTON_DTYPE array sorted by time.
+    """
+    photons = []
+    for second in range(int(np.floor(startTime)), int(np.floor(stopTime)) + 2):
+        binfile = findBin(os.path.join(binDir, '{}.bin'.format(second)))
+        if not os.path.exists(binfile):
+            continue
+        photons.append(readBin(binfile, startTime, stopTime, pixels, useIndex))
+    if not photons:
+        return np.empty(0, dtype=PHOTON_DTYPE)
+    photons = np.concatenate(photons)
+    return photons[np.argsort(photons['time'], kind='mergesort')]
@@ -65,6 +65,8 @@ from mkidreadout.readout.packetmaster import Packetmaster
 from mkidreadout.utils.utils import interpolateImage
 
 SHAREDIMAGE_LATENCY = 0.55 #0.53 #latency fudge factor for sharedmem
+PACKETMASTER_TELEMETRY_INTERVAL = 5000  # ms
+PACKETMASTER_RING_FILL_WARNING = 0.5  # fraction of a ring buffer a consumer may lag before we complain
 
 def add_actions(target, actions):
     for action in actions:
@@ -121,11 +123,15 @@ class LiveImageFetcher(QtCore.QObject):  # Extends QObject for use with QThreads
             removeOldFiles - remove .img and .png files after we read them
         """
         self.search = True
+        inttime = None
         while self.search:
             try:
                 utc = datetime.utcfromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
                 #self.imagebuffer.startIntegration(startTime=time.time() - SHAREDIMAGE_LATENCY, integrationTime=self.inttime)
-                self.imagebuffer.startIntegration(integrationTime=self.inttime)
+                # packetmaster integrates back to back until told otherwise (or a frame times out)
+                if inttime != self.inttime or not self.imagebuffer.continuous:
+                    inttime = self.inttime
+                    self.imagebuffer.startIntegration(integrationTime=inttime, continuous=True)
                 data = self.imagebuffer.receiveImage()
                 if not data.sum():
                     getLogger('Dashboard').warning('Received a frame of zeros from packetmaster!')
@@ -136,6 +142,10 @@ class LiveImageFetcher(QtCore.QObject):  # Extends QObject for use with QThreads
                 if ret.header['wavecal']:
                     ret.header['wmin'] = self.imagebuffer.wvlStart
                     ret.header['wmax'] = self.imagebuffer.wvlStop
+                    frame = self.imagebuffer.frameHeader
+                    if frame is not None:
+                        ret.header['wavegen'] = frame['wavecalGeneration']
+                        ret.header['wavemix'] = frame['wavecalMixed']
                 else:
                     ret.header['wmin'] = 'NaN'
                     ret.header['wmax'] = 'NaN'
@@ -144,6 +154,7 @@ class LiveImageFetcher(QtCore.QObject):  # Extends QObject for use with QThreads
                 getLogger('Dashboard').debug('Image stream unavailable: {}'.format(e))
             except Exception:
                 getLogger('Dashboard').error('Problem', exc_info=True)
+        self.imagebuffer.stopIntegration()
         self.finished.emit()
 
 
@@ -346,8 +357,18 @@ class MKIDDashboard(QMainWindow):
             forwarding = None
         self.packetmaster = Packetmaster(len(roachNums), self.config.packetmaster.captureport,
                                          useWriter=not self.offline, sharedImageCfg={'dashboard': imgcfg},
-                                         beammap=self.config.beammap, forwarding=forwarding, recreate_images=True)
+                                         beammap=self.config.beammap, forwarding=forwarding, recreate_images=True,
+                                         recvBatchSize=self.config.packetmaster.get('recv_batch_size', 1),
+                                         nReaders=self.config.packetmaster.get('n_readers', 1),
+                                         writerCfg=self.config.packetmaster.get('writer', None),
+                                         instanceName=self.config.packetmaster.get('instance', None),
+                                         cpuOffset=self.config.packetmaster.get('cpu_offset', 0))
         self.liveimage = self.packetmaster.sharedImages['dashboard']
+        self.last_telemetry = self.packetmaster.telemetry()
+        telemetry_timer = QtCore.QTimer(self)
+        telemetry_timer.timeout.connect(self.update_telemetry)
+        telemetry_timer.setInterval(PACKETMASTER_TELEMETRY_INTERVAL)
+        telemetry_timer.start()
 
         self.liveimage.startIntegration(startTime=time.time() - SHAREDIMAGE_LATENCY, integrationTime=1)
         data = self.liveimage.receiveImage()
@@ -473,6 +494,32 @@ class MKIDDashboard(QMainWindow):
         self.last_tcs_poll = self.telescopeController.get_header()
         # getLogger('Dashboard').debug(self.last_tcs_poll)
 
+    def update_telemetry(self):
+        """ Poll packetmaster's health and log anything that got worse since the last poll """
+        prev, self.last_telemetry = self.last_telemetry, self.packetmaster.telemetry()
+        log = getLogger('Dashboard')
+        for roach, stats in self.last_telemetry['roaches'].items():
+            old = prev['roaches'].get(roach, {})
+            if stats['framesMissed'] > old.get('framesMissed', 0):
+                log.warning('Roach {} dropped {} packets'.format(roach, stats['framesMissed'] -
+                                                                old.get('framesMissed', 0)))
+            if stats['outOfOrder'] > old.get('outOfOrder', 0):
+                log.warning('Roach {} sent {} packets out of order'.format(roach, stats['outOfOrder'] -
+                                                                          old.get('outOfOrder', 0)))
+        for name, stats in self.last_telemetry['consumers'].items():
+            old = prev['consumers'].get(name, {})
+            for key in ('packetsMissed', 'bytesMissed'):
+                if stats.get(key, 0) > old.get(key, 0):
+                    log.error('Packetmaster {} fell behind, {} {}'.format(name, stats[key] - old.get(key, 0), key))
+            if stats['ringFill'] > PACKETMASTER_RING_FILL_WARNING:
+                log.warning('Packetmaster {} is {:.0f}% behind'.format(name, 100*stats['ringFill']))
+        for i, stats in enumerate(self.last_telemetry['forwarding'] or []):
+            old = prev['forwarding'][i] if prev['forwarding'] else {'dropped': 0}
+            if stats['dropped'] > old['dropped']:
+                log.warning('Forwarding to {}:{} dropped {} packets'.format(stats['host'], stats['port'],
+                                                                           stats['dropped'] - old['dropped']))
+        log.debug(self.last_telemetry)
+
     def startworker(self, obj, name):
         self.workers.append(obj)
         thread = QtCore.QThread(parent=self)
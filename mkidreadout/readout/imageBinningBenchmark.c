@@ -0,0 +1,135 @@
+/*
+ * File:      imageBinningBenchmark.c
+ *
+ * Throughput of the shared image integration path (addPacketToFrame) for plain counts,
+ * wavelength cubes binned photon by photon, and wavelength cubes binned through the
+ * per pixel WVL_BIN_TABLE. Also checks that the table gives the same cube as the
+ * photon by photon path.
+ *
+ * Compile with
+ * gcc -O2 -std=gnu11 imageBinningBenchmark.c pmthreads.c mkidshm/mkidshm.c -Imkidshm -o imageBinningBenchmark -lrt -lpthread -lm -lz
+ *
+ * Usage: ./imageBinningBenchmark [nWvlBins] [nPackets]
+ */
+#include "pmthreads.h"
+
+#define BENCH_IMAGE_NAME "/imageBinningBenchmark"
+#define BENCH_NCOLS 140
+#define BENCH_NROWS 146
+#define BENCH_PHOTONS_PER_PACKET 100
+#define BENCH_WVL_START 700
+#define BENCH_WVL_STOP 1500
+
+static uint64_t makePhotonWord(int x, int y, int phase){
+    uint64_t word = 0;
+    PHOTON_WORD *photon = (PHOTON_WORD*)&word;
+    photon->xcoord = x;
+    photon->ycoord = y;
+    photon->phase = phase;
+    photon->timestamp = 0;
+    photon->baseline = 0;
+    return __bswap_64(word);
+
+}
+
+static double runBench(MKID_IMAGE *image, char *packets, int nPackets, WAVECAL_BUFFER *wavecal,
+        WVL_BIN_TABLE *binTable){
+    int i;
+    struct timespec startSpec, stopSpec;
+    int packSize = 8*(BENCH_PHOTONS_PER_PACKET + 1);
+
+    memset(image->image, 0, sizeof(image_t)*MKIDShmImage_frameSize(image->md));
+    clock_gettime(CLOCK_MONOTONIC, &startSpec);
+    for(i=0; i<nPackets; i++)
+        addPacketToFrame(image, image->image, packets + i*packSize, packSize, wavecal, binTable);
+    clock_gettime(CLOCK_MONOTONIC, &stopSpec);
+
+    return (stopSpec.tv_sec - startSpec.tv_sec) + (stopSpec.tv_nsec - startSpec.tv_nsec)/1.e9;
+
+}
+
+int main(int argc, char **argv){
+    int nWvlBins = argc > 1 ? atoi(argv[1]) : 10;
+    int nPackets = argc > 2 ? atoi(argv[2]) : 100000;
+    int i, j, pix;
+    int packSize = 8*(BENCH_PHOTONS_PER_PACKET + 1);
+    double nPhotons = (double)nPackets*BENCH_PHOTONS_PER_PACKET;
+    double tCounts, tExact, tTable;
+    size_t frameSize, nDiff;
+    char *packets;
+    image_t *exactCube;
+    uint64_t *word;
+    MKID_IMAGE_METADATA md;
+    MKID_IMAGE image;
+    WAVECAL_BUFFER wavecal;
+    WVL_BIN_TABLE binTable;
+
+    srand(1);
+
+    shm_unlink(BENCH_IMAGE_NAME);
+    shm_unlink(BENCH_IMAGE_NAME ".buf");
+    MKIDShmImage_populateMD(&md, BENCH_IMAGE_NAME, BENCH_NCOLS, BENCH_NROWS, 1, nWvlBins, 0,
+            BENCH_WVL_START, BENCH_WVL_STOP);
+    md.nBuffers = 1;
+    if(MKIDShmImage_create(&md, BENCH_IMAGE_NAME, &image) != 0){
+        printf("Error creating benchmark image\n");
+        return 1;
+
+    }
+    image.md->takingImage = 1;
+    frameSize = MKIDShmImage_frameSize(image.md);
+
+    // roughly linear energy vs phase, ~0.9-1.6 eV over -60 to -120 degrees
+    memset(&wavecal, 0, sizeof(wavecal));
+    wavecal.nCols = BENCH_NCOLS;
+    wavecal.nRows = BENCH_NROWS;
+    wavecal.tables[0].data = (wvlcoeff_t*)malloc(3*BENCH_NCOLS*BENCH_NROWS*sizeof(wvlcoeff_t));
+    for(pix=0; pix<BENCH_NCOLS*BENCH_NROWS; pix++){
+        wavecal.tables[0].data[3*pix] = -2.e-5*rand()/RAND_MAX;
+        wavecal.tables[0].data[3*pix+1] = -0.012 + 0.002*rand()/RAND_MAX;
+        wavecal.tables[0].data[3*pix+2] = 0.2*rand()/RAND_MAX;
+
+    }
+
+    packets = (char*)malloc((size_t)nPackets*packSize);
+    for(i=0; i<nPackets; i++){
+        word = (uint64_t*)(packets + i*packSize);
+        word[0] = 0; //header isn't looked at
+        for(j=1; j<=BENCH_PHOTONS_PER_PACKET; j++)
+            word[j] = makePhotonWord(rand()%BENCH_NCOLS, rand()%BENCH_NROWS,
+                    -(int)((40 + 100.*rand()/RAND_MAX)/RAD_TO_DEG*PHASE_BIN_PT));
+
+    }
+
+    memset(&binTable, 0, sizeof(binTable));
+    updateWvlBinTable(&binTable, image.md, &wavecal, wavecal.generation);
+
+    image.md->useWvl = 0;
+    tCounts = runBench(&image, packets, nPackets, &wavecal, NULL);
+    image.md->useWvl = 1;
+    tExact = runBench(&image, packets, nPackets, &wavecal, NULL);
+    exactCube = (image_t*)malloc(frameSize*sizeof(image_t));
+    memcpy(exactCube, image.image, frameSize*sizeof(image_t));
+    tTable = runBench(&image, packets, nPackets, &wavecal, &binTable);
+
+    nDiff = 0;
+    for(i=0; i<frameSize; i++)
+        if(exactCube[i] != image.image[i])
+            nDiff++;
+
+    printf("%d wavelength bins, %.0f photons\n", nWvlBins, nPhotons);
+    printf("counts only:           %8.1f Mphot/s\n", nPhotons/tCounts/1.e6);
+    printf("wavelength, computed:  %8.1f Mphot/s\n", nPhotons/tExact/1.e6);
+    printf("wavelength, bin table: %8.1f Mphot/s\n", nPhotons/tTable/1.e6);
+    printf("cube pixels differing between computed and table binning: %lu\n", nDiff);
+
+    freeWvlBinTable(&binTable);
+    free(exactCube);
+    free(packets);
+    free(wavecal.tables[0].data);
+    MKIDShmImage_close(&image);
+    shm_unlink(BENCH_IMAGE_NAME);
+    shm_unlink(BENCH_IMAGE_NAME ".buf");
+    return nDiff != 0;
+
+}
@@ -52,7 +52,6 @@ int MKIDShmImage_create(MKID_IMAGE_METADATA *imageMetadata, const char *imgName,
     char doneSemName[STRBUFLEN + 11];
     image_t *imgPtr;
     int i;
-    int depth;
 
     mdPtr = (MKID_IMAGE_METADATA*)openShmFile(imgName, sizeof(MKID_IMAGE_METADATA), 1);
 
@@ -61,20 +60,17 @@ int MKIDShmImage_create(MKID_IMAGE_METADATA *imageMetadata, const char *imgName,
 
     memcpy(mdPtr, imageMetadata, sizeof(MKID_IMAGE_METADATA)); //copy contents of imageMetadata into shared memory buffer
     outputImage->md = mdPtr;
+    if(mdPtr->nBuffers > MAX_IMAGE_BUFFERS)
+        mdPtr->nBuffers = MAX_IMAGE_BUFFERS;
 
     // CREATE IMAGE DATA BUFFER
-    if(mdPtr->useEdgeBins==1)
-        depth = mdPtr->nWvlBins + 2;
-    else
-        depth = mdPtr->nWvlBins;
-
-    int imageSize = (mdPtr->nCols)*(mdPtr->nRows)*depth;
-
-    imgPtr = (image_t*)openShmFile(mdPtr->imageBufferName, sizeof(image_t)*imageSize, 1);
+    imgPtr = (image_t*)openShmFile(mdPtr->imageBufferName, 
+            sizeof(image_t)*MKIDShmImage_frameSize(mdPtr)*MKIDShmImage_nBuffers(mdPtr), 1);
     if(imgPtr==NULL)
         return -1;
 
     outputImage->image = imgPtr;
+    outputImage->imageBuffers = imgPtr;
 
     // OPEN SEMAPHORES
     outputImage->takeImageSem = sem_open(mdPtr->takeImageSemName, O_CREAT, S_IRUSR|S_IWUSR|S_IRGRP|S_IWGRP|S_IROTH|S_IWOTH, 0);
@@ -101,7 +97,6 @@ int MKIDShmImage_open(MKID_IMAGE *imageStruct, const char *imgName){
     image_t *imgPtr;
     char doneSemName[STRBUFLEN + 11];
     int i;
-    int depth;
 
     // OPEN METADATA BUFFER
     mdPtr = (MKID_IMAGE_METADATA*)openShmFile(imgName, sizeof(MKID_IMAGE_METADATA), 0);
@@ -109,7 +104,8 @@ int MKIDShmImage_open(MKID_IMAGE *imageStruct, const char *imgName){
         return -1;
 
 
-    if(mdPtr->version != MKIDSHM_VERSION){
+    //image layout is unchanged since MKIDSHM_COMPAT_VERSION
+    if((mdPtr->version < MKIDSHM_COMPAT_VERSION) || (mdPtr->version > MKIDSHM_VERSION)){
         printf("ERROR: Version mismatch between libmkidshm and shared memory file");
         return -1;
 
@@ -118,17 +114,13 @@ int MKIDShmImage_open(MKID_IMAGE *imageStruct, const char *imgName){
     imageStruct->md = mdPtr;
 
     // OPEN IMAGE BUFFER 
-    if(mdPtr->useEdgeBins==1)
-        depth = mdPtr->nWvlBins + 2;
-    else
-        depth = mdPtr->nWvlBins;
-
-    int imageSize = (mdPtr->nCols)*(mdPtr->nRows)*depth;
-    imgPtr = (image_t*)openShmFile(imageStruct->md->imageBufferName, imageSize*sizeof(image_t), 0);
+    imgPtr = (image_t*)openShmFile(imageStruct->md->imageBufferName, 
+            sizeof(image_t)*MKIDShmImage_frameSize(mdPtr)*MKIDShmImage_nBuffers(mdPtr), 0);
     if(imgPtr == NULL)
         return -1;
  
     imageStruct->image = imgPtr;
+    imageStruct->imageBuffers = imgPtr;
 
     // OPEN SEMAPHORES
     imageStruct->takeImageSem = sem_open(mdPtr->takeImageSemName, O_CREAT, S_IRUSR | S_IWUSR, 0);
@@ -147,7 +139,6 @@ int MKIDShmImage_open(MKID_IMAGE *imageStruct, const char *imgName){
 
 int MKIDShmImage_close(MKID_IMAGE *imageStruct){
     int i;
-    int depth;
 
     sem_close(imageStruct->takeImageSem);
 
@@ -155,14 +146,8 @@ int MKIDShmImage_close(MKID_IMAGE *imageStruct){
         sem_close(imageStruct->doneImageSemList[i]);
     free(imageStruct->doneImageSemList);
 
-    if(imageStruct->md->useEdgeBins==1)
-        depth = imageStruct->md->nWvlBins + 2;
-    else
-        depth = imageStruct->md->nWvlBins;
-
-    int imageSize = (imageStruct->md->nCols)*(imageStruct->md->nRows)*depth;
-
-    munmap(imageStruct->image, sizeof(image_t)*imageSize);
+    munmap(imageStruct->imageBuffers, 
+            sizeof(image_t)*MKIDShmImage_frameSize(imageStruct->md)*MKIDShmImage_nBuffers(imageStruct->md));
     munmap(imageStruct->md, sizeof(MKID_IMAGE_METADATA));
     return 0;
 
@@ -181,6 +166,17 @@ int MKIDShmImage_populateMD(MKID_IMAGE_METADATA *imageMetadata, const char *name
     imageMetadata->integrationTime = 0;
     imageMetadata->takingImage = 0;
     imageMetadata->valid = 1;
+    imageMetadata->nBuffers = DEFAULT_IMAGE_BUFFERS;
+    imageMetadata->writeBuffer = 0;
+    imageMetadata->readyBuffer = -1;
+    imageMetadata->heldBuffer = -1;
+    imageMetadata->continuous = 0;
+    imageMetadata->nextBuffer = -1;
+    imageMetadata->frameCount = 0;
+    memset(imageMetadata->frameHeaders, 0, sizeof(imageMetadata->frameHeaders));
+    imageMetadata->wavecalGeneration = 0;
+    memset(imageMetadata->frameWavecalStart, 0, sizeof(imageMetadata->frameWavecalStart));
+    memset(imageMetadata->frameWavecalEnd, 0, sizeof(imageMetadata->frameWavecalEnd));
     snprintf(imageMetadata->name, STRBUFLEN, "%s", name);
     snprintf(imageMetadata->wavecalID, WVLIDLEN, "%s", "none");
     snprintf(imageMetadata->imageBufferName, STRBUFLEN, "%s.buf", name);
@@ -200,6 +196,15 @@ void MKIDShmImage_startIntegration(MKID_IMAGE *image, uint64_t startTime, uint64
     
 }
 
+// In continuous mode packetmaster starts the next frame as soon as one finishes (until this
+// is cleared), so the frames following MKIDShmImage_startIntegration have no gaps between them.
+// Continuous mode integrates into the next frame while finishing the current one, so it
+// needs at least 2 frames; ignored for images with fewer
+void MKIDShmImage_setContinuous(MKID_IMAGE *image, int continuous){
+    image->md->continuous = (continuous && MKIDShmImage_nBuffers(image->md) >= 2) ? 1 : 0;
+
+}
+
 void MKIDShmImage_setWvlRange(MKID_IMAGE *image, int wvlStart, int wvlStop){
     image->md->wvlStart = wvlStart;
     image->md->wvlStop = wvlStop;
@@ -246,6 +251,7 @@ int MKIDShmImage_timedwait(MKID_IMAGE *image, int semInd, int time, int stopImag
     #endif
 
     if((retval == -1) && (stopImage)){
+        image->md->continuous = 0;
         image->md->takingImage = 0;
         sem_trywait(image->takeImageSem);
 
@@ -260,16 +266,144 @@ int MKIDShmImage_timedwait(MKID_IMAGE *image, int semInd, int time, int stopImag
 int MKIDShmImage_checkIfDone(MKID_IMAGE *image, int semInd){
     return sem_trywait(image->doneImageSemList[semInd]);}
 
+// Copies the most recently completed frame
 void MKIDShmImage_copy(MKID_IMAGE *image, image_t *outputBuffer){
+    size_t frameSize = MKIDShmImage_frameSize(image->md);
+    int frameInd = image->md->readyBuffer;
+
+    if((frameInd < 0) || (frameInd >= MKIDShmImage_nBuffers(image->md)))
+        frameInd = 0;
+
+    memcpy(outputBuffer, image->imageBuffers + frameInd*frameSize, sizeof(image_t) * frameSize);
+
+}
+
+// Number of image_t in one frame (the full wavelength cube)
+size_t MKIDShmImage_frameSize(MKID_IMAGE_METADATA *imageMetadata){
     int depth;
 
-    if(image->md->useEdgeBins==1)
-        depth = image->md->nWvlBins + 2;
+    if(imageMetadata->useEdgeBins==1)
+        depth = imageMetadata->nWvlBins + 2;
     else
-        depth = image->md->nWvlBins;
-    int imageSize = (image->md->nCols)*(image->md->nRows)*depth;
+        depth = imageMetadata->nWvlBins;
+
+    return (size_t)(imageMetadata->nCols)*(imageMetadata->nRows)*depth;
+
+}
+
+int MKIDShmImage_nBuffers(MKID_IMAGE_METADATA *imageMetadata){
+    return (imageMetadata->nBuffers > 0) ? imageMetadata->nBuffers : 1; //version 4 images have 0
+
+}
+
+// Picks a frame for the writer: never the held frame or exclude (-1 for none), and the 
+// ready frame only if nothing else is free. Starts after the ready frame so frames rotate.
+static int pickFreeFrame(MKID_IMAGE *image, int exclude){
+    int i, frameInd;
+    int nBuffers = MKIDShmImage_nBuffers(image->md);
+    int readyBuffer = image->md->readyBuffer;
+    // pairs with the store/load in holdReadyFrame: either we see the reader's new held frame, or
+    // the reader sees the ready frame we are avoiding and holds that instead
+    int heldBuffer = __atomic_load_n(&image->md->heldBuffer, __ATOMIC_SEQ_CST);
+
+    for(i=1; i<=nBuffers; i++){
+        frameInd = (readyBuffer + i + nBuffers) % nBuffers;
+        if((frameInd != heldBuffer) && (frameInd != exclude))
+            return frameInd;
+
+    }
+
+    return (exclude == 0 && nBuffers > 1) ? 1 : 0; //nBuffers too small for the reader
+
+}
+
+// Zeros frame frameInd and fills in its header for an integration starting at startTime
+static image_t *setupFrame(MKID_IMAGE *image, int frameInd, uint64_t startTime){
+    image_t *frame = image->imageBuffers + frameInd*MKIDShmImage_frameSize(image->md);
+    MKID_FRAME_HEADER *header = image->md->frameHeaders + frameInd;
+
+    if(frameInd == image->md->readyBuffer) //only happens if nBuffers is too small for the reader
+        __atomic_store_n(&image->md->readyBuffer, -1, __ATOMIC_SEQ_CST);
+
+    header->complete = 0;
+    image->md->frameWavecalStart[frameInd] = image->md->wavecalGeneration;
+    header->startTime = startTime;
+    header->integrationTime = image->md->integrationTime;
+    memset(frame, 0, sizeof(image_t)*MKIDShmImage_frameSize(image->md));
+    return frame;
+
+}
+
+// Writer side: picks the frame to integrate into next (never the one held by a reader,
+// preferring not to overwrite the ready frame), zeros it and points image->image at it.
+void MKIDShmImage_startFrame(MKID_IMAGE *image){
+    int frameInd = pickFreeFrame(image, -1);
+
+    image->md->nextBuffer = -1;
+    image->md->writeBuffer = frameInd;
+    image->image = setupFrame(image, frameInd, image->md->startTime);
+
+}
+
+// Writer side, continuous mode: sets up the frame following the one being written (for
+// boards that have already passed the end of the current frame) and points image->nextImage 
+// at it. Returns the frame index.
+int MKIDShmImage_prepareNextFrame(MKID_IMAGE *image){
+    int frameInd = pickFreeFrame(image, image->md->writeBuffer);
+
+    image->md->nextBuffer = frameInd;
+    image->nextImage = setupFrame(image, frameInd, image->md->startTime + image->md->integrationTime);
+    return frameInd;
+
+}
+
+// Writer side: stamps the frame header and publishes the frame being written as the ready 
+// frame; call before posting done sems. In continuous mode the next frame becomes the 
+// frame being written (it is set up here if prepareNextFrame wasn't called).
+void MKIDShmImage_finishFrame(MKID_IMAGE *image){
+    struct timespec now;
+    MKID_FRAME_HEADER *header = image->md->frameHeaders + image->md->writeBuffer;
+
+    clock_gettime(CLOCK_REALTIME, &now);
+    header->doneTime = (uint64_t)now.tv_sec*1000000000 + now.tv_nsec;
+    header->valid = image->md->valid;
+    image->md->frameWavecalEnd[image->md->writeBuffer] = image->md->wavecalGeneration;
+    header->frameNum = ++(image->md->frameCount);
+    header->complete = 1;
+    __atomic_store_n(&image->md->readyBuffer, image->md->writeBuffer, __ATOMIC_SEQ_CST);
+
+    if(image->md->continuous){
+        if(image->md->nextBuffer < 0)
+            MKIDShmImage_prepareNextFrame(image);
+        image->md->startTime += image->md->integrationTime;
+        image->md->valid = 1;
+        image->md->writeBuffer = image->md->nextBuffer;
+        image->image = image->nextImage;
 
-    memcpy(outputBuffer, image->image, sizeof(image_t) * imageSize);
+    }
+
+    image->md->nextBuffer = -1;
+
+}
+
+// Reader side: marks the ready frame as held (so the writer won't reuse it) and returns 
+// a pointer to it. Any previously held frame is released. The held frame is published before
+// the ready frame is checked again, so the writer can't have picked it in between.
+image_t *MKIDShmImage_holdReadyFrame(MKID_IMAGE *image){
+    int readyBuffer, frameInd;
+    int newReadyBuffer = __atomic_load_n(&image->md->readyBuffer, __ATOMIC_SEQ_CST);
+
+    do{
+        readyBuffer = newReadyBuffer;
+        frameInd = readyBuffer;
+        if(frameInd < 0)
+            frameInd = image->md->writeBuffer; //nothing completed yet, fall back to the last frame written
+        __atomic_store_n(&image->md->heldBuffer, frameInd, __ATOMIC_SEQ_CST);
+        newReadyBuffer = __atomic_load_n(&image->md->readyBuffer, __ATOMIC_SEQ_CST);
+
+    } while(newReadyBuffer != readyBuffer); //a frame was finished in between, the writer may have picked ours
+
+    return image->imageBuffers + frameInd*MKIDShmImage_frameSize(image->md);
 
 }
 
@@ -282,9 +416,47 @@ void MKIDShmImage_resetSems(MKID_IMAGE *image){
 
 }
 
+// Size of the event data file for the version and layout in metadata
+size_t MKIDShmEventBuffer_dataSize(MKID_EVENT_BUFFER_METADATA *metadata){
+    if(metadata->version < MKIDSHM_VERSION)
+        return metadata->size*sizeof(MKID_PHOTON_EVENT_V4);
+    if(metadata->layout == MKID_EVENT_LAYOUT_SOA)
+        return metadata->size*(sizeof(uint64_t) + sizeof(wvl_t) + 2*sizeof(uint16_t));
+    return metadata->size*sizeof(MKID_PHOTON_EVENT);
+
+}
+
+// Points the typed buffer pointers in bufferStruct at the mapped event data
+static void setEventBufferPtrs(MKID_EVENT_BUFFER *bufferStruct, void *bufferPtr){
+    uint32_t size = bufferStruct->md->size;
+
+    bufferStruct->buffer = NULL;
+    bufferStruct->bufferV4 = NULL;
+    bufferStruct->time = NULL;
+    bufferStruct->wvl = NULL;
+    bufferStruct->x = NULL;
+    bufferStruct->y = NULL;
+
+    if(bufferStruct->md->version < MKIDSHM_VERSION)
+        bufferStruct->bufferV4 = (MKID_PHOTON_EVENT_V4*)bufferPtr;
+
+    else if(bufferStruct->md->layout == MKID_EVENT_LAYOUT_SOA){
+        //largest fields first so every array stays naturally aligned
+        bufferStruct->time = (uint64_t*)bufferPtr;
+        bufferStruct->wvl = (wvl_t*)(bufferStruct->time + size);
+        bufferStruct->x = (uint16_t*)(bufferStruct->wvl + size);
+        bufferStruct->y = bufferStruct->x + size;
+
+    }
+
+    else
+        bufferStruct->buffer = (MKID_PHOTON_EVENT*)bufferPtr;
+
+}
+
 int MKIDShmEventBuffer_open(MKID_EVENT_BUFFER *bufferStruct, const char *bufferName){
     MKID_EVENT_BUFFER_METADATA *mdPtr;
-    MKID_PHOTON_EVENT *bufferPtr;
+    void *bufferPtr;
     char newPhotonSemName[STRBUFLEN + 11];
     int i;
     int depth;
@@ -295,20 +467,23 @@ int MKIDShmEventBuffer_open(MKID_EVENT_BUFFER *bufferStruct, const char *bufferN
         return -1;
 
 
-    if(mdPtr->version != MKIDSHM_VERSION){
+    if((mdPtr->version < MKIDSHM_COMPAT_VERSION) || (mdPtr->version > MKIDSHM_VERSION)){
         printf("ERROR: Version mismatch between libmkidshm and shared memory file");
         return -1;
 
     }
 
+    if(mdPtr->version < MKIDSHM_VERSION)
+        printf("WARNING: Opening version %u event buffer %s, using compatibility layout\n", mdPtr->version, bufferName);
+
     bufferStruct->md = mdPtr;
 
     // OPEN IMAGE BUFFER 
-    bufferPtr = (MKID_PHOTON_EVENT*)openShmFile(bufferStruct->md->eventBufferName, bufferStruct->md->size*sizeof(MKID_PHOTON_EVENT), 0);
+    bufferPtr = openShmFile(bufferStruct->md->eventBufferName, MKIDShmEventBuffer_dataSize(mdPtr), 0);
     if(bufferPtr == NULL)
         return -1;
  
-    bufferStruct->buffer = bufferPtr;
+    setEventBufferPtrs(bufferStruct, bufferPtr);
 
     // OPEN SEMAPHORES
     bufferStruct->newPhotonSemList = (sem_t**)malloc(N_DONE_SEMS*sizeof(sem_t*));
@@ -327,7 +502,7 @@ int MKIDShmEventBuffer_open(MKID_EVENT_BUFFER *bufferStruct, const char *bufferN
 int MKIDShmEventBuffer_create(MKID_EVENT_BUFFER_METADATA *bufferMetadata, const char *bufferName, MKID_EVENT_BUFFER *outputBuffer){
     MKID_EVENT_BUFFER_METADATA *mdPtr;
     char newPhotonSemName[STRBUFLEN + 11];
-    MKID_PHOTON_EVENT *bufferPtr;
+    void *bufferPtr;
     int i;
 
     mdPtr = (MKID_EVENT_BUFFER_METADATA*)openShmFile(bufferName, sizeof(MKID_EVENT_BUFFER_METADATA), 1);
@@ -339,11 +514,11 @@ int MKIDShmEventBuffer_create(MKID_EVENT_BUFFER_METADATA *bufferMetadata, const
     outputBuffer->md = mdPtr;
 
     // CREATE IMAGE DATA BUFFER
-    bufferPtr = (MKID_PHOTON_EVENT*)openShmFile(mdPtr->eventBufferName, sizeof(MKID_PHOTON_EVENT)*mdPtr->size, 1);
+    bufferPtr = openShmFile(mdPtr->eventBufferName, MKIDShmEventBuffer_dataSize(mdPtr), 1);
     if(bufferPtr==NULL)
         return -1;
 
-    outputBuffer->buffer = bufferPtr;
+    setEventBufferPtrs(outputBuffer, bufferPtr);
 
     // OPEN SEMAPHORES
     outputBuffer->newPhotonSemList = (sem_t**)malloc(N_DONE_SEMS*sizeof(sem_t*));
@@ -370,6 +545,7 @@ int MKIDShmEventBuffer_populateMD(MKID_EVENT_BUFFER_METADATA *metadata, const ch
     metadata->writing = 0;
     metadata->nCycles = 0;
     metadata->endInd = -1;
+    metadata->layout = MKID_EVENT_LAYOUT_AOS;
     snprintf(metadata->name, STRBUFLEN, "%s", name);
     snprintf(metadata->wavecalID, WVLIDLEN, "%s", "none");
     snprintf(metadata->eventBufferName, STRBUFLEN, "%s.buf", name);
@@ -379,16 +555,69 @@ int MKIDShmEventBuffer_populateMD(MKID_EVENT_BUFFER_METADATA *metadata, const ch
 }
 
 int MKIDShmEventBuffer_addEvent(MKID_EVENT_BUFFER *buffer, MKID_PHOTON_EVENT *photon){
+    return MKIDShmEventBuffer_addEvents(buffer, photon, 1);
+
+}
+
+// Copies nPhotons events to buffer indices [writeInd, writeInd + nPhotons), no wrapping
+static void copyEvents(MKID_EVENT_BUFFER *buffer, int writeInd, MKID_PHOTON_EVENT *photons, int nPhotons){
+    int i;
+
+    if(buffer->buffer != NULL)
+        memcpy(buffer->buffer + writeInd, photons, nPhotons*sizeof(MKID_PHOTON_EVENT));
+
+    else if(buffer->time != NULL)
+        for(i=0; i<nPhotons; i++){
+            buffer->time[writeInd + i] = photons[i].time;
+            buffer->wvl[writeInd + i] = photons[i].wvl;
+            buffer->x[writeInd + i] = photons[i].x;
+            buffer->y[writeInd + i] = photons[i].y;
+
+        }
+
+    else
+        for(i=0; i<nPhotons; i++){
+            buffer->bufferV4[writeInd + i].time = photons[i].time;
+            buffer->bufferV4[writeInd + i].wvl = photons[i].wvl;
+            buffer->bufferV4[writeInd + i].x = (uint8_t)photons[i].x;
+            buffer->bufferV4[writeInd + i].y = (uint8_t)photons[i].y;
+
+        }
+
+}
+
+// Copies a batch of events into the buffer and posts the new photon sems once for the 
+// whole batch. If nPhotons exceeds the buffer size only the newest events are kept.
+int MKIDShmEventBuffer_addEvents(MKID_EVENT_BUFFER *buffer, MKID_PHOTON_EVENT *photons, int nPhotons){
+    int writeInd, nFirst;
+    int size = buffer->md->size;
+
+    if(nPhotons <= 0)
+        return 0;
+
+    if(nPhotons > size){
+        photons += nPhotons - size;
+        nPhotons = size;
+
+    }
+
     buffer->md->writing = 1;
-    int writeInd = buffer->md->endInd + 1;
-    if(writeInd == buffer->md->size){ //we've reached the end of the buffer
-        writeInd = 0;
+    writeInd = buffer->md->endInd + 1;
+    if(writeInd + nPhotons > size) //we'll pass the end of the buffer
         buffer->md->nCycles += 1;
+    if(writeInd == size)
+        writeInd = 0;
+
+    nFirst = size - writeInd;
+    if(nFirst >= nPhotons)
+        copyEvents(buffer, writeInd, photons, nPhotons);
+    else{ //wraps around the end of the buffer
+        copyEvents(buffer, writeInd, photons, nFirst);
+        copyEvents(buffer, 0, photons + nFirst, nPhotons - nFirst);
 
     }
 
-    buffer->buffer[writeInd] = *photon; 
-    buffer->md->endInd = writeInd;
+    buffer->md->endInd = (writeInd + nPhotons - 1) % size;
 
     buffer->md->writing = 0;
     MKIDShmEventBuffer_postDoneSem(buffer, -1);
@@ -23,14 +23,27 @@ extern "C" {
 #endif
 
 #define N_DONE_SEMS 10
-#define MKIDSHM_VERSION 4
+#define MKIDSHM_VERSION 5
+#define MKIDSHM_COMPAT_VERSION 4 //oldest version whose shared memory files can still be opened
 #define TIMEDWAIT_FUDGE 5000 //half ms
+#define DEFAULT_IMAGE_BUFFERS 3 //image frames in shared memory; >1 lets readers hold a frame while the next integrates
+#define MAX_IMAGE_BUFFERS 8
 #define STRBUFLEN 80
 #define WVLIDLEN 150
 typedef int image_t; //can mess around with changing this w/o many subsitutions
 typedef float coeff_t;
 typedef float wvl_t;
 
+typedef struct{
+    uint64_t frameNum; //value of frameCount when this frame completed (starts at 1)
+    uint64_t startTime; //same units as MKID_IMAGE_METADATA startTime
+    uint64_t integrationTime;
+    uint64_t doneTime; //CLOCK_REALTIME ns when the frame completed
+    uint32_t valid; //md->valid at completion
+    uint32_t complete; //0 while integrating
+
+} MKID_FRAME_HEADER;
+
 typedef struct{
     //metadata
     uint32_t version;
@@ -52,6 +65,24 @@ typedef struct{
     char doneImageSemName[STRBUFLEN];
     char wavecalID[WVLIDLEN];
 
+    // Frame buffering, added in version 5 (all read 0 for version 4 images, which have one buffer)
+    uint32_t nBuffers; //number of image frames in the image buffer
+    int32_t writeBuffer; //frame packetmaster is integrating into
+    int32_t readyBuffer; //most recently completed frame, -1 if none
+    int32_t heldBuffer; //frame a reader is viewing in place; the writer never reuses it, -1 if none
+
+    // Continuous mode, also added in version 5
+    uint32_t continuous; //if 1 start the next frame as soon as one finishes instead of stopping
+    int32_t nextBuffer; //frame the next integration is already going into (continuous mode), -1 if none
+    uint64_t frameCount; //number of frames completed
+    MKID_FRAME_HEADER frameHeaders[MAX_IMAGE_BUFFERS]; //one per frame buffer
+
+    // Wavecal generation (number of solutions packetmaster has applied, 0 for none). Appended
+    // after the version 5 fields so images created without them read 0.
+    uint32_t wavecalGeneration; //generation the writer is binning photons with
+    uint32_t frameWavecalStart[MAX_IMAGE_BUFFERS]; //generation when each frame started
+    uint32_t frameWavecalEnd[MAX_IMAGE_BUFFERS]; //and when it completed; they differ if the frame mixes two
+
 } MKID_IMAGE_METADATA;
 
 
@@ -60,7 +91,9 @@ typedef struct{
 
     // For nCounts in pixel (x, y) and wavelength bin i:
     //  image[i*nCols*nRows + y*nCols + x]
-    image_t *image; //pointer to shared memory buffer
+    image_t *image; //frame currently being written (set by MKIDShmImage_startFrame), initially frame 0
+    image_t *imageBuffers; //start of shared memory buffer, nBuffers consecutive frames
+    image_t *nextImage; //frame set up by MKIDShmImage_prepareNextFrame (continuous mode writer)
 
     sem_t *takeImageSem; //post to start integration
     sem_t **doneImageSemList; //post when integration is done
@@ -68,15 +101,31 @@ typedef struct{
 } MKID_IMAGE;
 
 
+#define MKID_EVENT_LAYOUT_AOS 0 //buffer is an array of MKID_PHOTON_EVENT
+#define MKID_EVENT_LAYOUT_SOA 1 //buffer is separate time, wvl, x, y arrays, each md->size long
+
+// Fields are ordered largest first so the struct is 16 bytes with no padding;
+// 16 byte alignment keeps every event inside a single cache line.
 typedef struct{
+    uint64_t time; //arrival time (could also shorten and make relative)
+    wvl_t wvl; //wavelength
+
     // coordinates
+    uint16_t x;
+    uint16_t y;
+
+} __attribute__((aligned(16))) MKID_PHOTON_EVENT;
+
+// Event layout of MKIDSHM_VERSION 4 buffers (24 bytes, 8 bit coordinates). Only used
+// when opening a buffer created by an older libmkidshm.
+typedef struct{
     uint8_t x;
     uint8_t y;
 
-    uint64_t time; //arrival time (could also shorten and make relative)
-    wvl_t wvl; //wavelength
+    uint64_t time;
+    wvl_t wvl;
 
-} MKID_PHOTON_EVENT;
+} MKID_PHOTON_EVENT_V4;
 
 typedef struct{
     uint32_t version;
@@ -92,11 +141,21 @@ typedef struct{
     char newPhotonSemName[STRBUFLEN];
     char wavecalID[WVLIDLEN];
 
+    uint32_t layout; //MKID_EVENT_LAYOUT_AOS or MKID_EVENT_LAYOUT_SOA; added in version 5 (reads 0 for version 4)
+
 } MKID_EVENT_BUFFER_METADATA;
 
 typedef struct{
     MKID_EVENT_BUFFER_METADATA *md;
-    MKID_PHOTON_EVENT *buffer;
+    MKID_PHOTON_EVENT *buffer; //AOS layout, NULL otherwise
+    MKID_PHOTON_EVENT_V4 *bufferV4; //version 4 buffers, NULL otherwise
+
+    // SOA layout, NULL otherwise; all point into the same shared memory file
+    uint64_t *time;
+    wvl_t *wvl;
+    uint16_t *x;
+    uint16_t *y;
+
     sem_t **newPhotonSemList;
 
 } MKID_EVENT_BUFFER;
@@ -107,24 +166,33 @@ int MKIDShmImage_close(MKID_IMAGE *imageStruct);
 int MKIDShmImage_create(MKID_IMAGE_METADATA *imageMetadata, const char *imgName, MKID_IMAGE *outputImage);
 int MKIDShmImage_populateMD(MKID_IMAGE_METADATA *imageMetadata, const char *name, int nCols, int nRows, int useWvl, int nWvlBins, int useEdgeBins, int wvlStart, int wvlStop);
 void MKIDShmImage_startIntegration(MKID_IMAGE *image, uint64_t startTime, uint64_t integrationTime);
+void MKIDShmImage_setContinuous(MKID_IMAGE *image, int continuous);
 void MKIDShmImage_wait(MKID_IMAGE *image, int semInd);
 
-//time is in half-ms, cancels integration if stopImage is 1
+//time is in half-ms, cancels integration (and continuous mode) if stopImage is 1
 int MKIDShmImage_timedwait(MKID_IMAGE *image, int semInd, int time, int stopImage);
 int MKIDShmImage_checkIfDone(MKID_IMAGE *image, int semInd);
 void MKIDShmImage_postDoneSem(MKID_IMAGE *image, int semInd);
 void MKIDShmImage_copy(MKID_IMAGE *image, image_t *ouputBuffer);
 void MKIDShmImage_setWvlRange(MKID_IMAGE *image, int wvlStart, int wvlStop);
 void MKIDShmImage_resetSems(MKID_IMAGE *image);
+size_t MKIDShmImage_frameSize(MKID_IMAGE_METADATA *imageMetadata);
+int MKIDShmImage_nBuffers(MKID_IMAGE_METADATA *imageMetadata);
+void MKIDShmImage_startFrame(MKID_IMAGE *image);
+int MKIDShmImage_prepareNextFrame(MKID_IMAGE *image);
+void MKIDShmImage_finishFrame(MKID_IMAGE *image);
+image_t *MKIDShmImage_holdReadyFrame(MKID_IMAGE *image);
 //void MKIDShmImage_setInvalid(MKID_IMAGE *image);
 //void MKIDShmImage_setValid(MKID_IMAGE *image);
 
 int MKIDShmEventBuffer_open(MKID_EVENT_BUFFER *bufferStruct, const char *bufferName);
 int MKIDShmEventBuffer_create(MKID_EVENT_BUFFER_METADATA *bufferMetadata, const char *bufferName, MKID_EVENT_BUFFER *outputBuffer);
 int MKIDShmEventBuffer_populateMD(MKID_EVENT_BUFFER_METADATA *metadata, const char *name, int size, int useWvl);
+size_t MKIDShmEventBuffer_dataSize(MKID_EVENT_BUFFER_METADATA *metadata);
 void MKIDShmEventBuffer_postDoneSem(MKID_EVENT_BUFFER *buffer, int semInd);
 void MKIDShmEventBuffer_resetSems(MKID_EVENT_BUFFER *buffer);
 int MKIDShmEventBuffer_addEvent(MKID_EVENT_BUFFER *buffer, MKID_PHOTON_EVENT *photon);
+int MKIDShmEventBuffer_addEvents(MKID_EVENT_BUFFER *buffer, MKID_PHOTON_EVENT *photons, int nPhotons);
 void MKIDShmEventBuffer_reset(MKID_EVENT_BUFFER *eventBuffer);
 //int MKIDShmEventBuffer_addEvent(MKID_EVENT_BUFFER *buffer, int x, int y, uint64_t time, coeff_t wvl);
 
@@ -1,6 +1,8 @@
 import cPickle as pickle
+import itertools
 import os
-import subprocess
+import re
+import time
 
 import numpy as np
 cimport numpy as np
@@ -14,15 +16,18 @@ READER_CPU = 1
 BIN_WRITER_CPU = 2
 SHM_IMAGE_WRITER_CPU = 3
 CIRC_BUFF_WRITER_CPU = 4
+EXTRA_READER_CPU_START = 5 #additional reader threads are pinned to consecutive cpus from here
 
 N_WVL_COEFFS = 3
 
-LO_IP = '127.0.0.1'
+FORWARD_SEND_BUFFER_MB = 8
 
-#WARNING: DO NOT USE IF THERE MAY BE MULTIPLE INSTANCES OF PACKETMASTER;
-#         THESE ARE SYSTEM WIDE SEMAPHORES
+#prefix of the quit semaphore; each Packetmaster adds its instance name (or pid and a counter)
+#so several can run on one machine
 QUIT_SEM_NAME = 'packetmaster_quitSem'
-RINGBUF_RESET_SEM_NAME = 'packetmaseter_ringbuff'
+MAX_INSTANCE_NAME_LEN = 32
+
+_instanceCounter = itertools.count()
 
 cdef extern from "<stdint.h>":
     ctypedef unsigned int uint32_t
@@ -33,70 +38,204 @@ cdef extern from "pmthreads.h":
     cdef int STRBUF
     cdef int SHAREDBUF
     cdef int RINGBUF_SIZE
+    cdef int MAX_RECV_BATCH
+    cdef int MAX_ROACHES
+    cdef int MAX_FORWARD_DESTS
     ctypedef float wvlcoeff_t
+    ctypedef struct READER_STATS:
+        uint64_t nRecvCalls
+        uint64_t nFrames
+        uint64_t nBytes
+        uint32_t lastBatchFrames
+        uint32_t lastBatchBytes
+
+    ctypedef struct ROACH_STATS:
+        uint64_t nPackets
+        uint64_t nPhotons
+        uint64_t nFrameGaps
+        uint64_t nFramesMissed
+        uint64_t nOutOfOrder
+        uint64_t lastTimestamp
+        uint32_t lastFrame
+        uint32_t seen
+
+    ctypedef struct CONSUMER_STATS:
+        uint64_t ringBacklog
+        uint64_t maxRingBacklog
+        uint64_t nPacketsMissed
+        uint64_t nBadPackets
+
+    ctypedef struct IMAGE_LATENCY_STATS:
+        uint64_t nFrames
+        uint64_t latencyNs
+        uint64_t lastLatencyNs
+        uint64_t maxLatencyNs
+
+    ctypedef struct RINGBUF_NOTIFIER:
+        uint64_t wakeBytes
+        int waitTimeoutUs
+
+    ctypedef struct WAIT_STATS:
+        uint64_t nWaits
+        uint64_t nWakes
+        uint64_t nTimeouts
+        uint64_t sleepNs
+        uint64_t wakeLatencyNs
+        uint64_t maxWakeLatencyNs
+        uint64_t cpuNs
+        uint64_t wallNs
+
     ctypedef struct READER_PARAMS:
         int port;
-        int nRoachStreams;
+        int reusePort;
         RINGBUFFER *packBuf;
+        RINGBUF_NOTIFIER *notifier;
 
         char quitSemName[80];
-        char ringBufResetSemName[80];
+
+        int batchSize; #datagrams per recvmmsg call; if <=1 use one recv per datagram
+        READER_STATS stats;
+        ROACH_STATS roachStats[256];
 
         int cpu; #if cpu=-1 then don't maximize priority
     
+    ctypedef struct BIN_WRITER_STATS:
+        uint64_t nBytesWritten
+        uint64_t nBytesMissed
+        uint64_t nFiles
+        uint64_t lastSecondBytes
+        uint64_t writeNs
+        uint64_t nWriteErrors
+        uint64_t nFsyncs
+        uint64_t fsyncNs
+        uint64_t lastFsyncNs
+        uint64_t maxFsyncNs
+        uint64_t queuedBytes
+        uint64_t maxQueuedBytes
+        uint64_t ringBacklog
+        uint64_t maxRingBacklog
+        uint64_t nStalls
+        uint64_t stallNs
+        uint64_t compressRawBytes
+        uint64_t compressOutBytes
+        uint64_t compressNs
+
     ctypedef struct BIN_WRITER_PARAMS:
-        RINGBUFFER *packBuf;
+        RINGBUFFER *packBufs;
+        int nPackBufs;
+        RINGBUF_NOTIFIER *notifier;
+        WAIT_STATS waitStats;
 
         int writing;
         char writerPath[80];
 
         char quitSemName[80];
-        char ringBufResetSemName[80];
+
+        int writeBehind;
+        int directIO;
+        int fsyncFiles;
+        uint64_t preallocBytes;
+        uint64_t blockSize;
+        int nBlocks;
+        BIN_WRITER_STATS stats;
+
+        int writeIndex;
+        int nRows;
+        int nCols;
+
+        int compressLevel;
+        int nCompressThreads;
 
         int cpu; 
     
     ctypedef struct SHM_IMAGE_WRITER_PARAMS:
-        RINGBUFFER *packBuf;
+        RINGBUFFER *packBufs;
+        int nPackBufs;
+        RINGBUF_NOTIFIER *notifier;
+        WAIT_STATS waitStats;
         int nRoach;
         int nSharedImages;
         char **sharedImageNames;
         WAVECAL_BUFFER *wavecal; #if NULL don't use wavecal
 
         char quitSemName[80];
-        char ringBufResetSemName[80];
+
+        CONSUMER_STATS stats;
+        IMAGE_LATENCY_STATS latencyStats;
 
         int cpu; #if cpu=-1 then don't maximize priority
     
     ctypedef struct EVENT_BUFF_WRITER_PARAMS:
-        RINGBUFFER *packBuf;
+        RINGBUFFER *packBufs;
+        int nPackBufs;
+        RINGBUF_NOTIFIER *notifier;
+        WAIT_STATS waitStats;
         char bufferName[80];
         WAVECAL_BUFFER *wavecal; #if NULL don't use wavecal
 
         char quitSemName[80]; 
-        char ringBufResetSemName[80];
 
         int nRows;
         int nCols;
 
+        uint64_t nEventsWritten;
+        uint64_t nBatches; #number of buffer updates (sem posts)
+        CONSUMER_STATS stats;
+
         int cpu; #if cpu=-1 then don't maximize priority
 
-    ctypedef struct WAVECAL_BUFFER:
+    ctypedef struct FORWARD_DEST:
+        char host[80];
+        int port;
+        int allRoaches;
+        uint8_t roaches[256];
+        int useRegion;
+        int xMin;
+        int xMax;
+        int yMin;
+        int yMax;
+
+        uint64_t nPacketsSent;
+        uint64_t nBytesSent;
+        uint64_t nPacketsDropped;
+        uint64_t nPacketsFiltered;
+        uint64_t nSendCalls;
+
+    ctypedef struct FORWARDER_PARAMS:
+        RINGBUFFER *packBufs;
+        int nPackBufs;
+        RINGBUF_NOTIFIER *notifier;
+        WAIT_STATS waitStats;
+        int nDests;
+        FORWARD_DEST dests[8];
+        int sendBufBytes;
+
+        char quitSemName[80];
+
+        CONSUMER_STATS stats;
+
+        int cpu; #if cpu=-1 then don't maximize priority
+
+    ctypedef struct WAVECAL_TABLE:
         char solutionFile[80];
-        int writing;
-        uint32_t nCols;
-        uint32_t nRows;
         # Each pixel has 3 coefficients, with address given by 
         # &a = 3*(nCols*y + x); &b = &a + 1; &c = &a + 2
         wvlcoeff_t *data;
 
+    ctypedef struct WAVECAL_BUFFER:
+        uint32_t generation; #_Atomic in C, tables[generation % 2] is current
+        uint32_t nCols;
+        uint32_t nRows;
+        WAVECAL_TABLE tables[2];
+
     ctypedef struct READOUT_STREAM:
         uint64_t unread;
         char data[536870912];
     
     ctypedef struct RINGBUFFER:
         uint8_t data[536870912];
-        uint64_t writeInd;
-        uint64_t nCycles;
+        uint64_t writeCursor; #_Atomic in C, only touch through initRingBuf
+        uint64_t packCount; #ditto
     
     ctypedef struct THREAD_PARAMS:
         pass
@@ -105,9 +244,26 @@ cdef extern from "pmthreads.h":
     cdef int startBinWriterThread(BIN_WRITER_PARAMS *rparams, THREAD_PARAMS *tparams);
     cdef int startShmImageWriterThread(SHM_IMAGE_WRITER_PARAMS *rparams, THREAD_PARAMS *tparams);
     cdef int startEventBuffWriterThread(EVENT_BUFF_WRITER_PARAMS *rparams, THREAD_PARAMS *tparams);
+    cdef int startForwarderThread(FORWARDER_PARAMS *rparams, THREAD_PARAMS *tparams);
     cdef void resetSem(const char *semName);
+    cdef void initRingBuf(RINGBUFFER *packBuf);
+    cdef void initRingBufNotifier(RINGBUF_NOTIFIER *notifier, uint64_t wakeBytes, int waitTimeoutUs);
     cdef void quitAllThreads(const char *quitSemName, int nThreads);
 
+cdef extern from "<semaphore.h>":
+    cdef int sem_unlink(const char *name);
+
+cdef _waitStatsDict(WAIT_STATS stats):
+    return {'nWaits': stats.nWaits, 'nWakes': stats.nWakes, 'nTimeouts': stats.nTimeouts,
+            'sleepTime': stats.sleepNs/1.e9, 'cpuFraction': float(stats.cpuNs)/stats.wallNs if stats.wallNs else 0.,
+            'meanWakeLatency': stats.wakeLatencyNs/1.e9/stats.nWakes if stats.nWakes else 0.,
+            'maxWakeLatency': stats.maxWakeLatencyNs/1.e9}
+
+cdef _consumerStatsDict(CONSUMER_STATS stats):
+    return {'ringBacklog': stats.ringBacklog, 'maxRingBacklog': stats.maxRingBacklog,
+            'ringFill': float(stats.ringBacklog)/RINGBUF_SIZE, 'packetsMissed': stats.nPacketsMissed,
+            'badPackets': stats.nBadPackets}
+
 cdef class Packetmaster(object): 
     """
     Receives and parses photon events for the MKID readout. This class is a python frontend for 
@@ -116,22 +272,29 @@ cdef class Packetmaster(object):
     cdef BIN_WRITER_PARAMS writerParams
     cdef SHM_IMAGE_WRITER_PARAMS imageParams
     cdef EVENT_BUFF_WRITER_PARAMS eventBuffParams
-    cdef READER_PARAMS readerParams
+    cdef FORWARDER_PARAMS forwarderParams
+    cdef READER_PARAMS *readerParams
     cdef WAVECAL_BUFFER wavecal
-    cdef RINGBUFFER packBuf
+    cdef RINGBUFFER *packBufs
+    cdef RINGBUF_NOTIFIER notifier
     cdef THREAD_PARAMS *threads
+    cdef int nReaders
     cdef int nRows
     cdef int nCols
     cdef int nThreads
     cdef int nSharedImages
     cdef readonly object sharedImages
     cdef readonly object eventBuffer
-    cdef readonly object samplicatorProcess
+    cdef object lastTelemetry
+    cdef readonly object instanceName
+    cdef readonly object quitSemName
+    cdef readonly object shmNames
 
     #TODO useWriter->savebinfiles, ramdiskPath->ramdisk ?use '' as default?
     def __init__(self, nRoaches, port, nRows=None, nCols=None, useWriter=True, wvlCoeffs=None,
                  beammap=None, sharedImageCfg=None, eventBuffCfg=None, maximizePriority=False, 
-                 recreate_images=False, forwarding=None):
+                 recreate_images=False, forwarding=None, recvBatchSize=1, nReaders=None, readerCpus=None,
+                 consumerWaitUs=500, wakeBytes=0, writerCfg=None, instanceName=None, cpuOffset=0):
         """
         Starts the reader (packet receiving) thread along with the appropriate number of parsing 
         threads according to the specified configuration.
@@ -140,8 +303,9 @@ cdef class Packetmaster(object):
         ----------
             nRoaches: int
                 Number of ROACH2 boards currently set up to read out the array and stream photons.
-            port: int
-                Port to use for receiving photon stream
+            port: int or list of ints
+                Port to use for receiving photon stream. If a list, one reader thread (with its own
+                ring buffer) is started per port.
             nRows: int
                 Number of rows on MKID array, required in no beammap, ignored if beammap
             nCols: int
@@ -161,23 +325,91 @@ cdef class Packetmaster(object):
                 Typical usage would pass a configdict specified in dashboard.yml. Creates/opens 
                 ImageCube objects for each image.
                 Object must have keys corresponding to the names of the images, and values must have a get method for
-                valid for the attributes n_wave_bins, use_wave, wave_start, wave_stop (i.e. a ConfigThing or a dict)
+                valid for the attributes n_wave_bins, use_wave, wave_start, wave_stop, n_buffers (i.e. a ConfigThing or a dict)
             eventBuffCfg: yaml config object (or dict)
-                Config dict specifying name and size of event buffer. If None no event buffer is created/used.
+                Config dict specifying name and size (and optionally layout, 'aos' or 'soa') of event 
+                buffer. If None no event buffer is created/used.
             recreate_images: bool
                 Remove and recreate the shared images if true
             forwarding: dict or yaml config object
-                Use if you want to forward photon packets to another machine (i.e. RTC). keys:
-                    localport: port that packetmaster listens to on local machine ('port'
-                        is the port that samplicator will bind to; localport must be different)
-                    destIP: IP address to forward packets to
-                    destport: port to use for forwarded IP
+                Use if you want to forward photon packets to other machines (i.e. RTC). A thread
+                re-sends packets from the ring buffers as they arrive. keys:
+                    destinations: list of up to MAX_FORWARD_DESTS dicts, each with
+                        host: hostname or IP address to forward packets to
+                        port: port to send to
+                        roaches: optional list of roach numbers (STREAM_HEADER roach field) to
+                            forward, default all
+                        region: optional [xMin, xMax, yMin, yMax]; only photons with 
+                            xMin <= x < xMax and yMin <= y < yMax are forwarded
+                    send_buffer_mb: socket send buffer per destination (default 8)
+                    cpu: cpu to pin the thread to if maximizePriority is set (default unpinned)
+                A single destination may also be given with the destIP and destport keys of 
+                the old samplicator setup (localport is no longer needed and is ignored). Use
+                forwarderStats and telemetry() to see what was sent and dropped.
+            recvBatchSize: int
+                Maximum number of UDP frames to pull from the socket per recvmmsg call. If 1, 
+                reader uses one recv per frame. Capped at MAX_RECV_BATCH.
+            nReaders: int
+                Number of reader threads to start on a single port. If > 1 the readers share the port
+                with SO_REUSEPORT, and the kernel assigns each roach's stream (by source address) to 
+                one of them. Ignored if port is a list. Each reader uses its own RINGBUF_SIZE buffer.
+            readerCpus: list of ints
+                CPUs to pin reader threads to if maximizePriority is set. Defaults to READER_CPU 
+                followed by consecutive cpus from EXTRA_READER_CPU_START.
+            consumerWaitUs: int
+                Parsing/writing threads sleep until a reader posts new data, waking at least this
+                often (microseconds) to check for quit, new images, etc. If 0 they busy-poll the 
+                ring buffers instead (lowest latency, but each burns a full core).
+            wakeBytes: int
+                Readers wake sleeping consumers only after this many bytes arrived since the 
+                consumers went idle (0 wakes on every packet batch). Trades latency, bounded by 
+                consumerWaitUs, for fewer wakeups.
+            writerCfg: dict or yaml config object
+                .bin writer options, all optional:
+                    write_behind: if True (default) the writer thread only copies data into large
+                        aligned staging buffers; a second thread writes them out and opens, fsyncs 
+                        and closes the per-second files. If False data is fwritten straight from 
+                        the ring buffers.
+                    direct_io: open files with O_DIRECT, bypassing the page cache (default False)
+                    fsync: fsync each file before closing it (default True)
+                    prealloc_mb: fallocate each file to this size on open (default 0, off)
+                    buffer_mb: size of each staging buffer (default 8)
+                    n_buffers: number of staging buffers (default 16)
+                    index: write a <ts>.idx sidecar index next to each <ts>.bin file (default 
+                        True), see mkidreadout.readout.binfile
+                    compress_level: zlib level (1-9) to compress each staging buffer with, 
+                        writing <ts>.binz files instead of <ts>.bin (default 0, off). Implies
+                        direct_io False. Read them with mkidreadout.readout.binfile.
+                    compress_threads: threads compressing staging buffers (default 4)
+                The last six only apply to write_behind.
+            instanceName: string
+                Set to run several packetmasters on one machine (e.g. one per 10 GbE port or 
+                array). Letters, digits, '_' and '-' only. Shared image and event buffer names
+                become '<instanceName>.<name>' (see shmNames; sharedImages is still keyed by 
+                the configured name) and .bin files go to <binDir>/<instanceName>/. The quit
+                semaphore is private to each instance whether or not this is set.
+            cpuOffset: int
+                Added to every cpu threads are pinned to with maximizePriority, so instances
+                don't share cores.
         """
+        if instanceName is not None:
+            if not re.match(r'^[A-Za-z0-9_-]{{1,{}}}$'.format(MAX_INSTANCE_NAME_LEN), instanceName):
+                raise ValueError('instanceName must be 1-{} letters, digits, _ or -'.format(MAX_INSTANCE_NAME_LEN))
+            self.quitSemName = '{}.{}'.format(QUIT_SEM_NAME, instanceName)
+        else:
+            self.quitSemName = '{}.{}.{}'.format(QUIT_SEM_NAME, os.getpid(), next(_instanceCounter))
+        self.instanceName = instanceName
+        self.shmNames = {}
+        if sharedImageCfg is not None:
+            for image in sharedImageCfg:
+                self.shmNames[image] = self._shmName(image)
+        if eventBuffCfg is not None:
+            self.shmNames[eventBuffCfg['name']] = self._shmName(eventBuffCfg['name'])
 
         #TODO: modify to include circular buffer
         if recreate_images and sharedImageCfg is not None:
             for k in sharedImageCfg:
-                f = '/dev/shm/{}'.format(k)
+                f = '/dev/shm/{}'.format(self.shmNames[k])
                 if os.path.exists(f):
                     os.remove(f)
                     os.remove(f+'.buf')
@@ -193,15 +425,41 @@ cdef class Packetmaster(object):
 
         npix = self.nRows*self.nCols
 
+        #SETUP READERS
+        if isinstance(port, (list, tuple)):
+            ports = [int(p) for p in port]
+            reusePort = False
+        else:
+            ports = [int(port)]*(nReaders if nReaders else 1)
+            reusePort = len(ports) > 1
+        if len(set(ports)) != len(ports) and not reusePort:
+            raise ValueError('Reader ports must be unique')
+        if not 1 <= recvBatchSize <= MAX_RECV_BATCH:
+            raise ValueError('recvBatchSize must be between 1 and {}'.format(MAX_RECV_BATCH))
+        self.nReaders = len(ports)
+        self.readerParams = <READER_PARAMS*>malloc(self.nReaders*sizeof(READER_PARAMS))
+        memset(self.readerParams, 0, self.nReaders*sizeof(READER_PARAMS))
+        self.packBufs = <RINGBUFFER*>malloc(self.nReaders*sizeof(RINGBUFFER))
+        if self.readerParams == NULL or self.packBufs == NULL:
+            raise MemoryError('Could not allocate {} ring buffers'.format(self.nReaders))
+
         #DEAL W/ CPU PRIORITY
         if maximizePriority:
-            self.readerParams.cpu = READER_CPU
-            self.writerParams.cpu = BIN_WRITER_CPU
-            self.imageParams.cpu = SHM_IMAGE_WRITER_CPU
+            if readerCpus is None:
+                readerCpus = [READER_CPU] + range(EXTRA_READER_CPU_START, EXTRA_READER_CPU_START+self.nReaders-1)
+            if len(readerCpus) != self.nReaders:
+                raise ValueError('readerCpus must have one cpu per reader')
+            for i in range(self.nReaders):
+                self.readerParams[i].cpu = readerCpus[i] + cpuOffset
+            self.writerParams.cpu = BIN_WRITER_CPU + cpuOffset
+            self.imageParams.cpu = SHM_IMAGE_WRITER_CPU + cpuOffset
+            self.eventBuffParams.cpu = CIRC_BUFF_WRITER_CPU + cpuOffset
         else:
-            self.readerParams.cpu = -1
+            for i in range(self.nReaders):
+                self.readerParams[i].cpu = -1
             self.writerParams.cpu = -1
             self.imageParams.cpu = -1
+            self.eventBuffParams.cpu = -1
         
         #INITIALIZE SHARED MEMORY IMAGES
         self.sharedImages = {}
@@ -211,13 +469,14 @@ cdef class Packetmaster(object):
             self.imageParams.wavecal = &(self.wavecal)
             self.imageParams.sharedImageNames = <char**>malloc(len(sharedImageCfg)*sizeof(char*))
             for i,image in enumerate(sharedImageCfg):
-                self.sharedImages[image] = ImageCube(name=image, nRows=self.nRows, nCols=self.nCols,
+                self.sharedImages[image] = ImageCube(name=self.shmNames[image], nRows=self.nRows, nCols=self.nCols,
                                                      useWvl=sharedImageCfg[image].get('use_wave', False),
                                                      nWvlBins=sharedImageCfg[image].get('n_wave_bins', 1),
                                                      wvlStart=sharedImageCfg[image].get('wave_start', False),
-                                                     wvlStop=sharedImageCfg[image].get('wave_stop', False))
+                                                     wvlStop=sharedImageCfg[image].get('wave_stop', False),
+                                                     nBuffers=sharedImageCfg[image].get('n_buffers', 3))
                 self.imageParams.sharedImageNames[i] = <char*>malloc(STRBUF*sizeof(char*))
-                strcpy(self.imageParams.sharedImageNames[i], image.encode('UTF-8'))
+                strcpy(self.imageParams.sharedImageNames[i], self.shmNames[image].encode('UTF-8'))
 
         #INITIALIZE EVENT BUFFER
         print 'initializing event buffer...'
@@ -226,13 +485,19 @@ cdef class Packetmaster(object):
             self.eventBuffParams.nRows = self.nRows
             self.eventBuffParams.nCols = self.nCols
             self.eventBuffParams.wavecal = &(self.wavecal)
-            self.eventBuffer = EventBuffer(eventBuffCfg['name'], eventBuffCfg['size'])
-            strcpy(self.eventBuffParams.bufferName, eventBuffCfg['name'].encode('UTF8'))
+            self.eventBuffer = EventBuffer(self.shmNames[eventBuffCfg['name']], eventBuffCfg['size'],
+                                           eventBuffCfg.get('layout', 'aos'))
+            strcpy(self.eventBuffParams.bufferName, self.shmNames[eventBuffCfg['name']].encode('UTF8'))
 
         #INITIALIZE WAVECAL
         print 'initializing wavecal...'
-        self.wavecal.data = <wvlcoeff_t*>malloc(N_WVL_COEFFS*sizeof(wvlcoeff_t)*npix)
-        memset(self.wavecal.data, 0, N_WVL_COEFFS*sizeof(wvlcoeff_t)*npix)
+        self.wavecal.nCols = self.nCols
+        self.wavecal.nRows = self.nRows
+        for i in range(2):
+            self.wavecal.tables[i].data = <wvlcoeff_t*>malloc(N_WVL_COEFFS*sizeof(wvlcoeff_t)*npix)
+            if self.wavecal.tables[i].data == NULL:
+                raise MemoryError('Could not allocate wavecal table')
+            memset(self.wavecal.tables[i].data, 0, N_WVL_COEFFS*sizeof(wvlcoeff_t)*npix)
         if wvlCoeffs is not None:
             if beammap is None:
                 raise Exception('Must provide a beammap to use a wavecal')
@@ -241,49 +506,70 @@ cdef class Packetmaster(object):
 
 
         #INITIALIZE QUIT SEM
-        strcpy(self.imageParams.quitSemName, QUIT_SEM_NAME.encode('UTF-8'))
-        strcpy(self.eventBuffParams.quitSemName, QUIT_SEM_NAME.encode('UTF-8'))
-        strcpy(self.writerParams.quitSemName, QUIT_SEM_NAME.encode('UTF-8'))
-        strcpy(self.readerParams.quitSemName, QUIT_SEM_NAME.encode('UTF-8'))
-
-        #INITIALIZE PACKBUF SEM
-        strcpy(self.imageParams.ringBufResetSemName, RINGBUF_RESET_SEM_NAME.encode('UTF-8'))
-        strcpy(self.eventBuffParams.ringBufResetSemName, RINGBUF_RESET_SEM_NAME.encode('UTF-8'))
-        strcpy(self.writerParams.ringBufResetSemName, RINGBUF_RESET_SEM_NAME.encode('UTF-8'))
-        strcpy(self.readerParams.ringBufResetSemName, RINGBUF_RESET_SEM_NAME.encode('UTF-8'))
+        strcpy(self.imageParams.quitSemName, self.quitSemName.encode('UTF-8'))
+        strcpy(self.eventBuffParams.quitSemName, self.quitSemName.encode('UTF-8'))
+        strcpy(self.writerParams.quitSemName, self.quitSemName.encode('UTF-8'))
+        for i in range(self.nReaders):
+            strcpy(self.readerParams[i].quitSemName, self.quitSemName.encode('UTF-8'))
 
         #SETUP IP FORWARDING
-        self.samplicatorProcess = None
         if forwarding is not None:
-            if port == forwarding['localport']:
-                raise Exception('forwarding["localport"] and "port" must be different!')
-            argstring = ['samplicate', '-p', str(port), LO_IP+'/'+str(forwarding['localport']), 
-                            forwarding['destIP']+'/'+str(forwarding['destport'])]
-            self.samplicatorProcess = subprocess.Popen(argstring)
-            port = forwarding['localport']
-            
+            self._setupForwarding(forwarding, maximizePriority, cpuOffset)
+        strcpy(self.forwarderParams.quitSemName, self.quitSemName.encode('UTF-8'))
+
         #INITIALIZE REMAINING PARAMS
-        self.readerParams.port = port
-        self.readerParams.packBuf = &self.packBuf
-        self.nThreads = 1
+        initRingBufNotifier(&self.notifier, wakeBytes, consumerWaitUs)
+        for i in range(self.nReaders):
+            self.readerParams[i].notifier = &self.notifier
+            self.readerParams[i].port = ports[i]
+            self.readerParams[i].reusePort = int(reusePort)
+            self.readerParams[i].batchSize = recvBatchSize
+            self.readerParams[i].packBuf = &(self.packBufs[i])
+        self.nThreads = self.nReaders
         if useWriter:
+            if writerCfg is None:
+                writerCfg = {}
             self.writerParams.writing = 0
-            self.writerParams.packBuf = &self.packBuf
+            self.writerParams.writeBehind = int(writerCfg.get('write_behind', True))
+            self.writerParams.directIO = int(writerCfg.get('direct_io', False))
+            self.writerParams.fsyncFiles = int(writerCfg.get('fsync', True))
+            self.writerParams.preallocBytes = int(writerCfg.get('prealloc_mb', 0)*1024*1024)
+            self.writerParams.blockSize = int(writerCfg.get('buffer_mb', 8)*1024*1024)
+            self.writerParams.nBlocks = int(writerCfg.get('n_buffers', 16))
+            self.writerParams.writeIndex = int(writerCfg.get('index', True))
+            self.writerParams.compressLevel = int(writerCfg.get('compress_level', 0))
+            self.writerParams.nCompressThreads = int(writerCfg.get('compress_threads', 4))
+            self.writerParams.nRows = self.nRows
+            self.writerParams.nCols = self.nCols
+            self.writerParams.packBufs = self.packBufs
+            self.writerParams.nPackBufs = self.nReaders
+            self.writerParams.notifier = &self.notifier
             self.nThreads += 1
         if self.sharedImages:
-            self.imageParams.packBuf = &self.packBuf
+            self.imageParams.packBufs = self.packBufs
+            self.imageParams.nPackBufs = self.nReaders
+            self.imageParams.notifier = &self.notifier
             self.nThreads += 1
         if self.eventBuffer:
             self.nThreads += 1
-            self.eventBuffParams.packBuf = &self.packBuf
+            self.eventBuffParams.packBufs = self.packBufs
+            self.eventBuffParams.nPackBufs = self.nReaders
+            self.eventBuffParams.notifier = &self.notifier
+        if self.forwarderParams.nDests:
+            self.nThreads += 1
+            self.forwarderParams.packBufs = self.packBufs
+            self.forwarderParams.nPackBufs = self.nReaders
+            self.forwarderParams.notifier = &self.notifier
 
         #START THREADS
         self.threads = <THREAD_PARAMS*>malloc((self.nThreads)*sizeof(THREAD_PARAMS))
 
-        resetSem(QUIT_SEM_NAME.encode('UTF-8'))
-        resetSem(RINGBUF_RESET_SEM_NAME.encode('UTF-8'))
-        startReaderThread(&(self.readerParams), &(self.threads[0]))
-        threadNum = 1
+        resetSem(self.quitSemName.encode('UTF-8'))
+        for i in range(self.nReaders):
+            initRingBuf(&(self.packBufs[i]))
+        for i in range(self.nReaders):
+            startReaderThread(&(self.readerParams[i]), &(self.threads[i]))
+        threadNum = self.nReaders
         print 'starting shared image thread'
         if self.sharedImages:
             startShmImageWriterThread(&(self.imageParams), &(self.threads[threadNum]))
@@ -292,76 +578,306 @@ cdef class Packetmaster(object):
         if self.eventBuffer:
             startEventBuffWriterThread(&(self.eventBuffParams), &(self.threads[threadNum]))
             threadNum += 1
+        if self.forwarderParams.nDests:
+            startForwarderThread(&(self.forwarderParams), &(self.threads[threadNum]))
+            threadNum += 1
         if useWriter:
             startBinWriterThread(&(self.writerParams), &(self.threads[threadNum]))
 
+    def _setupForwarding(self, forwarding, maximizePriority, cpuOffset):
+        """ Fills forwarderParams from the forwarding config, see __init__ """
+        cdef FORWARD_DEST *dest
+        if 'destinations' in forwarding:
+            destinations = list(forwarding['destinations'])
+        else:
+            if 'localport' in forwarding:
+                getLogger(__name__).info('forwarding["localport"] is not used by the built in forwarder')
+            destinations = [{'host': forwarding['destIP'], 'port': forwarding['destport']}]
+        if not 1 <= len(destinations) <= MAX_FORWARD_DESTS:
+            raise ValueError('forwarding needs 1 to {} destinations'.format(MAX_FORWARD_DESTS))
+
+        memset(&self.forwarderParams, 0, sizeof(FORWARDER_PARAMS))
+        for i, cfg in enumerate(destinations):
+            dest = &(self.forwarderParams.dests[i])
+            host = str(cfg['host'])
+            if len(host) >= STRBUF:
+                raise ValueError('Forwarding host name too long: {}'.format(host))
+            strcpy(dest.host, host.encode('UTF-8'))
+            dest.port = int(cfg['port'])
+            roaches = cfg.get('roaches', None)
+            dest.allRoaches = int(roaches is None)
+            for roach in roaches or []:
+                if not 0 <= roach < MAX_ROACHES:
+                    raise ValueError('Forwarding roach numbers must be between 0 and {}'.format(MAX_ROACHES - 1))
+                dest.roaches[roach] = 1
+            region = cfg.get('region', None)
+            if region is not None:
+                dest.useRegion = 1
+                dest.xMin, dest.xMax, dest.yMin, dest.yMax = [int(r) for r in region]
+        self.forwarderParams.nDests = len(destinations)
+        self.forwarderParams.sendBufBytes = int(forwarding.get('send_buffer_mb', FORWARD_SEND_BUFFER_MB)*1024*1024)
+        cpu = forwarding.get('cpu', None)
+        self.forwarderParams.cpu = cpu + cpuOffset if maximizePriority and cpu is not None else -1
+
+    def _shmName(self, name):
+        """ Name of the shared memory object for the configured image or event buffer name """
+        name = name.lstrip('/')
+        return '{}.{}'.format(self.instanceName, name) if self.instanceName else name
+
     def startWriting(self, binDir=None):
+        """
+        Start writing .bin files to binDir (in <binDir>/<instanceName>/ if this instance is
+        named), or to the last binDir if None.
+        """
         if binDir is not None:
+            if self.instanceName:
+                binDir = os.path.join(binDir, self.instanceName)
+                if not os.path.isdir(binDir):
+                    os.makedirs(binDir)
+            binDir = os.path.join(binDir, '')
+            if len(binDir) >= STRBUF - 20:
+                raise ValueError('binDir must be shorter than {} characters'.format(STRBUF - 20))
             strcpy(self.writerParams.writerPath, binDir.encode('UTF-8'))
         self.writerParams.writing = 1
 
     def stopWriting(self):
         self.writerParams.writing = 0
 
+    @property
+    def readerStats(self):
+        """
+        List of receive counters, one dict per reader thread. framesPerCall is the mean number of
+        frames returned per syscall (1 unless batched receive is enabled).
+        """
+        cdef READER_STATS stats
+        allStats = []
+        for i in range(self.nReaders):
+            stats = self.readerParams[i].stats
+            allStats.append({'port': self.readerParams[i].port, 'nRecvCalls': stats.nRecvCalls,
+                             'nFrames': stats.nFrames, 'nBytes': stats.nBytes,
+                             'lastBatchFrames': stats.lastBatchFrames, 'lastBatchBytes': stats.lastBatchBytes,
+                             'framesPerCall': float(stats.nFrames)/stats.nRecvCalls if stats.nRecvCalls else 0.})
+        return allStats
+
+    def telemetry(self):
+        """
+        Snapshot of packetmaster's health, cheap enough to poll every second or so. Rates are 
+        averaged since the previous call (0 on the first).
+
+        Returns a dict with
+            roaches: {roach number: dict} for every roach that has sent data, with packets, 
+                photons, packetRate and photonRate (per s), frameGaps (times the header frame 
+                counter skipped), framesMissed (packets lost in those gaps, i.e. dropped before 
+                reaching packetmaster), outOfOrder and lastTimestamp (header units).
+            receiveRate: MB/s received over all readers
+            consumers: {thread: dict} with ringBacklog (bytes received but not yet processed), 
+                maxRingBacklog, ringFill (backlog as a fraction of a ring; data is lost at 1) 
+                and packetsMissed (overwritten before being processed; bytesMissed for the 
+                binWriter). Backlogs are summed over rings when there are several readers.
+            ringFill: the largest consumer ringFill
+            imageLatency: dict with nFrames, last, mean and max seconds from the first roach 
+                passing the end of a shared image frame to the frame being done. None without
+                shared images.
+            forwarding: forwarderStats, None if not forwarding
+        """
+        cdef ROACH_STATS rs
+        cdef int i, roach
+        now = time.time()
+        roaches = {}
+        nBytes = 0
+        for i in range(self.nReaders):
+            nBytes += self.readerParams[i].stats.nBytes
+            for roach in range(MAX_ROACHES):
+                rs = self.readerParams[i].roachStats[roach]
+                if not rs.seen:
+                    continue
+                stats = roaches.setdefault(roach, {'packets': 0, 'photons': 0, 'frameGaps': 0, 'framesMissed': 0,
+                                                   'outOfOrder': 0, 'lastTimestamp': 0})
+                stats['packets'] += rs.nPackets
+                stats['photons'] += rs.nPhotons
+                stats['frameGaps'] += rs.nFrameGaps
+                stats['framesMissed'] += rs.nFramesMissed
+                stats['outOfOrder'] += rs.nOutOfOrder
+                stats['lastTimestamp'] = max(stats['lastTimestamp'], rs.lastTimestamp)
+
+        last = self.lastTelemetry
+        dt = now - last['time'] if last is not None else 0
+        for roach, stats in roaches.items():
+            prev = last['roaches'].get(roach, {'packets': 0, 'photons': 0}) if last is not None else None
+            stats['packetRate'] = (stats['packets'] - prev['packets'])/dt if dt > 0 else 0.
+            stats['photonRate'] = (stats['photons'] - prev['photons'])/dt if dt > 0 else 0.
+
+        consumers = {}
+        if self.writerParams.packBufs != NULL:
+            consumers['binWriter'] = {'ringBacklog': self.writerParams.stats.ringBacklog,
+                                      'maxRingBacklog': self.writerParams.stats.maxRingBacklog,
+                                      'ringFill': float(self.writerParams.stats.ringBacklog)/RINGBUF_SIZE,
+                                      'bytesMissed': self.writerParams.stats.nBytesMissed}
+        if self.sharedImages:
+            consumers['shmImageWriter'] = _consumerStatsDict(self.imageParams.stats)
+        if self.eventBuffer:
+            consumers['eventBuffWriter'] = _consumerStatsDict(self.eventBuffParams.stats)
+        if self.forwarderParams.nDests:
+            consumers['forwarder'] = _consumerStatsDict(self.forwarderParams.stats)
+
+        imageLatency = None
+        if self.sharedImages:
+            lat = self.imageParams.latencyStats
+            imageLatency = {'nFrames': lat.nFrames, 'last': lat.lastLatencyNs/1.e9, 'max': lat.maxLatencyNs/1.e9,
+                            'mean': lat.latencyNs/1.e9/lat.nFrames if lat.nFrames else 0.}
+
+        self.lastTelemetry = {'time': now, 'roaches': roaches, 'nBytes': nBytes}
+        return {'roaches': roaches, 'consumers': consumers, 'imageLatency': imageLatency,
+                'forwarding': self.forwarderStats,
+                'receiveRate': (nBytes - last['nBytes'])/1.e6/dt if dt > 0 else 0.,
+                'ringFill': max([c['ringFill'] for c in consumers.values()] or [0.])}
+
+    @property
+    def waitStats(self):
+        """
+        Idle behavior of the consumer threads, keyed by thread. cpuFraction is thread cpu time 
+        over wall time, wake latency is from a reader posting data to the consumer running. 
+        Updated whenever a thread sleeps, so values are stale while a thread is saturated.
+        """
+        report = {}
+        if self.writerParams.packBufs != NULL:
+            report['binWriter'] = _waitStatsDict(self.writerParams.waitStats)
+        if self.sharedImages:
+            report['shmImageWriter'] = _waitStatsDict(self.imageParams.waitStats)
+        if self.eventBuffer:
+            report['eventBuffWriter'] = _waitStatsDict(self.eventBuffParams.waitStats)
+        if self.forwarderParams.nDests:
+            report['forwarder'] = _waitStatsDict(self.forwarderParams.waitStats)
+        return report
+
+    @property
+    def forwarderStats(self):
+        """
+        Packets and bytes forwarded, one dict per destination. dropped counts packets the 
+        forwarder could not send (socket buffer full or destination unreachable), filtered
+        those skipped by the roach or region filter. None if not forwarding.
+        """
+        cdef FORWARD_DEST dest
+        if not self.forwarderParams.nDests:
+            return None
+        allStats = []
+        for i in range(self.forwarderParams.nDests):
+            dest = self.forwarderParams.dests[i]
+            allStats.append({'host': dest.host.decode('UTF-8'), 'port': dest.port, 'sent': dest.nPacketsSent,
+                             'bytesSent': dest.nBytesSent, 'dropped': dest.nPacketsDropped,
+                             'filtered': dest.nPacketsFiltered,
+                             'packetsPerCall': float(dest.nPacketsSent)/dest.nSendCalls if dest.nSendCalls else 0.})
+        return allStats
+
+    @property
+    def eventBufferStats(self):
+        """
+        Number of photons streamed into the event buffer and the number of batched updates
+        (each update posts the new photon semaphores once). None if there is no event buffer.
+        """
+        if not self.eventBuffer:
+            return None
+        return {'nEvents': self.eventBuffParams.nEventsWritten, 'nBatches': self.eventBuffParams.nBatches,
+                'eventsPerBatch': float(self.eventBuffParams.nEventsWritten)/self.eventBuffParams.nBatches
+                                  if self.eventBuffParams.nBatches else 0.}
+
+    @property
+    def binWriterStats(self):
+        """
+        Throughput and health of the .bin writer. None if the writer isn't running.
+        rate is MB/s received over the last complete file (second); diskRate is MB/s while
+        in write calls. backlog is data staged for the write behind thread but not yet 
+        written, ringBacklog is data in the ring buffers not yet picked up by the writer 
+        (once it exceeds the ring size data is lost and counted in bytesMissed). nStalls
+        counts the times the writer had to wait for a free staging buffer. When compressing,
+        bytesWritten and diskRate refer to the compressed data, compressionRatio is raw over
+        compressed size and compressRate is MB/s of raw data per compression thread. Sizes in
+        bytes, times in seconds.
+        """
+        cdef BIN_WRITER_STATS stats
+        if self.writerParams.packBufs == NULL:
+            return None
+        stats = self.writerParams.stats
+        return {'bytesWritten': stats.nBytesWritten, 'bytesMissed': stats.nBytesMissed,
+                'nFiles': stats.nFiles, 'nWriteErrors': stats.nWriteErrors,
+                'rate': stats.lastSecondBytes/1.e6,
+                'diskRate': stats.nBytesWritten/1.e3/stats.writeNs if stats.writeNs else 0.,
+                'nFsyncs': stats.nFsyncs, 'lastFsyncLatency': stats.lastFsyncNs/1.e9,
+                'meanFsyncLatency': stats.fsyncNs/1.e9/stats.nFsyncs if stats.nFsyncs else 0.,
+                'maxFsyncLatency': stats.maxFsyncNs/1.e9,
+                'backlog': stats.queuedBytes, 'maxBacklog': stats.maxQueuedBytes,
+                'ringBacklog': stats.ringBacklog, 'maxRingBacklog': stats.maxRingBacklog,
+                'nStalls': stats.nStalls, 'stallTime': stats.stallNs/1.e9,
+                'writeBehind': bool(self.writerParams.writeBehind), 
+                'directIO': bool(self.writerParams.directIO),
+                'compressLevel': self.writerParams.compressLevel,
+                'compressionRatio': float(stats.compressRawBytes)/stats.compressOutBytes
+                                    if stats.compressOutBytes else 0.,
+                'compressRate': stats.compressRawBytes/1.e3/stats.compressNs if stats.compressNs else 0.}
+
     def applyWvlSol(self, wvlCoeffs, beammap):
         """
         Fills packetmaster's wavecal buffer with coefficients specified in wvlCoeffs.
-        (Should be!) safe to use while packetmaster threads are running, though
-        data will be invalid while writing.
+        Safe to use while packetmaster threads are running: the coefficients are written
+        to the spare table, then wavecalGeneration is incremented to make it current. Threads
+        switch between packets, so every packet is calibrated entirely with either the old or
+        the new solution. Images keep integrating; frames spanning the switch are flagged
+        (ImageCube.frameHeader wavecalMixed) rather than invalidated. Pixels whose resID isn't
+        in wvlCoeffs get zero coefficients.
 
         Parameters
         ----------
             wvlCoeffs: coefficient dict saved by wavecal Solution
             beamap: beammap object
+
+        Returns
+        -------
+            The new wavecalGeneration
         """
-        self.wavecal.nCols = self.nCols
-        self.wavecal.nRows = self.nRows
-        strcpy(self.wavecal.solutionFile, str(wvlCoeffs['solution_file_path']).encode('UTF-8'))
-
-        for image in self.sharedImages:
-            self.sharedImages[image].invalidate()
-
-        calCoeffs = wvlCoeffs['calibrations']
-        calResIDs = wvlCoeffs['res_ids']
-        a = np.zeros((self.nRows, self.nCols))
-        b = np.zeros((self.nRows, self.nCols))
-        c = np.zeros((self.nRows, self.nCols))
-        resIDMap = beammap.residmap.T
-
-        for i,j in np.ndindex(self.nRows, self.nCols):
-            curCoeffs = calCoeffs[resIDMap[i,j]==calResIDs]
-            if curCoeffs.size:
-                curCoeffs = curCoeffs[0]
-                a[i,j] = curCoeffs[0]
-                b[i,j] = curCoeffs[1]
-                c[i,j] = curCoeffs[2]
-
-        a = a.flatten()
-        b = b.flatten()
-        c = c.flatten()
-
-        coeffArray = np.zeros(N_WVL_COEFFS*self.nRows*self.nCols)
-        coeffArray[0::3] = a
-        coeffArray[1::3] = b
-        coeffArray[2::3] = c
-        coeffArray = coeffArray.astype(np.single) #convert to float (ASSUMES wvlcoeff_t is float!)
-
-        self.wavecal.writing = 1
-        memcpy(self.wavecal.data, <wvlcoeff_t*>np.PyArray_DATA(coeffArray), N_WVL_COEFFS*self.nRows*self.nCols*sizeof(wvlcoeff_t))
-        self.wavecal.writing = 0
+        cdef np.ndarray[np.float32_t, ndim=2] coeffArray
+        cdef WAVECAL_TABLE *spare
+
+        calCoeffs = np.asarray(wvlCoeffs['calibrations'])
+        calResIDs = np.asarray(wvlCoeffs['res_ids']).ravel()
+        resIDs = np.asarray(beammap.residmap.T).ravel() #pixel nCols*y + x
+
+        # stable sort so a resID listed twice gets its first entry
+        order = np.argsort(calResIDs, kind='mergesort')
+        sortedResIDs = calResIDs[order]
+        coeffArray = np.zeros((self.nRows*self.nCols, N_WVL_COEFFS), dtype=np.single) #ASSUMES wvlcoeff_t is float!
+        if sortedResIDs.size:
+            calInds = np.minimum(np.searchsorted(sortedResIDs, resIDs), sortedResIDs.size - 1)
+            found = sortedResIDs[calInds] == resIDs
+            coeffArray[found] = calCoeffs[order[calInds[found]], :N_WVL_COEFFS]
+        solutionFile = str(wvlCoeffs['solution_file_path']).encode('UTF-8')[:STRBUF - 1]
+
+        # threads move on from a table at their next packet, so the one replaced by the last 
+        # update is free to refill
+        spare = &(self.wavecal.tables[(self.wavecal.generation + 1) % 2])
+        memcpy(spare.data, &coeffArray[0, 0], N_WVL_COEFFS*self.nRows*self.nCols*sizeof(wvlcoeff_t))
+        strcpy(spare.solutionFile, solutionFile)
+        self.wavecal.generation += 1 #publishes spare; the image writer also rebuilds its wavelength bin tables
+        return self.wavecal.generation
+
+    @property
+    def wavecalGeneration(self):
+        """ Number of wavelength solutions applied, 0 if none. Stamped into shared image frames. """
+        return self.wavecal.generation
 
     def quit(self):
         """ Exit all threads """
-        quitAllThreads(QUIT_SEM_NAME.encode('UTF-8'), self.nThreads)
-        if self.samplicatorProcess is not None:
-            self.samplicatorProcess.terminate()
+        quitAllThreads(self.quitSemName.encode('UTF-8'), self.nThreads)
+        sem_unlink(self.quitSemName.encode('UTF-8')) #threads already have it open
 
     def __dealloc__(self):
         for i in range(len(self.sharedImages)):
             free(self.imageParams.sharedImageNames[i])
         free(self.imageParams.sharedImageNames)
         free(self.threads)
-        free(self.wavecal.data)
+        free(self.readerParams)
+        free(self.packBufs)
+        free(self.wavecal.tables[0].data)
+        free(self.wavecal.tables[1].data)
         
 
 
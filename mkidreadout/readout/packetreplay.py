@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+"""
+Offline load generator for packetmaster.
+
+Streams photon packets laid out like the ROACH2 firmware's (STREAM_HEADER and PHOTON_WORD in
+pmthreads.h) over UDP, paced by their header timestamps. Packets come either from recorded
+.bin/.binz files or are synthesized at a given photon rate per roach over an nRows x nCols
+array. By default header timestamps are rewritten to the time each packet is sent, so
+packetmaster sees a live stream and image latencies are meaningful.
+
+With --bench a Packetmaster is started in this process (writing .bin files to a scratch
+directory and integrating a continuous shared image) and the tool reports the reader drop
+rate, image latency and writer throughput, e.g.
+
+    packetreplay.py synth --roaches 10 --rate 2e6 --duration 20 --bench
+    packetreplay.py replay /data/1563000000.bin --bench --writer-cfg compress_level=1
+
+Without --bench packets go to host:port for a packetmaster (or dashboard) running elsewhere.
+"""
+from __future__ import division, print_function
+
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from mkidcore.corelog import getLogger, create_log
+from mkidreadout.readout.binfile import TICKS_PER_SEC, RAD_TO_DEG, PHASE_BIN_PT, openBin, tsOffset
+
+MAX_PHOTONS_PER_PACKET = 100
+HEADER_START = np.uint64(0xff) << np.uint64(56)
+HEADER_TS_MASK = np.uint64(2**36 - 1)
+SEND_BUFFER_BYTES = 8*1024*1024
+LATE_SEC = 0.001  # a packet sent more than this after its scheduled time counts as late
+
+
+def makeHeaders(roach, frame, timestamp):
+    """ Header words (native uint64, as read back from the big endian stream) """
+    return (HEADER_START | (np.asarray(roach, dtype=np.uint64) << np.uint64(48)) |
+            ((np.asarray(frame, dtype=np.uint64) & np.uint64(0xfff)) << np.uint64(36)) |
+            (np.asarray(timestamp, dtype=np.uint64) & HEADER_TS_MASK))
+
+
+def makePhotons(x, y, us, phase, baseline):
+    """ Photon words for phase and baseline in degrees, us the time within the 0.5 ms tick """
+    phase = np.round(np.asarray(phase)/RAD_TO_DEG*PHASE_BIN_PT).astype(np.int64) & (2**18 - 1)
+    baseline = np.round(np.asarray(baseline)/RAD_TO_DEG*PHASE_BIN_PT).astype(np.int64) & (2**17 - 1)
+    return ((np.asarray(x, dtype=np.uint64) << np.uint64(54)) | (np.asarray(y, dtype=np.uint64) << np.uint64(44)) |
+            (np.asarray(us, dtype=np.uint64) << np.uint64(35)) | (phase.astype(np.uint64) << np.uint64(17)) |
+            baseline.astype(np.uint64))
+
+
+class PacketChunk(object):
+    """
+    A run of packets ready to send. words holds the stream (big endian), packet i is
+    words[starts[i]:starts[i+1]] and goes out at tick ticks[i] (0.5 ms units from the start
+    of the stream, not decreasing). Each packet's header is words[starts[i]].
+    """
+    def __init__(self, words, starts, ticks):
+        self.words = words
+        self.starts = starts
+        self.ticks = ticks
+
+    @property
+    def nPackets(self):
+        return len(self.ticks)
+
+    def restamp(self, firstTick, speed=1.):
+        """ Sets each header timestamp to the tick it is sent at, firstTick + ticks/speed """
+        headers = self.words[self.starts[:-1]].astype(np.uint64)
+        ticks = firstTick + np.round(self.ticks/speed).astype(np.int64)
+        self.words[self.starts[:-1]] = (headers & ~HEADER_TS_MASK) | ticks.astype(np.uint64)
+
+
+class SyntheticSource(object):
+    """
+    Poisson photon streams from nRoach roaches, each covering an equal slice of an
+    nRows x nCols array with photonRate photons/s. Every roach sends at least one packet
+    (possibly empty) per 0.5 ms tick, like the firmware, and at most
+    MAX_PHOTONS_PER_PACKET photons per packet. Phases are uniform in [-120, -40) degrees.
+    """
+    def __init__(self, nRoach, nRows, nCols, photonRate, seed=None):
+        self.nRoach = nRoach
+        self.nRows = nRows
+        self.nCols = nCols
+        self.photonRate = photonRate
+        self.random = np.random.RandomState(seed)
+        self._frames = np.zeros(nRoach, dtype=np.int64)
+        self._tick = 0
+        edges = np.linspace(0, nRows*nCols, nRoach + 1).astype(int)
+        self._pixStart = edges[:-1]
+        self._pixCount = np.maximum(np.diff(edges), 1)
+
+    def chunks(self, chunkTicks=200):
+        while True:
+            yield self.makeChunk(chunkTicks)
+
+    def makeChunk(self, nTicks):
+        # group = (tick, roach), in send order
+        counts = self.random.poisson(self.photonRate/TICKS_PER_SEC, size=nTicks*self.nRoach)
+        groupRoach = np.tile(np.arange(self.nRoach), nTicks)
+        groupTick = np.repeat(np.arange(nTicks), self.nRoach) + self._tick
+        nPackets = np.maximum(1, -(-counts//MAX_PHOTONS_PER_PACKET))
+
+        packGroup = np.repeat(np.arange(len(counts)), nPackets)
+        packInGroup = np.arange(len(packGroup)) - np.repeat(np.cumsum(nPackets) - nPackets, nPackets)
+        packPhotons = np.clip(counts[packGroup] - packInGroup*MAX_PHOTONS_PER_PACKET, 0, MAX_PHOTONS_PER_PACKET)
+        starts = np.concatenate(([0], np.cumsum(packPhotons + 1)))
+        packRoach = groupRoach[packGroup]
+
+        frames = np.empty(len(packGroup), dtype=np.int64)
+        for roach in range(self.nRoach):
+            mine = np.flatnonzero(packRoach == roach)
+            frames[mine] = self._frames[roach] + np.arange(len(mine))
+            self._frames[roach] += len(mine)
+
+        words = np.empty(starts[-1], dtype='>u8')
+        words[starts[:-1]] = makeHeaders(packRoach, frames, groupTick[packGroup])
+        isPhoton = np.ones(starts[-1], dtype=bool)
+        isPhoton[starts[:-1]] = False
+
+        nPhotons = counts.sum()
+        photonGroup = np.repeat(np.arange(len(counts)), counts)
+        photonRoach = groupRoach[photonGroup]
+        us = np.sort(self.random.randint(0, 500, nPhotons) + 500*photonGroup) - 500*photonGroup
+        pix = self._pixStart[photonRoach] + (self.random.random_sample(nPhotons)*self._pixCount[photonRoach]).astype(int)
+        words[isPhoton] = makePhotons(pix % self.nCols, pix//self.nCols, us,
+                                      self.random.uniform(-120, -40, nPhotons),
+                                      self.random.normal(-2, 0.5, nPhotons))
+
+        self._tick += nTicks
+        return PacketChunk(words, starts, groupTick[packGroup])
+
+
+class BinReplaySource(object):
+    """
+    Packets from recorded .bin (or .binz) files, in file order, scheduled by their header
+    timestamps relative to the first packet. With loop the files are replayed back to back
+    forever, each pass continuing the schedule of the last.
+    """
+    def __init__(self, binfiles, loop=False):
+        self.binfiles = binfiles
+        self.loop = loop
+
+    def chunks(self, chunkTicks=200):
+        tickOffset = None
+        while True:
+            lastTick = 0
+            for binfile in self.binfiles:
+                with openBin(binfile) as f:
+                    data = f.read()
+                words = np.frombuffer(data[:len(data) - len(data) % 8], dtype='>u8').copy()
+                headerInds = np.flatnonzero((words >> np.uint64(56)) == np.uint64(0xff))
+                if len(headerInds) == 0:
+                    getLogger(__name__).warning('No packets in {}'.format(binfile))
+                    continue
+                starts = np.append(headerInds, len(words))
+                ticks = (words[headerInds] & HEADER_TS_MASK).astype(np.int64)
+                if tickOffset is None:
+                    tickOffset = -ticks[0]
+                ticks = np.maximum.accumulate(ticks + tickOffset)  # roaches aren't perfectly in step
+                lastTick = ticks[-1]
+                for first in range(0, len(headerInds), 10*chunkTicks):
+                    last = min(first + 10*chunkTicks, len(headerInds))
+                    yield PacketChunk(words[starts[first]:starts[last]], starts[first:last + 1] - starts[first],
+                                      ticks[first:last])
+            if not self.loop:
+                return
+            tickOffset += lastTick + 1
+
+
+class PacketSender(object):
+    """
+    Sends PacketChunks to host:port, each packet at its scheduled tick (scaled by 1/speed)
+    after start. Sleeps until shortly before a tick is due, then spins, then sends all of that
+    tick's packets back to back.
+
+    stats after run: nPackets, nBytes, elapsed (s), nLate (packets sent more than LATE_SEC
+    behind schedule), maxLag (s), and rate (MB/s).
+    """
+    def __init__(self, port, host='127.0.0.1', speed=1., restamp=True):
+        self.address = (host, port)
+        self.speed = speed
+        self.restamp = restamp
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_BYTES)
+        self.stats = {'nPackets': 0, 'nBytes': 0, 'elapsed': 0., 'nLate': 0, 'maxLag': 0., 'rate': 0.}
+        self.stopped = threading.Event()
+        self.done = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self, chunks, duration=None):
+        stats = self.stats
+        start = time.time()
+        firstTick = int(round((start - tsOffset(start))*TICKS_PER_SEC))
+        secPerTick = 1./TICKS_PER_SEC/self.speed
+        sendto = self.sock.sendto
+        for chunk in chunks:
+            if self.stopped.is_set() or (duration is not None and chunk.ticks[0]*secPerTick >= duration):
+                break
+            if self.restamp:
+                chunk.restamp(firstTick, self.speed)
+            data = memoryview(chunk.words.view(np.uint8))
+            offsets = (8*chunk.starts).tolist()
+            tickStarts = np.concatenate(([0], np.flatnonzero(np.diff(chunk.ticks)) + 1, [chunk.nPackets]))
+            due = (start + chunk.ticks[tickStarts[:-1]]*secPerTick).tolist()
+            tickStarts = tickStarts.tolist()
+            for i, t in enumerate(due):
+                now = time.time()
+                if t - now > 0.002:
+                    time.sleep(t - now - 0.001)
+                while now < t:
+                    now = time.time()
+                if now - t > LATE_SEC:
+                    stats['nLate'] += tickStarts[i + 1] - tickStarts[i]
+                stats['maxLag'] = max(stats['maxLag'], now - t)
+                for j in range(tickStarts[i], tickStarts[i + 1]):
+                    stats['nBytes'] += sendto(data[offsets[j]:offsets[j + 1]], self.address)
+            stats['nPackets'] += chunk.nPackets
+        stats['elapsed'] = time.time() - start
+        stats['rate'] = stats['nBytes']/1.e6/stats['elapsed'] if stats['elapsed'] else 0.
+        self.done.set()
+        return stats
+
+
+def _receiveFrames(image, sender, latencies):
+    """ Collects frame latencies from a continuous image until sender is done """
+    while not sender.done.is_set():
+        try:
+            image.receiveImage(copy=False)
+        except RuntimeError:
+            continue
+        header = image.frameHeader
+        if header is not None:
+            latencies.append(header['doneTime'] - header['startTime'] - header['integrationTime'])
+
+
+def benchmark(sources, nRoach, nRows, nCols, port=50000, duration=10., speed=1., integrationTime=0.1,
+              writerCfg=None, binDir=None, **packetmasterKwargs):
+    """
+    Runs a Packetmaster in this process against source and returns a dict of sender stats,
+    reader drop rate, image latency and writer stats. Given a list of sources, runs one named
+    Packetmaster instance per source side by side, on consecutive ports, and returns a list 
+    of reports.
+
+    Parameters
+    ----------
+        sources: SyntheticSource or BinReplaySource, or a list of them
+        nRoach, nRows, nCols: int
+            Packetmaster array configuration
+        port: int
+            UDP port the (first) packetmaster listens on
+        duration: float
+            Seconds of stream to send
+        speed: float
+            Replay speed, 2 sends packets twice as fast as their timestamps say
+        integrationTime: float
+            Frame time (s) of the continuous shared image used to measure latency, i.e. the
+            time from the end of a frame's integration to packetmaster finishing it.
+        writerCfg: dict
+            Passed to Packetmaster
+        binDir: str
+            Where the writer puts .bin files; a scratch directory, removed afterwards, if None
+        packetmasterKwargs:
+            Any other Packetmaster arguments (recvBatchSize, nReaders, ...)
+    """
+    from mkidreadout.readout.packetmaster import Packetmaster
+
+    log = getLogger(__name__)
+    single = not isinstance(sources, (list, tuple))
+    if single:
+        sources = [sources]
+    scratch = binDir is None
+    if scratch:
+        binDir = tempfile.mkdtemp(prefix='packetreplay')
+    imageName = 'packetreplay{}'.format(os.getpid())
+
+    packetmasters = []
+    reports = []
+    try:
+        for i in range(len(sources)):
+            packetmasters.append(Packetmaster(nRoach, port + i, nRows=nRows, nCols=nCols, useWriter=True,
+                                              writerCfg=writerCfg, sharedImageCfg={imageName: {'n_buffers': 4}},
+                                              recreate_images=True, instanceName=None if single else 'replay{}'.format(i),
+                                              **packetmasterKwargs))
+        time.sleep(0.5)
+
+        senders = []
+        threads = []
+        latencies = []
+        for i, (pm, source) in enumerate(zip(packetmasters, sources)):
+            pm.startWriting(binDir)
+            senders.append(PacketSender(port + i, speed=speed))
+            threads.append(threading.Thread(target=senders[i].run, args=(source.chunks(), duration)))
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        for pm, sender in zip(packetmasters, senders):
+            image = pm.sharedImages[imageName]
+            image.startIntegration(integrationTime=integrationTime, continuous=True)
+            latencies.append([])
+            threads.append(threading.Thread(target=_receiveFrames, args=(image, sender, latencies[-1])))
+            threads[-1].start()
+        for thread in threads:
+            thread.join()
+
+        for pm in packetmasters:
+            pm.sharedImages[imageName].stopIntegration()
+        time.sleep(1.5)  # let the writers finish the last file
+        for pm in packetmasters:
+            pm.stopWriting()
+        time.sleep(0.5)
+
+        for pm, sender, lat in zip(packetmasters, senders, latencies):
+            nReceived = sum(s['nFrames'] for s in pm.readerStats)
+            lat = np.array(lat[1:])  # the first frame starts with the stream
+            pmDir = os.path.join(binDir, pm.instanceName) if pm.instanceName else binDir
+            reports.append({'instance': pm.instanceName, 'sender': sender.stats, 'nReceived': nReceived,
+                            'dropRate': 1 - nReceived/sender.stats['nPackets'] if sender.stats['nPackets'] else 0.,
+                            'nFrames': len(lat), 'framesDropped': pm.sharedImages[imageName].framesDropped,
+                            'latencyMedian': np.median(lat) if len(lat) else np.nan,
+                            'latency99': np.percentile(lat, 99) if len(lat) else np.nan,
+                            'latencyMax': lat.max() if len(lat) else np.nan,
+                            'writer': pm.binWriterStats, 'telemetry': pm.telemetry(),
+                            'bytesOnDisk': sum(os.path.getsize(os.path.join(pmDir, f)) for f in os.listdir(pmDir)
+                                               if f.endswith(('.bin', '.binz')))})
+    finally:
+        for pm in packetmasters:
+            pm.quit()
+        if scratch:
+            shutil.rmtree(binDir, ignore_errors=True)
+    log.debug(reports)
+    return reports[0] if single else reports
+
+
+def formatReport(report):
+    sender = report['sender']
+    writer = report['writer']
+    lines = ['instance {}:'.format(report['instance'])] if report['instance'] else []
+    lines += ['sent {nPackets} packets, {nBytes} bytes in {elapsed:.2f} s ({rate:.1f} MB/s), '
+             '{nLate} late, max lag {maxLag:.4f} s'.format(**sender),
+             'received {} packets, drop rate {:.2e}'.format(report['nReceived'], report['dropRate']),
+             'image: {} frames, {} dropped, latency median {:.4f} s, 99% {:.4f} s, max {:.4f} s'.format(
+                 report['nFrames'], report['framesDropped'], report['latencyMedian'], report['latency99'],
+                 report['latencyMax'])]
+    roaches = report['telemetry']['roaches']
+    lines.append('packetmaster: {} roaches, {} packets lost upstream (frame counter gaps), {} out of order, '
+                 'image latency mean {:.4f} s'.format(len(roaches), sum(r['framesMissed'] for r in roaches.values()),
+                                                      sum(r['outOfOrder'] for r in roaches.values()),
+                                                      report['telemetry']['imageLatency']['mean']))
+    if writer is not None:
+        lines.append('writer: {} bytes written ({} on disk), {} missed, disk rate {:.1f} MB/s, '
+                     'max backlog {}, {} stalls'.format(writer['bytesWritten'], report['bytesOnDisk'],
+                                                       writer['bytesMissed'], writer['diskRate'],
+                                                       writer['maxBacklog'], writer['nStalls']))
+    return '\n'.join(lines)
+
+
+def _parseCfg(items):
+    """ {key: value} from KEY=VALUE strings, values parsed as numbers or booleans where possible """
+    cfg = {}
+    for item in items or []:
+        key, value = item.split('=', 1)
+        if value.lower() in ('true', 'false'):
+            cfg[key] = value.lower() == 'true'
+            continue
+        try:
+            cfg[key] = int(value)
+        except ValueError:
+            try:
+                cfg[key] = float(value)
+            except ValueError:
+                cfg[key] = value
+    return cfg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay or synthesize MKID photon packets over UDP')
+    sub = parser.add_subparsers(dest='mode')
+    synth = sub.add_parser('synth', help='Synthetic Poisson photon streams')
+    synth.add_argument('--roaches', type=int, default=10, help='Number of roaches')
+    synth.add_argument('--rows', type=int, default=146)
+    synth.add_argument('--cols', type=int, default=140)
+    synth.add_argument('--rate', type=float, default=1.e6, help='Photons/s per roach')
+    synth.add_argument('--seed', type=int, default=None)
+    replay = sub.add_parser('replay', help='Replay recorded .bin/.binz files')
+    replay.add_argument('binfiles', nargs='+')
+    replay.add_argument('--loop', action='store_true', help='Replay the files until --duration is up')
+    replay.add_argument('--roaches', type=int, default=10, help='Number of roaches (for --bench)')
+    replay.add_argument('--rows', type=int, default=146, help='Array rows (for --bench)')
+    replay.add_argument('--cols', type=int, default=140, help='Array columns (for --bench)')
+    for p in (synth, replay):
+        p.add_argument('--host', default='127.0.0.1')
+        p.add_argument('-p', '--port', type=int, default=50000)
+        p.add_argument('-d', '--duration', type=float, default=10., help='Seconds of stream to send')
+        p.add_argument('--speed', type=float, default=1., help='Playback speed multiplier')
+        p.add_argument('--keep-timestamps', action='store_true', help="Don't rewrite header timestamps")
+        p.add_argument('--bench', action='store_true', help='Run a Packetmaster here and report on it')
+        p.add_argument('--integration', type=float, default=0.1, help='Shared image frame time (--bench)')
+        p.add_argument('--batch', type=int, default=32, help='Packetmaster recvBatchSize (--bench)')
+        p.add_argument('--readers', type=int, default=1, help='Packetmaster reader threads (--bench)')
+        p.add_argument('--writer-cfg', nargs='*', metavar='KEY=VALUE', help='Packetmaster writerCfg (--bench)')
+        p.add_argument('--bin-dir', default=None, help='Keep .bin files here (--bench)')
+        p.add_argument('--instances', type=int, default=1,
+                       help='Independent streams to send on consecutive ports; with --bench one Packetmaster each')
+    args = parser.parse_args()
+
+    create_log('mkidreadout', console=True, fmt='%(asctime)s %(funcName)s: %(levelname)s %(message)s',
+               level='INFO')
+
+    if args.mode == 'synth':
+        sources = [SyntheticSource(args.roaches, args.rows, args.cols, args.rate,
+                                   seed=None if args.seed is None else args.seed + i) for i in range(args.instances)]
+    else:
+        sources = [BinReplaySource(args.binfiles, loop=args.loop) for i in range(args.instances)]
+
+    if args.bench:
+        reports = benchmark(sources if args.instances > 1 else sources[0], args.roaches, args.rows, args.cols,
+                            port=args.port, duration=args.duration, speed=args.speed,
+                            integrationTime=args.integration, writerCfg=_parseCfg(args.writer_cfg),
+                            binDir=args.bin_dir, recvBatchSize=args.batch, nReaders=args.readers)
+        for report in reports if args.instances > 1 else [reports]:
+            print(formatReport(report))
+    else:
+        senders = [PacketSender(args.port + i, host=args.host, speed=args.speed, restamp=not args.keep_timestamps)
+                   for i in range(args.instances)]
+        threads = [threading.Thread(target=sender.run, args=(source.chunks(), args.duration))
+                   for sender, source in zip(senders, sources)]
+        for thread in threads:
+            thread.start()
+        for thread, sender in zip(threads, senders):
+            thread.join()
+            print('port {}: sent {nPackets} packets, {nBytes} bytes in {elapsed:.2f} s ({rate:.1f} MB/s), '
+                  '{nLate} late, max lag {maxLag:.4f} s'.format(sender.address[1], **sender.stats))
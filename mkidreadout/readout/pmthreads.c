@@ -90,60 +90,79 @@ int startEventBuffWriterThread(EVENT_BUFF_WRITER_PARAMS *rparams, THREAD_PARAMS
 
 }
 
+int startForwarderThread(FORWARDER_PARAMS *rparams, THREAD_PARAMS *tparams){
+    int rc; 
+    pthread_attr_init(&(tparams->attr));
+    rc = pthread_create(&(tparams->thread), &(tparams->attr), forwarder, rparams);
+    if (rc){
+        printf("ERROR creating forwarder(); return code from pthread_create() is %d\n", rc);
+        //exit(-1);
+    } 
+
+    return rc;
+
+}
+
 void *shmImageWriter(void *prms)
 {
-    int64_t i,j,ret,imgIdx;
+    int64_t j,imgIdx;
     char packet[MAX_PACKSIZE];
+    #ifdef _DEBUG_OUTPUT
     struct timespec startSpec;
     struct timespec stopSpec;
+    long nsElapsed;
+    #endif
+    #ifdef _TIMING_TEST
     struct timeval tv;
     unsigned long long sysTs;
-    long nsElapsed;
+    #endif
     uint64_t pcount = 0;
     STREAM_HEADER *hdr;
     uint64_t swp,swp1;
-    uint64_t pStartInd;
-    uint64_t pStartCycle;
     RINGBUFFER *packBuf;
-    uint64_t bufReadInd = 0;
-    uint64_t lastCycle = 0;
-    uint64_t nWriteCycles;
-    uint64_t bufWriteInd;
-    int nUnread;
-    int packSize;
-
-    uint64_t curTs;
-    uint64_t prevTs;
+    RINGBUF_READ_STATE *readStates;
+    RINGBUF_READ_STATE *readState;
+    int ringInd;
+    uint64_t packCount;
+    uint64_t packEnd;
+    uint64_t pStartInd;
+    uint64_t batchStartCursor;
+    uint64_t packSize;
+    char *packData;
+
+    uint64_t curTs = 0;
     uint16_t *boardNums;
     uint16_t curRoachInd;
-    uint16_t prevRoachInd;
     uint32_t *doneIntegrating; //Array of bitmasks (one for each image, bits are roaches)
+    uint64_t *firstDoneNs; //when the first roach passed the end of each image's current frame
+    uint64_t latencyNs;
+    WVL_BIN_TABLE *binTables; //one per image
+    uint32_t wvlGeneration = 0; //wavecal generation the images are using
     uint32_t doneIntMask; //constant - each place value corresponds to a roach board
     SHM_IMAGE_WRITER_PARAMS *params;
     MKID_IMAGE *sharedImages;
     sem_t *quitSem;
-    sem_t *ringBufResetSem;
 
     params = (SHM_IMAGE_WRITER_PARAMS*)prms; //cast param struct
 
     if(params->cpu != -1)
-        ret = MaximizePriority(params->cpu);
+        MaximizePriority(params->cpu);
     printf("SharedImageWriter online.\n");
 
-    packBuf = params->packBuf;
-
     doneIntMask = (1<<(params->nRoach))-1;
     printf("DONE INT MASK: %x\n", doneIntMask);
     printf("NROACH: %x\n", params->nRoach);
 
     quitSem = sem_open(params->quitSemName, O_CREAT, S_IRUSR | S_IWUSR | S_IRGRP | S_IWGRP, 0);
-    ringBufResetSem = sem_open(params->ringBufResetSemName, O_CREAT, S_IRUSR | S_IWUSR | S_IRGRP | S_IWGRP, 0);
+    readStates = calloc(params->nPackBufs, sizeof(RINGBUF_READ_STATE));
         
     
     memset(packet, 0, sizeof(packet[0]) * 808 * 2);    // zero out array
     boardNums = calloc(params->nRoach, sizeof(uint16_t));
 
     doneIntegrating = calloc(params->nSharedImages, sizeof(uint32_t));
+    firstDoneNs = calloc(params->nSharedImages, sizeof(uint64_t));
+    binTables = calloc(params->nSharedImages, sizeof(WVL_BIN_TABLE));
     sharedImages = (MKID_IMAGE*)malloc(params->nSharedImages*sizeof(MKID_IMAGE));
 
     for(imgIdx=0; imgIdx<params->nSharedImages; imgIdx++){
@@ -157,225 +176,248 @@ void *shmImageWriter(void *prms)
 
     }
 
-    prevTs = 0;
-
     #ifdef _TIMING_TEST
     FILE *timeFile = fopen("timetest.txt", "w");
     #endif
 
     printf("SharedImageWriter done initializing\n");
     curRoachInd = 0;
-    prevRoachInd = 0;
-    pStartInd = 0;
-    pStartCycle = 0;
-    bufReadInd = 0; // first pack is header
+    initWaitStats(&(params->waitStats));
+    memset(&(params->stats), 0, sizeof(CONSUMER_STATS));
+    memset(&(params->latencyStats), 0, sizeof(IMAGE_LATENCY_STATS));
 
     while (sem_trywait(quitSem) == -1)
     {
-        getRingBufState(packBuf, ringBufResetSem, &nWriteCycles, &bufWriteInd);
-        nUnread = (RINGBUF_SIZE)*(nWriteCycles - lastCycle) + (int)bufWriteInd - bufReadInd;
+        // sleep until a reader posts new data (returns immediately if there is unread data)
+        ringBufWait(params->notifier, params->packBufs, readStates, params->nPackBufs, 8, &(params->waitStats));
 
-        if((nUnread + 8) < 0){
-            printf("SharedImageWriter: nUnread < 0, unspecified glitch in ring buffer. Have fun! nUnread: %d writeInd: %lu nCycles: %lu\n", nUnread, bufWriteInd, nWriteCycles);
-            printf("    bufReadInd: %lu lastCycle %lu\n", bufReadInd, lastCycle);
+        if((params->wavecal != NULL) && (params->wavecal->generation != wvlGeneration)){
+            wvlGeneration = params->wavecal->generation;
+            pickUpWavecal(sharedImages, binTables, params->nSharedImages, params->wavecal, wvlGeneration);
 
         }
-        else if(nUnread > RINGBUF_SIZE){
-            printf("SharedImageWriter: Missed %d bytes\n", nUnread - RINGBUF_SIZE);
-            nUnread = RINGBUF_SIZE;
-            bufReadInd = (bufWriteInd + 8)%RINGBUF_SIZE;
-            if(bufReadInd % 8 > 0){
-                printf("Misalign in shmImageWriter\n");
-                bufReadInd -= bufReadInd%8;
 
+        // check for new image requests once per batch of packets
+        for(imgIdx=0; imgIdx<params->nSharedImages; imgIdx++)
+        {
+            if(sem_trywait(sharedImages[imgIdx].takeImageSem)==0)
+            {
+                //printf("SharedImageWriter: taking image %s\n", params->sharedImageNames[imgIdx]);
+                #ifdef _DEBUG_OUTPUT
+                clock_gettime(CLOCK_REALTIME, &startSpec);
+                #endif
+                sharedImages[imgIdx].md->takingImage = 1;
+                doneIntegrating[imgIdx] = 0;   
+                //sharedImages[imgIdx].md->valid = 1;
+                if(sharedImages[imgIdx].md->startTime==0)
+                    sharedImages[imgIdx].md->startTime = curTs;
+                // pick a free frame (not held by a reader) and zero it
+                MKIDShmImage_startFrame(sharedImages+imgIdx);
+                #ifdef _DEBUG_OUTPUT
+                printf("SharedImageWriter: starting image at %lu, roach: %d\n", curTs, boardNums[curRoachInd]);
+                printf("                   startTime: %lu, int time: %lu\n", sharedImages[imgIdx].md->startTime, sharedImages[imgIdx].md->integrationTime);
+                #endif
+         
             }
 
-            lastCycle = nWriteCycles - 1;
+            // cheap unless binning or the wavecal changed since the table was built
+            if(sharedImages[imgIdx].md->takingImage)
+                updateWvlBinTable(binTables+imgIdx, sharedImages[imgIdx].md, params->wavecal, wvlGeneration);
 
         }
 
-        if(nUnread % 8 >0)
-            printf("Misalign in shmImageWriter\n");
+        for(ringInd=0; ringInd<params->nPackBufs; ringInd++)
+        {
+            // each reader fills its own ring; packets from a given roach always land in the 
+            // same ring, so per roach ordering is preserved when interleaving them here
+            packBuf = params->packBufs + ringInd;
+            readState = readStates + ringInd;
+            packCount = getRingBufPackCount(packBuf);
+
+            if(ringBufOverwritten(packBuf, readState->readCursor) || (packCount - readState->packInd > PACKINDEX_SIZE)){
+                //skip to the end of the newest packet
+                printf("SharedImageWriter: Missed %lu packets\n", packCount - readState->packInd);
+                params->stats.nPacketsMissed += packCount - readState->packInd;
+                readState->packInd = packCount;
+                readState->readCursor = getRingBufPackEnd(packBuf, packCount);
+                continue;
+
+            }
 
-        //if(nUnread > (RINGBUF_SIZE - bufReadInd))
-        //    maxNToRead = RINGBUF_SIZE - bufReadInd;
+            batchStartCursor = readState->readCursor;
 
-        //else
-        //    maxNToRead = nUnread;
-        
-        
+            // the reader's packet index gives us datagram boundaries, so jump straight from
+            // header to header and parse photons where they sit in the ring
+            for(; readState->packInd < packCount; readState->packInd++)
+            {
+                packEnd = packBuf->packEnd[readState->packInd % PACKINDEX_SIZE];
+                packSize = packEnd - readState->readCursor;
+                pStartInd = readState->readCursor % RINGBUF_SIZE;
+                readState->readCursor = packEnd;
+
+                if((packSize < 8) || (packSize > MAX_PACKSIZE) || (packSize % 8 > 0)){
+                    printf("SharedImageWriter: Bad packet size %lu\n", packSize);
+                    params->stats.nBadPackets++;
+                    continue;
 
-        // if there is data waiting, process it
-        if(nUnread > 0) {       
-            // search the available data for a packet boundary
-            for(i=0; i<nUnread; i+=8) { 
-                for(imgIdx=0; imgIdx<params->nSharedImages; imgIdx++)
+                }
+
+                if(pStartInd + packSize > RINGBUF_SIZE){ //packet wraps around the ring
+                    ringBufCopy(packBuf, packEnd - packSize, packSize, packet);
+                    packData = packet;
+
+                }
+
+                else
+                    packData = (char*)(packBuf->data + pStartInd);
+
+                swp = *((uint64_t *) packData);
+                swp1 = __bswap_64(swp);
+                hdr = (STREAM_HEADER *) (&swp1);             
+
+                if (hdr->start != 0b11111111) {
+                    printf("SharedImageWriter: Packet missing header\n");
+                    params->stats.nBadPackets++;
+                    continue;
+
+                }
+
+                curRoachInd = 0;
+                curTs = (uint64_t)hdr->timestamp;
+
+                #ifdef _TIMING_TEST
+                gettimeofday(&tv, NULL);
+                sysTs = (unsigned long long)(tv.tv_sec)*2000 + (unsigned long long)(tv.tv_usec)/500 - (unsigned long long)tsOffset()*2000;
+                #endif
+          
+           
+                //Figure out index corresponding to roach number (index of roachNum in boardNums)
+                //If this doesn't exist, assign it
+                for(j=0; j<params->nRoach; j++)
                 {
-                    //printf("looping through image %d\n", imgIdx); fflush(stdout);
-                    //printf("Shared Image %d: %d\n", sharedImages[imgIdx]);
-                    if(sem_trywait(sharedImages[imgIdx].takeImageSem)==0)
+                    if(boardNums[j]==hdr->roach)
                     {
-                        //printf("SharedImageWriter: taking image %s\n", params->sharedImageNames[imgIdx]);
-                        #ifdef _DEBUG_OUTPUT
-                        clock_gettime(CLOCK_REALTIME, &startSpec);
-                        #endif
-                        sharedImages[imgIdx].md->takingImage = 1;
-                        doneIntegrating[imgIdx] = 0;   
-                        strcpy(sharedImages[imgIdx].md->wavecalID, params->wavecal->solutionFile);
-                        //sharedImages[imgIdx].md->valid = 1;
-                        // zero out array:
-                        memset(sharedImages[imgIdx].image, 0, sizeof(*(sharedImages[imgIdx].image)) * sharedImages[imgIdx].md->nCols * sharedImages[imgIdx].md->nRows); 
-                        if(sharedImages[imgIdx].md->startTime==0)
-                            sharedImages[imgIdx].md->startTime = curTs;
-                        #ifdef _DEBUG_OUTPUT
-                        printf("SharedImageWriter: starting image at %lu, roach: %d\n", curTs, boardNums[curRoachInd]);
-                        printf("                   startTime: %lu, int time: %lu\n", sharedImages[imgIdx].md->startTime, sharedImages[imgIdx].md->integrationTime);
-                        #endif
-                     
+                        curRoachInd = j;
+                        break;
+
+                    }
+                    if(boardNums[j]==0)
+                    {
+                        boardNums[j] = hdr->roach;
+                        curRoachInd = j;
+                        break;
+
                     }
 
-               }
+                }
+
+
+                #ifdef _TIMING_TEST
+                fprintf(timeFile, "%llu %llu %d\n", curTs, sysTs, boardNums[curRoachInd]);
+                #endif
+
+                // a new wavecal takes effect between packets, never partway through one
+                if((params->wavecal != NULL) && (params->wavecal->generation != wvlGeneration)){
+                    wvlGeneration = params->wavecal->generation;
+                    pickUpWavecal(sharedImages, binTables, params->nSharedImages, params->wavecal, wvlGeneration);
+
+                }
+           
+                for(imgIdx=0; imgIdx<params->nSharedImages; imgIdx++)
+                {
+                    if(sharedImages[imgIdx].md->takingImage)
+                    {
+                        //printf("curRoachTs: %lld\n", curTs);
+                        if((curTs>sharedImages[imgIdx].md->startTime)&&(curTs<=(sharedImages[imgIdx].md->startTime+sharedImages[imgIdx].md->integrationTime))){
+                            addPacketToFrame(sharedImages+imgIdx, sharedImages[imgIdx].image, packData, packSize, params->wavecal, binTables+imgIdx);
+                            if((doneIntegrating[imgIdx] & (1<<curRoachInd)) == (1<<curRoachInd))
+                                printf("Packet out of order! roach: %d\n", boardNums[curRoachInd]);
+
+                        }
+
+                        else if(curTs>(sharedImages[imgIdx].md->startTime+sharedImages[imgIdx].md->integrationTime))
+                        {
+                            #ifdef _DEBUG_OUTPUT
+                            if(!((doneIntegrating[imgIdx]>>curRoachInd)&1))
+                                printf("SharedImageWriter: Roach %d done Integrating\n", boardNums[curRoachInd]);
+                            #endif
+                            if(doneIntegrating[imgIdx] == 0)
+                                firstDoneNs[imgIdx] = monotonicNs();
+                            doneIntegrating[imgIdx] |= (1<<curRoachInd);
+
+                            // in continuous mode boards that finish early integrate straight into the 
+                            // next frame while the others catch up, so no photons fall between frames
+                            if(sharedImages[imgIdx].md->continuous && 
+                                    (curTs<=(sharedImages[imgIdx].md->startTime+2*sharedImages[imgIdx].md->integrationTime))){
+                                if(sharedImages[imgIdx].md->nextBuffer < 0)
+                                    MKIDShmImage_prepareNextFrame(sharedImages+imgIdx);
+                                addPacketToFrame(sharedImages+imgIdx, sharedImages[imgIdx].nextImage, packData, packSize, params->wavecal, binTables+imgIdx);
+
+                            }
+
+                        }
+
+                        //printf("SharedImageWriter: curTs %lld\n", curTs);
+                        pcount++;
+
+                        if(doneIntegrating[imgIdx]==doneIntMask) //check to see if all boards are done integrating
+                        {
+                            if(!sharedImages[imgIdx].md->continuous)
+                                sharedImages[imgIdx].md->takingImage = 0;
+                            doneIntegrating[imgIdx] = 0;
+                            MKIDShmImage_finishFrame(sharedImages + imgIdx);
+                            MKIDShmImage_postDoneSem(sharedImages + imgIdx, -1);
+                            latencyNs = monotonicNs() - firstDoneNs[imgIdx];
+                            params->latencyStats.nFrames++;
+                            params->latencyStats.latencyNs += latencyNs;
+                            params->latencyStats.lastLatencyNs = latencyNs;
+                            if(latencyNs > params->latencyStats.maxLatencyNs)
+                                params->latencyStats.maxLatencyNs = latencyNs;
+                            #ifdef _DEBUG_OUTPUT
+                            clock_gettime(CLOCK_REALTIME, &stopSpec);
+                            nsElapsed = 1000000000*(stopSpec.tv_sec - startSpec.tv_sec);
+                            nsElapsed += (long)stopSpec.tv_nsec - startSpec.tv_nsec;
+                            printf("SharedImageWriter: done image at %lu\n", curTs);
+                            printf("SharedImageWriter: int time %lu\n", curTs-sharedImages[imgIdx].md->integrationTime);
+                            printf("SharedImageWriter: real time %ld ms\n", (nsElapsed)/1000000);
+                            //printf("SharedImageWriter: Parse rate = %lu pkts/img. Data in buffer = %lu\n",pcount,oldbr); fflush(stdout);
+                            #endif
+                            pcount = 0;
+
+                        }
                
-               assert(bufReadInd % 8 == 0);
-
-               swp = *((uint64_t *) (&packBuf->data[bufReadInd]));
-               swp1 = __bswap_64(swp);
-               hdr = (STREAM_HEADER *) (&swp1);             
-
-               if (hdr->start == 0b11111111) {        // found new packet header!
-                   // fill packet and parse
-                   if(lastCycle == pStartCycle){
-                       memmove(packet, &packBuf->data[pStartInd], bufReadInd - pStartInd);
-                       packSize = bufReadInd - pStartInd;
-                       pStartInd = bufReadInd;
-
-                   }
-                   else if(lastCycle == (pStartCycle + 1)){
-                       if(bufReadInd > pStartInd)
-                           printf("Shared mem overflow - skipped packet boundary\n");
-                       assert(RINGBUF_SIZE - pStartInd <= MAX_PACKSIZE);
-                       memmove(packet, &packBuf->data[pStartInd], RINGBUF_SIZE - pStartInd);
-                       memmove(packet + (RINGBUF_SIZE - pStartInd), packBuf->data, bufReadInd);
-                       packSize = RINGBUF_SIZE + (int)bufReadInd - pStartInd;
-                       pStartInd = bufReadInd;
-                       pStartCycle = lastCycle;
-
-                   }
-
-                   else
-                       printf("Severe shared mem overflow! lastCycle: %lu, pStartCycle: %lu, nCycles %lu\n", lastCycle, pStartCycle, nWriteCycles);
-
-                   prevRoachInd = curRoachInd;
-                   curRoachInd = 0;
-
-                   prevTs = curTs;
-                   curTs = (uint64_t)hdr->timestamp;
-
-                   #ifdef _TIMING_TEST
-                   gettimeofday(&tv, NULL);
-                   sysTs = (unsigned long long)(tv.tv_sec)*2000 + (unsigned long long)(tv.tv_usec)/500 - (unsigned long long)TSOFFS*2000;
-                   #endif
-                  
-                   
-                   //Figure out index corresponding to roach number (index of roachNum in boardNums)
-                   //If this doesn't exist, assign it
-                   for(j=0; j<params->nRoach; j++)
-                   {
-                       if(boardNums[j]==hdr->roach)
-                       {
-                           curRoachInd = j;
-                           break;
-
-                       }
-                       if(boardNums[j]==0)
-                       {
-                           boardNums[j] = hdr->roach;
-                           curRoachInd = j;
-                           break;
-
-                       }
-
-                   }
-
-
-                   #ifdef _TIMING_TEST
-                   fprintf(timeFile, "%llu %llu %d\n", curTs, sysTs, boardNums[curRoachInd]);
-                   #endif
-
-                   //if(curTs < prevTs)
-                   //    printf("Packet out of order. dt = %lu, curRoach = %d, prevRoach=%d \n", 
-                   //          prevTs-curTs, boardNums[curRoachInd], boardNums[prevRoachInd]);
-                   
-                   for(imgIdx=0; imgIdx<params->nSharedImages; imgIdx++)
-                   {
-                       if(sharedImages[imgIdx].md->takingImage)
-                       {
-                           //printf("curRoachTs: %lld\n", curTs);
-                           if((curTs>sharedImages[imgIdx].md->startTime)&&(curTs<=(sharedImages[imgIdx].md->startTime+sharedImages[imgIdx].md->integrationTime))){
-                               addPacketToImage(sharedImages+imgIdx, packet, packSize, params->wavecal);
-                               if((doneIntegrating[imgIdx] & (1<<curRoachInd)) == (1<<curRoachInd))
-                                   printf("Packet out of order! roach: %d\n", boardNums[curRoachInd]);
-
-                           }
-
-                           else if(curTs>(sharedImages[imgIdx].md->startTime+sharedImages[imgIdx].md->integrationTime))
-                           {
-                               #ifdef _DEBUG_OUTPUT
-                               if(!((doneIntegrating[imgIdx]>>curRoachInd)&1))
-                                   printf("SharedImageWriter: Roach %d done Integrating\n", boardNums[curRoachInd]);
-                               #endif
-                               doneIntegrating[imgIdx] |= (1<<curRoachInd);
-
-                           }
-
-                           //printf("SharedImageWriter: curTs %lld\n", curTs);
-                           pcount++;
-
-                           if(doneIntegrating[imgIdx]==doneIntMask) //check to see if all boards are done integrating
-                           {
-                               sharedImages[imgIdx].md->takingImage = 0;
-                               MKIDShmImage_postDoneSem(sharedImages + imgIdx, -1);
-                               #ifdef _DEBUG_OUTPUT
-                               clock_gettime(CLOCK_REALTIME, &stopSpec);
-                               nsElapsed = 1000000000*(stopSpec.tv_sec - startSpec.tv_sec);
-                               nsElapsed += (long)stopSpec.tv_nsec - startSpec.tv_nsec;
-                               printf("SharedImageWriter: done image at %lu\n", curTs);
-                               printf("SharedImageWriter: int time %lu\n", curTs-sharedImages[imgIdx].md->integrationTime);
-                               printf("SharedImageWriter: real time %ld ms\n", (nsElapsed)/1000000);
-                               //printf("SharedImageWriter: Parse rate = %lu pkts/img. Data in buffer = %lu\n",pcount,oldbr); fflush(stdout);
-                               //printf("SharedImageWriter: forLoopIters %d\n", forLoopIters);
-                               //printf("SharedImageWriter: whileLoopIters %d\n", whileLoopIters);
-                               //printf("SharedImageWriter: oldbr: %lu\n\n", oldbr);
-                               #endif
-                               pcount = 0;
-
-                           }
-                       
-                       }
-
-                  }
-	              //pStart = i*8;   // move start location for next packet	                      
-               }
-
-               bufReadInd += 8;
-               if(bufReadInd >= RINGBUF_SIZE){
-                   bufReadInd = 0;
-                   lastCycle += 1;
-
-               }
-           }
-
-        }                           
+                    }
+
+                }
+
+            }
+
+            if(ringBufOverwritten(packBuf, batchStartCursor))
+                printf("SharedImageWriter: ring buffer overwritten while parsing, image may be corrupt\n");
+
+        }
+
+        params->stats.ringBacklog = consumerBacklog(params->packBufs, readStates, params->nPackBufs);
+        if(params->stats.ringBacklog > params->stats.maxRingBacklog)
+            params->stats.maxRingBacklog = params->stats.ringBacklog;
+
     }
 
+    printf("SharedImageWriter: slept %lu times, mean wake latency %lu us, cpu %lu%%\n", params->waitStats.nWaits,
+            params->waitStats.nWakes ? params->waitStats.wakeLatencyNs/params->waitStats.nWakes/1000 : 0,
+            params->waitStats.wallNs ? 100*params->waitStats.cpuNs/params->waitStats.wallNs : 0);
     printf("SharedImageWriter: Freeing stuff\n");
     free(boardNums);
     for(imgIdx=0; imgIdx<params->nSharedImages; imgIdx++)
         MKIDShmImage_close(sharedImages+imgIdx);
     free(sharedImages);
     free(doneIntegrating);
+    free(firstDoneNs);
+    for(imgIdx=0; imgIdx<params->nSharedImages; imgIdx++)
+        freeWvlBinTable(binTables+imgIdx);
+    free(binTables);
+    free(readStates);
     sem_close(quitSem);
-    sem_close(ringBufResetSem);
 
     #ifdef _TIMING_TEST
     fclose(timeFile);
@@ -386,24 +428,476 @@ void *shmImageWriter(void *prms)
 
 void *eventBuffWriter(void *prms)
 {
+    char packet[MAX_PACKSIZE];
+    STREAM_HEADER *hdr;
+    uint64_t swp,swp1;
+    RINGBUFFER *packBuf;
+    RINGBUF_READ_STATE *readStates;
+    RINGBUF_READ_STATE *readState;
+    int ringInd;
+    uint64_t packCount;
+    uint64_t packEnd;
+    uint64_t pStartInd;
+    uint64_t batchStartCursor;
+    uint64_t packSize;
+    time_t tsOffs;
+    char *packData;
+    MKID_PHOTON_EVENT *events;
+    int nEvents;
+    EVENT_BUFF_WRITER_PARAMS *params;
+    MKID_EVENT_BUFFER eventBuffer;
+    sem_t *quitSem;
+
+    params = (EVENT_BUFF_WRITER_PARAMS*)prms; //cast param struct
+
+    if(params->cpu != -1)
+        MaximizePriority(params->cpu);
+    printf("EventBufferWriter online.\n");
+
+    quitSem = sem_open(params->quitSemName, O_CREAT, S_IRUSR | S_IWUSR | S_IRGRP | S_IWGRP, 0);
+    if(MKIDShmEventBuffer_open(&eventBuffer, params->bufferName) != 0){
+        printf("EventBufferWriter: Error opening event buffer %s\n", params->bufferName);
+        sem_close(quitSem);
+        return NULL;
+
+    }
+
+    MKIDShmEventBuffer_reset(&eventBuffer);
+    readStates = calloc(params->nPackBufs, sizeof(RINGBUF_READ_STATE));
+
+    // photons are staged here and copied into the shared buffer with one set of sem posts;
+    // sized so that a full packet always fits after a flush
+    events = (MKID_PHOTON_EVENT*)malloc((EVENT_BATCH_SIZE + MAX_PACKSIZE/8)*sizeof(MKID_PHOTON_EVENT));
+    nEvents = 0;
+    params->nEventsWritten = 0;
+    params->nBatches = 0;
+    memset(&(params->stats), 0, sizeof(CONSUMER_STATS));
+
+    printf("EventBufferWriter done initializing\n");
+    initWaitStats(&(params->waitStats));
+
+    while (sem_trywait(quitSem) == -1)
+    {
+        ringBufWait(params->notifier, params->packBufs, readStates, params->nPackBufs, 8, &(params->waitStats));
+        tsOffs = tsOffset(); //header timestamps restart every UTC year
+
+        for(ringInd=0; ringInd<params->nPackBufs; ringInd++)
+        {
+            packBuf = params->packBufs + ringInd;
+            readState = readStates + ringInd;
+            packCount = getRingBufPackCount(packBuf);
+
+            if(ringBufOverwritten(packBuf, readState->readCursor) || (packCount - readState->packInd > PACKINDEX_SIZE)){
+                printf("EventBufferWriter: Missed %lu packets\n", packCount - readState->packInd);
+                params->stats.nPacketsMissed += packCount - readState->packInd;
+                readState->packInd = packCount;
+                readState->readCursor = getRingBufPackEnd(packBuf, packCount);
+                continue;
+
+            }
+
+            batchStartCursor = readState->readCursor;
+
+            for(; readState->packInd < packCount; readState->packInd++)
+            {
+                packEnd = packBuf->packEnd[readState->packInd % PACKINDEX_SIZE];
+                packSize = packEnd - readState->readCursor;
+                pStartInd = readState->readCursor % RINGBUF_SIZE;
+                readState->readCursor = packEnd;
+
+                if((packSize < 8) || (packSize > MAX_PACKSIZE) || (packSize % 8 > 0)){
+                    params->stats.nBadPackets++;
+                    continue;
+
+                }
+
+                if(pStartInd + packSize > RINGBUF_SIZE){ //packet wraps around the ring
+                    ringBufCopy(packBuf, packEnd - packSize, packSize, packet);
+                    packData = packet;
+
+                }
+
+                else
+                    packData = (char*)(packBuf->data + pStartInd);
+
+                swp = *((uint64_t *) packData);
+                swp1 = __bswap_64(swp);
+                hdr = (STREAM_HEADER *) (&swp1);             
+
+                if (hdr->start != 0b11111111){
+                    params->stats.nBadPackets++;
+                    continue;
+
+                }
+
+                nEvents += parsePacketToEvents(events + nEvents, packData, packSize, (uint64_t)hdr->timestamp, 
+                        tsOffs, params->wavecal, eventBuffer.md->useWvl, params->nRows, params->nCols);
+
+                if(nEvents >= EVENT_BATCH_SIZE){
+                    MKIDShmEventBuffer_addEvents(&eventBuffer, events, nEvents);
+                    params->nEventsWritten += nEvents;
+                    params->nBatches++;
+                    nEvents = 0;
+
+                }
+
+            }
+
+            if(ringBufOverwritten(packBuf, batchStartCursor))
+                printf("EventBufferWriter: ring buffer overwritten while parsing, events may be corrupt\n");
+
+        }
+
+        params->stats.ringBacklog = consumerBacklog(params->packBufs, readStates, params->nPackBufs);
+        if(params->stats.ringBacklog > params->stats.maxRingBacklog)
+            params->stats.maxRingBacklog = params->stats.ringBacklog;
+
+        // don't hold photons back waiting for a full batch once we've caught up
+        if(nEvents > 0){
+            MKIDShmEventBuffer_addEvents(&eventBuffer, events, nEvents);
+            params->nEventsWritten += nEvents;
+            params->nBatches++;
+            nEvents = 0;
+
+        }
+
+    }
+
+    printf("EventBufferWriter: wrote %lu photons in %lu batches\n", params->nEventsWritten, params->nBatches);
+    printf("EventBufferWriter: slept %lu times, mean wake latency %lu us, cpu %lu%%\n", params->waitStats.nWaits,
+            params->waitStats.nWakes ? params->waitStats.wakeLatencyNs/params->waitStats.nWakes/1000 : 0,
+            params->waitStats.wallNs ? 100*params->waitStats.cpuNs/params->waitStats.wallNs : 0);
+    free(events);
+    free(readStates);
+    sem_close(quitSem);
     printf("EventBufferWriter: Closing\n");
     return NULL;
 
 }
 
+// Re-sends packets from the rings to each destination with one sendmmsg per batch.
+// Unfiltered destinations send straight out of the ring (two iovecs if a packet wraps), 
+// region filtered ones from a per destination copy holding the selected photons.
+void *forwarder(void *prms)
+{
+    int i, d, nBatch, wraps;
+    char packet[MAX_PACKSIZE];
+    STREAM_HEADER *hdr;
+    uint64_t swp,swp1;
+    RINGBUFFER *packBuf;
+    RINGBUF_READ_STATE *readStates;
+    RINGBUF_READ_STATE *readState;
+    int ringInd;
+    uint64_t packCount;
+    uint64_t packEnd;
+    uint64_t pStartInd;
+    uint64_t batchStartCursor;
+    uint64_t packSize;
+    uint64_t firstSize;
+    uint64_t outSize;
+    char *packData;
+    FORWARDER_PARAMS *params;
+    FORWARD_DEST *dest;
+    int socks[MAX_FORWARD_DESTS];
+    struct mmsghdr *msgs[MAX_FORWARD_DESTS];
+    struct iovec *iovecs[MAX_FORWARD_DESTS];
+    char *filtered[MAX_FORWARD_DESTS];
+    int nMsgs[MAX_FORWARD_DESTS];
+    uint64_t nSentBefore[MAX_FORWARD_DESTS];
+    struct msghdr *msg;
+    sem_t *quitSem;
+
+    params = (FORWARDER_PARAMS*)prms; //cast param struct
+
+    if(params->cpu != -1)
+        MaximizePriority(params->cpu);
+    printf("Forwarder online.\n");
+
+    quitSem = sem_open(params->quitSemName, O_CREAT, S_IRUSR | S_IWUSR | S_IRGRP | S_IWGRP, 0);
+    readStates = calloc(params->nPackBufs, sizeof(RINGBUF_READ_STATE));
+    memset(&(params->stats), 0, sizeof(CONSUMER_STATS));
+
+    for(d=0; d<params->nDests; d++){
+        socks[d] = openForwardSocket(params->dests + d, params->sendBufBytes);
+        msgs[d] = calloc(FORWARD_BATCH, sizeof(struct mmsghdr));
+        iovecs[d] = calloc(2*FORWARD_BATCH, sizeof(struct iovec));
+        filtered[d] = params->dests[d].useRegion ? (char*)malloc(FORWARD_BATCH*MAX_PACKSIZE) : NULL;
+        for(i=0; i<FORWARD_BATCH; i++)
+            msgs[d][i].msg_hdr.msg_iov = iovecs[d] + 2*i;
+
+    }
+
+    printf("Forwarder done initializing\n");
+    initWaitStats(&(params->waitStats));
+
+    while (sem_trywait(quitSem) == -1)
+    {
+        ringBufWait(params->notifier, params->packBufs, readStates, params->nPackBufs, 8, &(params->waitStats));
+
+        for(ringInd=0; ringInd<params->nPackBufs; ringInd++)
+        {
+            packBuf = params->packBufs + ringInd;
+            readState = readStates + ringInd;
+            packCount = getRingBufPackCount(packBuf);
+
+            if(ringBufOverwritten(packBuf, readState->readCursor) || (packCount - readState->packInd > PACKINDEX_SIZE)){
+                printf("Forwarder: Missed %lu packets\n", packCount - readState->packInd);
+                params->stats.nPacketsMissed += packCount - readState->packInd;
+                readState->packInd = packCount;
+                readState->readCursor = getRingBufPackEnd(packBuf, packCount);
+                continue;
+
+            }
+
+            while(readState->packInd < packCount)
+            {
+                for(d=0; d<params->nDests; d++)
+                    nMsgs[d] = 0;
+
+                batchStartCursor = readState->readCursor;
+                for(nBatch=0; (nBatch < FORWARD_BATCH) && (readState->packInd < packCount); readState->packInd++)
+                {
+                    packEnd = packBuf->packEnd[readState->packInd % PACKINDEX_SIZE];
+                    packSize = packEnd - readState->readCursor;
+                    pStartInd = readState->readCursor % RINGBUF_SIZE;
+                    readState->readCursor = packEnd;
+
+                    if((packSize < 8) || (packSize > MAX_PACKSIZE) || (packSize % 8 > 0)){
+                        params->stats.nBadPackets++;
+                        continue;
+
+                    }
+
+                    wraps = pStartInd + packSize > RINGBUF_SIZE;
+                    firstSize = wraps ? RINGBUF_SIZE - pStartInd : packSize;
+                    if(wraps){ //only copied for the header and region filters, sent from the ring
+                        ringBufCopy(packBuf, packEnd - packSize, packSize, packet);
+                        packData = packet;
+
+                    }
+
+                    else
+                        packData = (char*)(packBuf->data + pStartInd);
+
+                    swp = *((uint64_t *) packData);
+                    swp1 = __bswap_64(swp);
+                    hdr = (STREAM_HEADER *) (&swp1);             
+
+                    if (hdr->start != 0b11111111){
+                        params->stats.nBadPackets++;
+                        continue;
+
+                    }
+
+                    nBatch++;
+                    for(d=0; d<params->nDests; d++){
+                        dest = params->dests + d;
+                        if(!dest->allRoaches && !dest->roaches[hdr->roach]){
+                            dest->nPacketsFiltered++;
+                            continue;
+
+                        }
+
+                        msg = &(msgs[d][nMsgs[d]].msg_hdr);
+                        if(dest->useRegion){
+                            outSize = filterForwardPacket(dest, packData, packSize, filtered[d] + nMsgs[d]*MAX_PACKSIZE);
+                            if(outSize == 8){
+                                dest->nPacketsFiltered++;
+                                continue;
+
+                            }
+                            msg->msg_iov[0].iov_base = filtered[d] + nMsgs[d]*MAX_PACKSIZE;
+                            msg->msg_iov[0].iov_len = outSize;
+                            msg->msg_iovlen = 1;
+
+                        }
+
+                        else{
+                            msg->msg_iov[0].iov_base = packBuf->data + pStartInd;
+                            msg->msg_iov[0].iov_len = firstSize;
+                            msg->msg_iov[1].iov_base = packBuf->data;
+                            msg->msg_iov[1].iov_len = packSize - firstSize;
+                            msg->msg_iovlen = wraps ? 2 : 1;
+
+                        }
+                        nMsgs[d]++;
+
+                    }
+
+                }
+
+                for(d=0; d<params->nDests; d++){
+                    nSentBefore[d] = params->dests[d].nPacketsSent;
+                    if(nMsgs[d] > 0)
+                        sendForwardBatch(socks[d], params->dests + d, msgs[d], nMsgs[d]);
+
+                }
+
+                // unfiltered destinations were sent straight from the ring, so if the readers lapped the 
+                // start of the batch before sendmmsg copied it out those packets may be corrupt
+                if(ringBufOverwritten(packBuf, batchStartCursor)){
+                    printf("Forwarder: ring buffer overwritten while sending, counting the batch as dropped\n");
+                    for(d=0; d<params->nDests; d++){
+                        dest = params->dests + d;
+                        if(!dest->useRegion){
+                            dest->nPacketsDropped += dest->nPacketsSent - nSentBefore[d];
+                            dest->nPacketsSent = nSentBefore[d];
+
+                        }
+
+                    }
+
+                }
+
+            }
+
+        }
+
+        params->stats.ringBacklog = consumerBacklog(params->packBufs, readStates, params->nPackBufs);
+        if(params->stats.ringBacklog > params->stats.maxRingBacklog)
+            params->stats.maxRingBacklog = params->stats.ringBacklog;
+
+    }
+
+    for(d=0; d<params->nDests; d++){
+        dest = params->dests + d;
+        printf("Forwarder: sent %lu packets (%lu bytes) to %s:%d in %lu calls, dropped %lu, filtered %lu\n", 
+                dest->nPacketsSent, dest->nBytesSent, dest->host, dest->port, dest->nSendCalls, 
+                dest->nPacketsDropped, dest->nPacketsFiltered);
+        if(socks[d] != -1)
+            close(socks[d]);
+        free(filtered[d]);
+        free(iovecs[d]);
+        free(msgs[d]);
+
+    }
+    free(readStates);
+    sem_close(quitSem);
+    printf("Forwarder: Closing\n");
+    return NULL;
+
+}
+
+// Connected UDP socket to dest, or -1 if host can't be resolved or the socket can't be set up
+int openForwardSocket(FORWARD_DEST *dest, int sendBufBytes){
+    struct addrinfo hints;
+    struct addrinfo *addr;
+    char portStr[16];
+    int s, ret;
+
+    memset(&hints, 0, sizeof(hints));
+    hints.ai_family = AF_INET;
+    hints.ai_socktype = SOCK_DGRAM;
+    snprintf(portStr, sizeof(portStr), "%d", dest->port);
+    ret = getaddrinfo(dest->host, portStr, &hints, &addr);
+    if(ret != 0){
+        printf("Forwarder: can't resolve %s: %s, dropping its packets\n", dest->host, gai_strerror(ret));
+        return -1;
+
+    }
+
+    s = socket(AF_INET, SOCK_DGRAM, IPPROTO_UDP);
+    if(s == -1){
+        perror("Forwarder: socket");
+        freeaddrinfo(addr);
+        return -1;
+
+    }
+
+    if((sendBufBytes > 0) && (setsockopt(s, SOL_SOCKET, SO_SNDBUF, &sendBufBytes, sizeof(sendBufBytes)) == -1))
+        perror("Forwarder: set send buffer size");
+
+    if(connect(s, addr->ai_addr, addr->ai_addrlen) == -1){
+        perror("Forwarder: connect");
+        close(s);
+        s = -1;
+
+    }
+
+    else
+        printf("Forwarder: sending to %s:%d\n", dest->host, dest->port);
+
+    freeaddrinfo(addr);
+    return s;
+
+}
+
+// Copies the header and the photons inside dest's region to out, returns the bytes copied
+uint64_t filterForwardPacket(FORWARD_DEST *dest, char *packData, uint64_t packSize, char *out){
+    uint64_t i;
+    uint64_t outSize = 8;
+    uint64_t swp;
+    PHOTON_WORD *photon = (PHOTON_WORD*)&swp;
+
+    memcpy(out, packData, 8);
+    for(i=8; i<packSize; i+=8){
+        swp = __bswap_64(*(uint64_t*)(packData + i));
+        if((photon->xcoord >= dest->xMin) && (photon->xcoord < dest->xMax) 
+                && (photon->ycoord >= dest->yMin) && (photon->ycoord < dest->yMax)){
+            memcpy(out + outSize, packData + i, 8);
+            outSize += 8;
+
+        }
+
+    }
+
+    return outSize;
+
+}
+
+// Never blocks: a full socket buffer drops the rest of the batch, any other error (e.g. 
+// ECONNREFUSED left by an earlier datagram while the receiver is down) drops one datagram
+void sendForwardBatch(int sock, FORWARD_DEST *dest, struct mmsghdr *msgs, int nMsgs){
+    int i, ret;
+    int sent = 0;
+
+    if(sock == -1){
+        dest->nPacketsDropped += nMsgs;
+        return;
+
+    }
+
+    while(sent < nMsgs){
+        ret = sendmmsg(sock, msgs + sent, nMsgs - sent, MSG_DONTWAIT);
+        dest->nSendCalls++;
+        if(ret == -1){
+            if((errno == EAGAIN) || (errno == EWOULDBLOCK) || (errno == ENOBUFS)){
+                dest->nPacketsDropped += nMsgs - sent;
+                return;
+
+            }
+            dest->nPacketsDropped++;
+            sent++;
+            continue;
+
+        }
+
+        for(i=sent; i<sent+ret; i++)
+            dest->nBytesSent += msgs[i].msg_len;
+        dest->nPacketsSent += ret;
+        sent += ret;
+
+    }
+
+}
+
 void* reader(void *prms){
     //set up a socket connection
-    struct sockaddr_in si_me, si_other;
+    struct sockaddr_in si_me;
     int s, ret, i;
+    int batchSize, nMsgs;
     ssize_t nBytesReceived = 0;
-    ssize_t nTotalBytes = 0;
     size_t lastWriteSize;
+    uint64_t writeCursor;
+    uint64_t writeInd;
+    uint64_t packCount;
+    uint64_t lastWakeCursor;
     RINGBUFFER *packBuf;
     READER_PARAMS *params;
     sem_t *quitSem;
-    sem_t *ringBufResetSem;
-    char streamSemName[80];
     char overFlowBuf[BUFLEN];
+    struct mmsghdr *msgs;
+    struct iovec *iovecs;
 
     params = (READER_PARAMS*) prms;
     
@@ -414,18 +908,47 @@ void* reader(void *prms){
 
     //open semaphores
     quitSem = sem_open(params->quitSemName, O_CREAT, S_IRUSR | S_IWUSR | S_IRGRP | S_IWGRP, 0);
-    ringBufResetSem = sem_open(params->ringBufResetSemName, O_CREAT, S_IRUSR | S_IWUSR | S_IRGRP | S_IWGRP, 0);
 
-    packBuf = params->packBuf; //pointer to list of stream buffers, assume this is allocated
-    packBuf->writeInd = 0;
-    packBuf->nCycles = 0;
-    sem_post(ringBufResetSem);
+    packBuf = params->packBuf; //pointer to list of stream buffers, assume this is allocated (and initRingBuf'd)
+    writeCursor = getRingBufWriteCursor(packBuf); //we are the only writer, keep a local copy
+    lastWakeCursor = writeCursor;
+    packCount = getRingBufPackCount(packBuf);
+
+    memset(&(params->stats), 0, sizeof(READER_STATS));
+    memset(params->roachStats, 0, sizeof(params->roachStats));
+
+    // recvmmsg setup; each datagram gets a BUFLEN slot in the ring buffer
+    batchSize = params->batchSize;
+    if(batchSize > MAX_RECV_BATCH)
+        batchSize = MAX_RECV_BATCH;
+    msgs = NULL;
+    iovecs = NULL;
+    if(batchSize > 1){
+        msgs = calloc(batchSize, sizeof(struct mmsghdr));
+        iovecs = calloc(batchSize, sizeof(struct iovec));
+        for(i=0; i<batchSize; i++){
+            iovecs[i].iov_len = BUFLEN;
+            msgs[i].msg_hdr.msg_iov = &iovecs[i];
+            msgs[i].msg_hdr.msg_iovlen = 1;
+
+        }
+        printf("READER: receiving up to %d frames per call\n", batchSize);
+
+    }
 
     if ((s=socket(AF_INET, SOCK_DGRAM, IPPROTO_UDP))==-1)
         diep("socket");
     printf("READER: socket created\n");
     fflush(stdout);
 
+    if(params->reusePort){
+        int optval = 1;
+        if(setsockopt(s, SOL_SOCKET, SO_REUSEPORT, &optval, sizeof(optval)) == -1)
+            diep("set SO_REUSEPORT");
+        printf("READER: sharing port %d with other readers\n", params->port);
+
+    }
+
     memset((char *) &si_me, 0, sizeof(si_me));
     si_me.sin_family = AF_INET;
     si_me.sin_port = htons(params->port);
@@ -450,8 +973,6 @@ void* reader(void *prms){
     if (retval == -1)
         diep("set receive buffer size");
 
-    uint64_t nFrames = 0;
-    
     // clean out socket before we start
     //printf("READER: clearing buffer.\n"); fflush(stdout);
     //while ( recv(s, buf, BUFLEN, 0) > 0 );
@@ -463,15 +984,24 @@ void* reader(void *prms){
     while(sem_trywait(quitSem)==-1) //(access( "/home/ramdisk/QUIT", F_OK ) == -1)
     {
         #ifdef _DEBUG_READER_OUTPUT
-        if (nFrames % 1000 == 0)
+        if (params->stats.nFrames % 1000 == 0)
         {
-            printf("Frame %d\n",nFrames);  fflush(stdout);
+            printf("Frame %lu\n",params->stats.nFrames);  fflush(stdout);
         }
         #endif
 
-        if((RINGBUF_SIZE - packBuf->writeInd) <= BUFLEN){ //Need to use overflow buffer since we might cross ringbuffer boundary
-            nBytesReceived = recv(s, overFlowBuf, BUFLEN, 0);
-            if (nBytesReceived == -1)
+        writeInd = writeCursor % RINGBUF_SIZE;
+
+        if((batchSize > 1) && ((RINGBUF_SIZE - writeInd) > batchSize*BUFLEN)){
+            // Batched mode: receive frames directly into consecutive BUFLEN slots after writeInd,
+            // then pack them down so the ring stays contiguous. writeCursor is only published after
+            // packing, so consumers never see the gaps. Falls through to single recv near the 
+            // end of the ring.
+            for(i=0; i<batchSize; i++)
+                iovecs[i].iov_base = packBuf->data + writeInd + i*BUFLEN;
+
+            nMsgs = recvmmsg(s, msgs, batchSize, MSG_WAITFORONE, NULL);
+            if (nMsgs == -1)
             {
                 if (errno == EAGAIN || errno == EWOULDBLOCK)
                 {// recv timed out, clear the error and check again
@@ -479,45 +1009,76 @@ void* reader(void *prms){
                     continue;
                 }
                 else
-                    diep("recvfrom()");
+                    diep("recvmmsg()");
             }
+            else if (nMsgs == 0) continue;
+
+            nBytesReceived = 0;
+            for(i=0; i<nMsgs; i++){
+                if(nBytesReceived != i*BUFLEN)
+                    memmove(packBuf->data + writeInd + nBytesReceived, iovecs[i].iov_base, msgs[i].msg_len);
+                updateRoachStats(params->roachStats, packBuf->data + writeInd + nBytesReceived, msgs[i].msg_len);
+                nBytesReceived += msgs[i].msg_len;
+                packBuf->packEnd[(packCount + i) % PACKINDEX_SIZE] = writeCursor + nBytesReceived;
+
+                if( msgs[i].msg_len % 8 != 0 ) {
+                    printf("Misalign in reader %u\n",msgs[i].msg_len); fflush(stdout);
+                }
 
-            else if (nBytesReceived == 0 ) continue;
-            
-            else if(nBytesReceived >= (RINGBUF_SIZE - packBuf->writeInd)){ //We've hit ringbuffer boundary
-                memcpy(packBuf->data + packBuf->writeInd, overFlowBuf, RINGBUF_SIZE - packBuf->writeInd);
-                lastWriteSize = RINGBUF_SIZE - packBuf->writeInd;
-
-                sem_wait(ringBufResetSem);
-                packBuf->writeInd = 0;
-                packBuf->nCycles += 1;
-                sem_post(ringBufResetSem);
-
-                memcpy(packBuf->data + packBuf->writeInd, overFlowBuf + lastWriteSize, 
-                        nBytesReceived - lastWriteSize); 
-                packBuf->writeInd += nBytesReceived - lastWriteSize;
-                #ifdef _DEBUG_READER_OUTPUT
-                printf("Reader: nRingBufCycles: %lu\n", packBuf->nCycles);
-                printf("    nBytesReceived: %ld\n", nBytesReceived);
-                printf("    lastWriteSize: %ld\n", lastWriteSize);
-                printf("    writeInd: %lu\n", packBuf->writeInd);
-                #endif 
+            }
+
+            writeCursor += nBytesReceived;
+            packCount += nMsgs;
+            atomic_store_explicit(&packBuf->packCount, packCount, memory_order_release);
+            atomic_store_explicit(&packBuf->writeCursor, writeCursor, memory_order_release);
+            ringBufNotify(params->notifier, writeCursor, &lastWakeCursor);
+
+            params->stats.nRecvCalls++;
+            params->stats.nFrames += nMsgs;
+            params->stats.nBytes += nBytesReceived;
+            params->stats.lastBatchFrames = nMsgs;
+            params->stats.lastBatchBytes = nBytesReceived;
+            continue;
+
+        }
 
+        if((RINGBUF_SIZE - writeInd) <= BUFLEN){ //Need to use overflow buffer since we might cross ringbuffer boundary
+            nBytesReceived = recv(s, overFlowBuf, BUFLEN, 0);
+            if (nBytesReceived == -1)
+            {
+                if (errno == EAGAIN || errno == EWOULDBLOCK)
+                {// recv timed out, clear the error and check again
+                    errno = 0;
+                    continue;
+                }
+                else
+                    diep("recvfrom()");
             }
 
-            else{
-                memcpy(packBuf->data + packBuf->writeInd, overFlowBuf, nBytesReceived);
-                packBuf->writeInd += nBytesReceived;
-                assert(packBuf->writeInd < RINGBUF_SIZE);
+            else if (nBytesReceived == 0 ) continue;
+            
+            updateRoachStats(params->roachStats, (uint8_t*)overFlowBuf, nBytesReceived);
+            if(nBytesReceived >= (RINGBUF_SIZE - writeInd)){ //We've hit ringbuffer boundary
+                lastWriteSize = RINGBUF_SIZE - writeInd;
+                memcpy(packBuf->data + writeInd, overFlowBuf, lastWriteSize);
+                memcpy(packBuf->data, overFlowBuf + lastWriteSize, nBytesReceived - lastWriteSize); 
+                #ifdef _DEBUG_READER_OUTPUT
+                printf("Reader: nRingBufCycles: %lu\n", (writeCursor + nBytesReceived)/RINGBUF_SIZE);
+                printf("    nBytesReceived: %ld\n", nBytesReceived);
+                printf("    lastWriteSize: %ld\n", lastWriteSize);
+                #endif 
 
             }
 
+            else
+                memcpy(packBuf->data + writeInd, overFlowBuf, nBytesReceived);
+
         }
 
 
 
         else{
-            nBytesReceived = recv(s, packBuf->data + packBuf->writeInd, BUFLEN, 0);
+            nBytesReceived = recv(s, packBuf->data + writeInd, BUFLEN, 0);
             if (nBytesReceived == -1)
             {
                 if (errno == EAGAIN || errno == EWOULDBLOCK)
@@ -529,24 +1090,17 @@ void* reader(void *prms){
                     diep("recvfrom()");
             }
             else if (nBytesReceived == 0 ) continue;
-
-
-            //else if((nBytesReceived + packBuf->writeInd) > RINGBUF_SIZE)
-            //    printf("READER: RINGBUFFER MEMORY OVERFLOW\n");
-            else if((nBytesReceived + packBuf->writeInd) == RINGBUF_SIZE){
-                printf("READER: line 518 shouldn't happen\n");
-                sem_wait(ringBufResetSem);
-                packBuf->writeInd = 0;
-                packBuf->nCycles += 1;
-                sem_post(ringBufResetSem);
-
-            }
-            else
-                packBuf->writeInd += nBytesReceived;
+            updateRoachStats(params->roachStats, packBuf->data + writeInd, nBytesReceived);
 
         }
 
-        nTotalBytes += nBytesReceived;
+        writeCursor += nBytesReceived;
+        packBuf->packEnd[packCount % PACKINDEX_SIZE] = writeCursor;
+        packCount++;
+        atomic_store_explicit(&packBuf->packCount, packCount, memory_order_release);
+        atomic_store_explicit(&packBuf->writeCursor, writeCursor, memory_order_release);
+        ringBufNotify(params->notifier, writeCursor, &lastWakeCursor);
+
         //printf("Received packet from %s:%d\nData: %s\n\n", 
         //        inet_ntoa(si_other.sin_addr), ntohs(si_other.sin_port), buf);
         //printf("Received %d bytes. Data: ",nBytesReceived);
@@ -555,17 +1109,23 @@ void* reader(void *prms){
             printf("Misalign in reader %ld\n",nBytesReceived); fflush(stdout);
         }
 
-        ++nFrames; 
+        params->stats.nRecvCalls++;
+        params->stats.nFrames++;
+        params->stats.nBytes += nBytesReceived;
+        params->stats.lastBatchFrames = 1;
+        params->stats.lastBatchBytes = nBytesReceived;
 
 
     }
 
     //fclose(dump_file);
-    printf("received %ld frames, %ld bytes\n",nFrames,nTotalBytes);
+    printf("received %lu frames, %lu bytes in %lu calls\n", params->stats.nFrames, 
+            params->stats.nBytes, params->stats.nRecvCalls);
     close(s);
+    free(msgs);
+    free(iovecs);
 
     sem_close(quitSem);
-    sem_close(ringBufResetSem);
 
     printf("Reader closing\n");
 
@@ -584,27 +1144,70 @@ void* binWriter(void *prms)
     //char data[1024];
     char fname[120];
     RINGBUFFER *packBuf;
-    uint64_t bufReadInd = 0;
-    uint64_t lastCycle = 0;
-    uint64_t bufWriteInd;
-    uint64_t nWriteCycles;
-    int nUnread;
+    RINGBUF_READ_STATE *readStates;
+    int ringInd, i;
+    uint64_t readCursor;
+    uint64_t writeCursor;
+    uint64_t bufReadInd;
+    uint64_t nUnread;
+    uint64_t ringBacklog;
     BIN_WRITER_PARAMS *params;
+    BIN_WRITE_QUEUE *queue;
+    BIN_INDEX binIndex;
+    BIN_INDEX *index;
+    pthread_t flusherThread;
     sem_t *quitSem;
-    sem_t *ringBufResetSem;
 
     params = (BIN_WRITER_PARAMS*)prms; //cast param struct
     if(params->cpu!=-1)
         ret = MaximizePriority(params->cpu);
 
-    packBuf = params->packBuf;
+    readStates = calloc(params->nPackBufs, sizeof(RINGBUF_READ_STATE));
 
     wp = NULL;
+    queue = NULL;
+    memset(&(params->stats), 0, sizeof(BIN_WRITER_STATS));
+
+    if(params->writeBehind){
+        queue = initBinWriteQueue(params);
+        if(queue == NULL || pthread_create(&flusherThread, NULL, binFlusher, queue) != 0){
+            printf("WRITER: could not start write behind, writing from the ring buffers\n");
+            freeBinWriteQueue(queue);
+            queue = NULL;
+            params->compressLevel = 0;
+
+        }
+
+    }
+    else
+        params->compressLevel = 0;
+
+    if(queue != NULL && params->compressLevel > 0){
+        while(queue->nCompressThreads < params->nCompressThreads 
+                && queue->nCompressThreads < BINWRITER_MAX_COMPRESS_THREADS){
+            if(pthread_create(queue->compressThreads + queue->nCompressThreads, NULL, binCompressor, queue) != 0)
+                break;
+            queue->nCompressThreads++;
+
+        }
+        printf("WRITER: compressing with %d threads, zlib level %d\n", queue->nCompressThreads, 
+                params->compressLevel);
+
+    }
+
+    // with write behind the flusher builds the indices
+    index = NULL;
+    if(params->writeIndex && (queue == NULL)){
+        if(initBinIndex(&binIndex, params->nRows, params->nCols) == 0)
+            index = &binIndex;
+        else
+            printf("WRITER: could not allocate .bin index\n");
+
+    }
 
     printf("Rev up the RAID array, WRITER is active!\n");
 
     quitSem = sem_open(params->quitSemName, O_CREAT, S_IRUSR | S_IWUSR | S_IRGRP | S_IWGRP, 0);
-    ringBufResetSem = sem_open(params->ringBufResetSemName, O_CREAT, S_IRUSR | S_IWUSR | S_IRGRP | S_IWGRP, 0);
     
     // open shared memory block 1 for photon data
     
@@ -618,17 +1221,18 @@ void* binWriter(void *prms)
     // mode = 2 :  continous writing mode, watch for "STOP" or "QUIT" files
     // mode = 3 :  QUIT file detected, exit
 
-    while (sem_trywait(quitSem) == -1){
-       // keep the shared mem clean!       
-       if( mode == 0 ) {
-           getRingBufState(packBuf, ringBufResetSem, &nWriteCycles, &bufWriteInd);
-           bufReadInd = bufWriteInd;
-           lastCycle = nWriteCycles;
+    initWaitStats(&(params->waitStats));
 
-       }
+    while (sem_trywait(quitSem) == -1){
+       // nothing to do until writing starts, don't spin
+       if(mode == 0 && params->writing == 0)
+           idleSleep(params->notifier, &(params->waitStats));
 
        if(mode == 0 && params->writing == 1) {
           // start file exists, go to mode 1
+           // skip everything received while we weren't writing
+           for(ringInd=0; ringInd<params->nPackBufs; ringInd++)
+               readStates[ringInd].readCursor = getRingBufWriteCursor(params->packBufs + ringInd);
            mode = 1;
            printf("Mode 0->1\n");
        } 
@@ -641,7 +1245,13 @@ void* binWriter(void *prms)
           olds = s;
           sprintf(fname,"%s%ld.bin",params->writerPath,s);
           printf("Writing to %s\n",fname);
-          wp = fopen(fname,"wb");
+          if(queue != NULL)
+              queue->cur = acquireBinBlock(queue, s);
+          else{
+              wp = fopen(fname,"wb");
+              params->stats.nFiles++;
+
+          }
           mode = 2;
           outcount = 0;
           printf("Mode 1->2\n");
@@ -650,8 +1260,15 @@ void* binWriter(void *prms)
        if( mode == 2 ) {
           if (params->writing == 0) {
              // stop file exists, finish up and go to mode 0
-	         fclose(wp);
-             wp = NULL;
+             if(queue != NULL)
+                 submitBinBlock(queue, 1);
+             else{
+	             fclose(wp);
+                 wp = NULL;
+                 if(index != NULL)
+                     finishBinIndex(index, params, olds);
+
+             }
              mode = 0;
              printf("Mode 2->0\n");
           } else {
@@ -662,47 +1279,78 @@ void* binWriter(void *prms)
              s  = spec.tv_sec;
 
              if( s - olds >= 1 ) {
-                 fclose(wp);
-                 wp = NULL;
                  sprintf(fname,"%s%ld.bin",params->writerPath,s);
                  printf("WRITER: Writing to %s, rate = %ld MBytes/sec\n",fname,outcount/1000000);
-                 wp = fopen(fname,"wb");
+                 // with write behind the flusher closes the old file and opens the new one
+                 if(queue != NULL){
+                     submitBinBlock(queue, 1);
+                     queue->cur = acquireBinBlock(queue, s);
+
+                 }
+                 else{
+                     fclose(wp);
+                     if(index != NULL)
+                         finishBinIndex(index, params, olds);
+                     wp = fopen(fname,"wb");
+                     params->stats.nFiles++;
+
+                 }
                  olds = s;
+                 params->stats.lastSecondBytes = outcount;
                  outcount = 0;               
              }
 
+             ringBufWait(params->notifier, params->packBufs, readStates, params->nPackBufs, 
+                     BINWRITER_MINSIZE, &(params->waitStats));
+
 	         // write all data in shared memory to disk
-             getRingBufState(packBuf, ringBufResetSem, &nWriteCycles, &bufWriteInd);
-             nUnread = (RINGBUF_SIZE)*(nWriteCycles - lastCycle) + (int)bufWriteInd - bufReadInd;
-             if(nUnread < 0)
-                 printf("Writer: nUnread < 0, unspecified glitch in ring buffer. Have fun!\n");
-             else if(nUnread > RINGBUF_SIZE){
-                 printf("Writer: Missed %d bytes\n", nUnread - RINGBUF_SIZE);
-                 nUnread = RINGBUF_SIZE;
+             // rings only ever hold whole packets up to writeCursor, so output from
+             // each reader's ring can be interleaved at packet granularity
+             ringBacklog = 0;
+             for(ringInd=0; ringInd<params->nPackBufs; ringInd++){
+                 packBuf = params->packBufs + ringInd;
+                 readCursor = readStates[ringInd].readCursor;
+
+                 writeCursor = getRingBufWriteCursor(packBuf);
+                 nUnread = writeCursor - readCursor;
+                 if(ringBufOverwritten(packBuf, readCursor)){
+                     //skip to the write cursor, which is always on a packet boundary
+                     printf("Writer: Missed %lu bytes\n", nUnread);
+                     params->stats.nBytesMissed += nUnread;
+                     readCursor = writeCursor;
+                     nUnread = 0;
 
-                 bufReadInd = (bufWriteInd + 1)%RINGBUF_SIZE;
-                 lastCycle = nWriteCycles - 1;
+                 }
+                 ringBacklog += nUnread;
+                 if(nUnread >= BINWRITER_MINSIZE){
+                     bufReadInd = readCursor % RINGBUF_SIZE;
+                     if(nUnread > (RINGBUF_SIZE - bufReadInd)){ 
+                        writeBinData(wp, queue, index, packBuf->data + bufReadInd, 
+                                RINGBUF_SIZE - bufReadInd, params);
+                        writeBinData(wp, queue, index, packBuf->data, 
+                                nUnread - (RINGBUF_SIZE - bufReadInd), params);
 
-             }
-             if(nUnread >= BINWRITER_MINSIZE){
-                 if(nUnread >= (RINGBUF_SIZE - bufReadInd)){ 
-	                fwrite(packBuf->data + bufReadInd, 1, RINGBUF_SIZE - bufReadInd, wp);    	         
-	                fwrite(packBuf->data, 1, nUnread - (RINGBUF_SIZE - bufReadInd), wp);
-                    lastCycle += 1;
-                    outcount += RINGBUF_SIZE - bufReadInd;
-                    bufReadInd = nUnread - (RINGBUF_SIZE - bufReadInd);
+                     }
 
-                 }
+                    else
+                       writeBinData(wp, queue, index, packBuf->data + bufReadInd, nUnread, params);
 
-                else{
-	                   fwrite(packBuf->data + bufReadInd, 1, nUnread, wp);    	         
-                       bufReadInd += nUnread;
-                       outcount += nUnread;
+                    if(ringBufOverwritten(packBuf, readCursor))
+                        printf("Writer: ring buffer overwritten during write, file may be corrupt\n");
 
-                    }
+                    readCursor += nUnread;
+                    outcount += nUnread;
+
+                 }
+
+                 readStates[ringInd].readCursor = readCursor;
 
              }
 
+             params->stats.ringBacklog = ringBacklog;
+             if(ringBacklog > params->stats.maxRingBacklog)
+                 params->stats.maxRingBacklog = ringBacklog;
+
 
                 
 
@@ -711,10 +1359,30 @@ void* binWriter(void *prms)
 
     }
 
-    if(wp!=NULL)
+    if(wp!=NULL){
 	  fclose(wp);
+      if(index != NULL)
+          finishBinIndex(index, params, olds);
+
+    }
+    if(index != NULL)
+        freeBinIndex(index);
+    if(queue != NULL){
+        if(queue->cur != NULL)
+            submitBinBlock(queue, 1);
+        pthread_mutex_lock(&(queue->lock));
+        queue->quit = 1;
+        pthread_cond_broadcast(&(queue->submitted));
+        pthread_cond_broadcast(&(queue->compressed));
+        pthread_mutex_unlock(&(queue->lock));
+        pthread_join(flusherThread, NULL);
+        for(i=0; i<queue->nCompressThreads; i++)
+            pthread_join(queue->compressThreads[i], NULL);
+        freeBinWriteQueue(queue);
+
+    }
+    free(readStates);
     sem_close(quitSem);
-    sem_close(ringBufResetSem);
 
 /*
     clock_gettime(CLOCK_REALTIME, &spec);
@@ -729,18 +1397,715 @@ void* binWriter(void *prms)
        printf("%ld\n",dat);	
     }
 */
+    printf("WRITER: slept %lu times, mean wake latency %lu us, cpu %lu%%\n", params->waitStats.nWaits,
+            params->waitStats.nWakes ? params->waitStats.wakeLatencyNs/params->waitStats.nWakes/1000 : 0,
+            params->waitStats.wallNs ? 100*params->waitStats.cpuNs/params->waitStats.wallNs : 0);
+    printf("WRITER: read %lu MB from the rings, missed %lu bytes\n", 
+            (params->stats.nBytesWritten + params->stats.queuedBytes)/1000000, params->stats.nBytesMissed);
     printf("WRITER: Closing\n"); fflush(stdout);
     return NULL;
 }
 
+// Allocates the staging buffers for write behind. Returns NULL on failure.
+BIN_WRITE_QUEUE *initBinWriteQueue(BIN_WRITER_PARAMS *params)
+{
+    int i;
+    BIN_WRITE_QUEUE *queue;
+
+    queue = (BIN_WRITE_QUEUE*)calloc(1, sizeof(BIN_WRITE_QUEUE));
+    if(queue == NULL)
+        return NULL;
+    queue->params = params;
+    queue->nBlocks = params->nBlocks > 0 ? params->nBlocks : BINWRITER_NBLOCKS;
+    queue->blockSize = params->blockSize > 0 ? params->blockSize : BINWRITER_BLOCKSIZE;
+    queue->blockSize = (queue->blockSize + BINWRITER_ALIGN - 1)/BINWRITER_ALIGN*BINWRITER_ALIGN;
+    params->blockSize = queue->blockSize;
+    if(params->compressLevel > 0 && params->directIO){
+        printf("WRITER: O_DIRECT is not used for compressed files\n");
+        params->directIO = 0;
+
+    }
+    queue->blocks = (BIN_WRITE_BLOCK*)calloc(queue->nBlocks, sizeof(BIN_WRITE_BLOCK));
+    if(queue->blocks == NULL){
+        free(queue);
+        return NULL;
+
+    }
+
+    for(i=0; i<queue->nBlocks; i++){
+        if(posix_memalign((void**)&(queue->blocks[i].data), BINWRITER_ALIGN, queue->blockSize) != 0){
+            queue->blocks[i].data = NULL;
+            freeBinWriteQueue(queue);
+            return NULL;
+
+        }
+        if(params->compressLevel > 0){
+            queue->blocks[i].compData = (uint8_t*)malloc(sizeof(BINZ_FRAME_HEADER) + compressBound(queue->blockSize));
+            if(queue->blocks[i].compData == NULL){
+                freeBinWriteQueue(queue);
+                return NULL;
+
+            }
+
+        }
+
+    }
+
+    pthread_mutex_init(&(queue->lock), NULL);
+    pthread_cond_init(&(queue->submitted), NULL);
+    pthread_cond_init(&(queue->flushed), NULL);
+    pthread_cond_init(&(queue->compressed), NULL);
+    printf("WRITER: write behind with %d x %lu kB staging buffers\n", queue->nBlocks, queue->blockSize/1024);
+    return queue;
+
+}
+
+void freeBinWriteQueue(BIN_WRITE_QUEUE *queue)
+{
+    int i;
+    if(queue == NULL)
+        return;
+    for(i=0; i<queue->nBlocks; i++){
+        free(queue->blocks[i].data);
+        free(queue->blocks[i].compData);
+
+    }
+    free(queue->blocks);
+    free(queue);
+
+}
+
+// Returns the next staging buffer, emptied and tagged with fileTs. Waits for the flusher
+// if every buffer is still queued.
+BIN_WRITE_BLOCK *acquireBinBlock(BIN_WRITE_QUEUE *queue, time_t fileTs)
+{
+    uint64_t stallStart;
+    BIN_WRITE_BLOCK *block;
+
+    pthread_mutex_lock(&(queue->lock));
+    if(queue->nSubmitted - queue->nFlushed >= queue->nBlocks){
+        stallStart = monotonicNs();
+        queue->params->stats.nStalls++;
+        while(queue->nSubmitted - queue->nFlushed >= queue->nBlocks)
+            pthread_cond_wait(&(queue->flushed), &(queue->lock));
+        queue->params->stats.stallNs += monotonicNs() - stallStart;
+
+    }
+    pthread_mutex_unlock(&(queue->lock));
+
+    block = queue->blocks + queue->nSubmitted % queue->nBlocks;
+    block->nBytes = 0;
+    block->fileTs = fileTs;
+    block->closeFile = 0;
+    block->compressed = 0;
+    return block;
+
+}
+
+// Hands queue->cur to the compression threads (if any) and flusher. If closeFile is set, 
+// the flusher closes the block's file after writing it.
+void submitBinBlock(BIN_WRITE_QUEUE *queue, int closeFile)
+{
+    BIN_WRITER_STATS *stats = &(queue->params->stats);
+
+    queue->cur->closeFile = closeFile;
+    pthread_mutex_lock(&(queue->lock));
+    queue->nSubmitted++;
+    stats->queuedBytes += queue->cur->nBytes;
+    if(stats->queuedBytes > stats->maxQueuedBytes)
+        stats->maxQueuedBytes = stats->queuedBytes;
+    pthread_cond_broadcast(&(queue->submitted));
+    pthread_mutex_unlock(&(queue->lock));
+    queue->cur = NULL;
+
+}
+
+// Writes nBytes of ring data to the current file (and index, if not NULL), or stages them 
+// for the flusher if queue is not NULL
+void writeBinData(FILE *wp, BIN_WRITE_QUEUE *queue, BIN_INDEX *index, uint8_t *data, uint64_t nBytes, 
+        BIN_WRITER_PARAMS *params)
+{
+    uint64_t nCopy;
+    time_t fileTs;
+
+    if(queue == NULL){
+        if(fwrite(data, 1, nBytes, wp) == nBytes)
+            params->stats.nBytesWritten += nBytes;
+        else
+            params->stats.nWriteErrors++;
+        if(index != NULL)
+            addBinIndexData(index, data, nBytes);
+        return;
+
+    }
+
+    while(nBytes > 0){
+        nCopy = queue->blockSize - queue->cur->nBytes;
+        if(nCopy > nBytes)
+            nCopy = nBytes;
+        memcpy(queue->cur->data + queue->cur->nBytes, data, nCopy);
+        queue->cur->nBytes += nCopy;
+        data += nCopy;
+        nBytes -= nCopy;
+
+        if(queue->cur->nBytes == queue->blockSize){
+            fileTs = queue->cur->fileTs;
+            submitBinBlock(queue, 0);
+            queue->cur = acquireBinBlock(queue, fileTs);
+
+        }
+
+    }
+
+}
+
+// Writes the path of the file for second fileTs into fname (at least STRBUF+32 chars):
+// <writerPath><fileTs>.bin, or .binz if compressing
+void binFileName(char *fname, BIN_WRITER_PARAMS *params, time_t fileTs)
+{
+    sprintf(fname, params->compressLevel > 0 ? "%s%ld.binz" : "%s%ld.bin", params->writerPath, fileTs);
+
+}
+
+// Opens (creating or truncating) binFileName() for the flusher, preallocating it if 
+// requested. Returns the file descriptor or -1.
+int openBinFile(BIN_WRITER_PARAMS *params, time_t fileTs)
+{
+    int fd;
+    char fname[STRBUF+32];
+    BINZ_FILE_HEADER header;
+
+    binFileName(fname, params, fileTs);
+    fd = -1;
+    if(params->directIO){
+        fd = open(fname, O_WRONLY | O_CREAT | O_TRUNC | O_DIRECT, 0664);
+        if(fd < 0 && errno == EINVAL){
+            printf("WRITER: %s does not support O_DIRECT, using buffered writes\n", params->writerPath);
+            params->directIO = 0;
+
+        }
+
+    }
+    if(fd < 0 && !params->directIO)
+        fd = open(fname, O_WRONLY | O_CREAT | O_TRUNC, 0664);
+    if(fd < 0){
+        printf("WRITER: error opening %s: %s\n", fname, strerror(errno));
+        params->stats.nWriteErrors++;
+        return -1;
+
+    }
+
+    if(params->preallocBytes > 0)
+        if(fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, params->preallocBytes) != 0){
+            printf("WRITER: could not preallocate %s: %s\n", fname, strerror(errno));
+            params->preallocBytes = 0;
+
+        }
+
+    if(params->compressLevel > 0){
+        header.magic = BINZ_MAGIC;
+        header.version = BINZ_VERSION;
+        header.codec = BINZ_CODEC_ZLIB;
+        header.blockSize = params->blockSize;
+        if(write(fd, &header, sizeof(header)) != sizeof(header)){
+            printf("WRITER: error writing %s: %s\n", fname, strerror(errno));
+            params->stats.nWriteErrors++;
+
+        }
+
+    }
+
+    params->stats.nFiles++;
+    return fd;
+
+}
+
+// Writes a staging block (or its compressed frame) at the end of fd and returns the number
+// of bytes written. With O_DIRECT only the last block of a file may have a length that 
+// isn't a multiple of BINWRITER_ALIGN; its tail is written through the page cache.
+uint64_t writeBinBlock(int fd, BIN_WRITE_BLOCK *block, BIN_WRITER_PARAMS *params)
+{
+    uint64_t nAligned;
+    uint64_t nWritten;
+    uint64_t nBytes;
+    uint64_t writeStart;
+    uint8_t *data;
+    ssize_t ret;
+    char fname[STRBUF+32];
+
+    data = params->compressLevel > 0 ? block->compData : block->data;
+    nBytes = params->compressLevel > 0 ? block->compBytes : block->nBytes;
+    nAligned = nBytes;
+    if(params->directIO)
+        nAligned -= nBytes % BINWRITER_ALIGN;
+
+    writeStart = monotonicNs();
+    nWritten = 0;
+    while(nWritten < nBytes){
+        if(nWritten == nAligned)
+            fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) & ~O_DIRECT);
+        ret = write(fd, data + nWritten, (nWritten < nAligned ? nAligned : nBytes) - nWritten);
+        if(ret < 0){
+            if(errno == EINTR)
+                continue;
+            binFileName(fname, params, block->fileTs);
+            printf("WRITER: error writing %s: %s\n", fname, strerror(errno));
+            params->stats.nWriteErrors++;
+            break;
+
+        }
+        nWritten += ret;
+
+    }
+
+    params->stats.writeNs += monotonicNs() - writeStart;
+    params->stats.nBytesWritten += nWritten;
+    return nWritten;
+
+}
+
+void closeBinFile(int fd, uint64_t fileBytes, BIN_WRITER_PARAMS *params)
+{
+    uint64_t fsyncStart, fsyncNs;
+
+    // drop preallocated space past the data
+    if(params->preallocBytes > 0)
+        ftruncate(fd, fileBytes);
+
+    if(params->fsyncFiles){
+        fsyncStart = monotonicNs();
+        fsync(fd);
+        fsyncNs = monotonicNs() - fsyncStart;
+        params->stats.nFsyncs++;
+        params->stats.fsyncNs += fsyncNs;
+        params->stats.lastFsyncNs = fsyncNs;
+        if(fsyncNs > params->stats.maxFsyncNs)
+            params->stats.maxFsyncNs = fsyncNs;
+
+    }
+
+    close(fd);
+
+}
+
+// Write behind thread for binWriter: writes staging blocks in order, opening and closing
+// .bin files as the blocks' fileTs changes. Exits once queue->quit is set and every
+// submitted block is written.
+void *binFlusher(void *prms)
+{
+    int fd = -1;
+    int cpu;
+    time_t fileTs = 0;
+    uint64_t fileBytes = 0;
+    cpu_set_t cpuset;
+    BIN_WRITE_BLOCK *block;
+    BIN_INDEX binIndex;
+    BIN_INDEX *index = NULL;
+    BIN_WRITE_QUEUE *queue = (BIN_WRITE_QUEUE*)prms;
+    BIN_WRITER_PARAMS *params = queue->params;
+
+    // don't compete with binWriter for its cpu
+    if(params->cpu != -1){
+        CPU_ZERO(&cpuset);
+        for(cpu=0; cpu<sysconf(_SC_NPROCESSORS_ONLN); cpu++)
+            if(cpu != params->cpu)
+                CPU_SET(cpu, &cpuset);
+        if(CPU_COUNT(&cpuset) > 0)
+            pthread_setaffinity_np(pthread_self(), sizeof(cpu_set_t), &cpuset);
+
+    }
+
+    if(params->writeIndex){
+        if(initBinIndex(&binIndex, params->nRows, params->nCols) == 0)
+            index = &binIndex;
+        else
+            printf("WRITER: could not allocate .bin index\n");
+
+    }
+
+    while(1){
+        pthread_mutex_lock(&(queue->lock));
+        block = queue->blocks + queue->nFlushed % queue->nBlocks;
+        // with compression wait for the oldest block's frame, not just the block
+        while(((queue->nFlushed == queue->nSubmitted) && !queue->quit) || ((queue->nFlushed < queue->nSubmitted) 
+                    && (queue->nCompressThreads > 0) && !block->compressed))
+            pthread_cond_wait(queue->nCompressThreads > 0 ? &(queue->compressed) : &(queue->submitted), 
+                    &(queue->lock));
+        if(queue->nFlushed == queue->nSubmitted){
+            pthread_mutex_unlock(&(queue->lock));
+            break;
+
+        }
+        pthread_mutex_unlock(&(queue->lock));
+
+        if((fd >= 0) && (block->fileTs != fileTs)){
+            closeBinFile(fd, fileBytes, params);
+            if(index != NULL)
+                finishBinIndex(index, params, fileTs);
+            fd = -1;
+
+        }
+        if(fd < 0){
+            fd = openBinFile(params, block->fileTs);
+            fileTs = block->fileTs;
+            fileBytes = params->compressLevel > 0 ? sizeof(BINZ_FILE_HEADER) : 0;
+
+        }
+        if(fd >= 0){
+            fileBytes += writeBinBlock(fd, block, params);
+            if(index != NULL)
+                addBinIndexData(index, block->data, block->nBytes);
+            if(block->closeFile){
+                closeBinFile(fd, fileBytes, params);
+                if(index != NULL)
+                    finishBinIndex(index, params, fileTs);
+                fd = -1;
+
+            }
+
+        }
+
+        pthread_mutex_lock(&(queue->lock));
+        queue->nFlushed++;
+        params->stats.queuedBytes -= block->nBytes;
+        pthread_cond_signal(&(queue->flushed));
+        pthread_mutex_unlock(&(queue->lock));
+
+    }
+
+    if(fd >= 0){
+        closeBinFile(fd, fileBytes, params);
+        if(index != NULL)
+            finishBinIndex(index, params, fileTs);
+
+    }
+    if(index != NULL)
+        freeBinIndex(index);
+    printf("WRITER: flusher wrote %lu MB to %lu files, %lu fsyncs, max fsync %lu ms\n",
+            params->stats.nBytesWritten/1000000, params->stats.nFiles, params->stats.nFsyncs,
+            params->stats.maxFsyncNs/1000000);
+    return NULL;
+
+}
+
+// Compression thread for binWriter's write behind: compresses submitted blocks into BINZ
+// frames, several blocks at a time across threads. The flusher writes frames in block order.
+void *binCompressor(void *prms)
+{
+    uint8_t *shuffleBuf;
+    uint64_t compressStart;
+    BIN_WRITE_BLOCK *block;
+    BIN_WRITE_QUEUE *queue = (BIN_WRITE_QUEUE*)prms;
+    BIN_WRITER_STATS *stats = &(queue->params->stats);
+
+    shuffleBuf = (uint8_t*)malloc(queue->blockSize);
+    if(shuffleBuf == NULL){
+        printf("WRITER: could not allocate compression buffer\n");
+        return NULL;
+
+    }
+
+    pthread_mutex_lock(&(queue->lock));
+    while(1){
+        while((queue->nCompressStarted == queue->nSubmitted) && !queue->quit)
+            pthread_cond_wait(&(queue->submitted), &(queue->lock));
+        if(queue->nCompressStarted == queue->nSubmitted)
+            break;
+        block = queue->blocks + queue->nCompressStarted % queue->nBlocks;
+        queue->nCompressStarted++;
+        pthread_mutex_unlock(&(queue->lock));
+
+        compressStart = monotonicNs();
+        compressBinBlock(block, shuffleBuf, queue->params->compressLevel);
+
+        pthread_mutex_lock(&(queue->lock));
+        block->compressed = 1;
+        stats->compressNs += monotonicNs() - compressStart;
+        stats->compressRawBytes += block->nBytes;
+        stats->compressOutBytes += block->compBytes;
+        pthread_cond_broadcast(&(queue->compressed));
+
+    }
+    pthread_mutex_unlock(&(queue->lock));
+
+    free(shuffleBuf);
+    return NULL;
+
+}
+
+// Writes block->data as one BINZ frame into block->compData, stored raw if deflating
+// doesn't make it smaller
+void compressBinBlock(BIN_WRITE_BLOCK *block, uint8_t *shuffleBuf, int level)
+{
+    BINZ_FRAME_HEADER *frame = (BINZ_FRAME_HEADER*)block->compData;
+    uint8_t *compData = block->compData + sizeof(BINZ_FRAME_HEADER);
+    uLongf compBytes = compressBound(block->nBytes);
+    int ret;
+
+    shuffleWords(shuffleBuf, block->data, block->nBytes);
+    ret = compress2(compData, &compBytes, shuffleBuf, block->nBytes, level);
+    frame->rawBytes = block->nBytes;
+    frame->reserved = 0;
+    if((ret == Z_OK) && (compBytes < block->nBytes)){
+        frame->flags = BINZ_FRAME_SHUFFLED;
+        frame->compBytes = compBytes;
+
+    }
+    else{
+        memcpy(compData, block->data, block->nBytes);
+        frame->flags = BINZ_FRAME_STORED;
+        frame->compBytes = block->nBytes;
+
+    }
+    block->compBytes = sizeof(BINZ_FRAME_HEADER) + frame->compBytes;
+
+}
+
+// Transposes the bytes of the 8 byte words in src: dest holds byte 0 of every word, then
+// byte 1, etc. Headers and photon fields change slowly from word to word, so this puts
+// long runs of similar bytes together. Trailing bytes of a partial word are copied as is.
+void shuffleWords(uint8_t *dest, uint8_t *src, uint64_t nBytes)
+{
+    uint64_t i, nWords = nBytes/8;
+    int j;
+
+    for(j=0; j<8; j++)
+        for(i=0; i<nWords; i++)
+            dest[j*nWords + i] = src[8*i + j];
+    memcpy(dest + 8*nWords, src + 8*nWords, nBytes - 8*nWords);
+
+}
+
+// Allocates index for a nRows x nCols array. Returns 0 on success.
+int initBinIndex(BIN_INDEX *index, int nRows, int nCols)
+{
+    memset(index, 0, sizeof(BIN_INDEX));
+    index->header.magic = BIN_INDEX_MAGIC;
+    index->header.version = BIN_INDEX_VERSION;
+    index->header.nRows = nRows;
+    index->header.nCols = nCols;
+    index->counts = (uint32_t*)malloc((size_t)nRows*nCols*sizeof(uint32_t));
+    index->pixelRoach = (uint8_t*)malloc((size_t)nRows*nCols);
+    index->nAllocated = 4096;
+    index->entries = (BIN_INDEX_ENTRY*)malloc(index->nAllocated*sizeof(BIN_INDEX_ENTRY));
+    if(index->counts == NULL || index->pixelRoach == NULL || index->entries == NULL){
+        freeBinIndex(index);
+        return -1;
+
+    }
+    resetBinIndex(index);
+    return 0;
+
+}
+
+// Empties index for the next file
+void resetBinIndex(BIN_INDEX *index)
+{
+    uint64_t nPix = (uint64_t)index->header.nRows*index->header.nCols;
+
+    memset(index->counts, 0, nPix*sizeof(uint32_t));
+    memset(index->pixelRoach, BIN_INDEX_NO_ROACH, nPix);
+    index->header.nEntries = 0;
+    index->header.fileBytes = 0;
+    index->header.nPhotons = 0;
+    index->header.firstTimestamp = 0;
+    index->header.lastTimestamp = 0;
+    index->offset = 0;
+    index->nCarry = 0;
+
+}
+
+void freeBinIndex(BIN_INDEX *index)
+{
+    free(index->counts);
+    free(index->pixelRoach);
+    free(index->entries);
+    index->counts = NULL;
+    index->pixelRoach = NULL;
+    index->entries = NULL;
+
+}
+
+// Indexes the next nBytes of the .bin file. Data is a stream of 8 byte words, so 
+// packets may be split across calls anywhere.
+void addBinIndexData(BIN_INDEX *index, uint8_t *data, uint64_t nBytes)
+{
+    uint64_t word, swp, pixInd;
+    uint64_t nPix = (uint64_t)index->header.nRows*index->header.nCols;
+    STREAM_HEADER *hdr = (STREAM_HEADER*)&swp;
+    PHOTON_WORD *photon = (PHOTON_WORD*)&swp;
+    BIN_INDEX_ENTRY *entry;
+    int nCopy;
+
+    // only the last entry is still growing
+    entry = index->header.nEntries ? index->entries + index->header.nEntries - 1 : NULL;
+
+    while(nBytes > 0){
+        if(index->nCarry > 0 || nBytes < 8){
+            nCopy = 8 - index->nCarry;
+            if(nCopy > nBytes)
+                nCopy = nBytes;
+            memcpy(index->carry + index->nCarry, data, nCopy);
+            index->nCarry += nCopy;
+            data += nCopy;
+            nBytes -= nCopy;
+            if(index->nCarry < 8)
+                break;
+            memcpy(&word, index->carry, 8);
+            index->nCarry = 0;
+
+        }
+        else{
+            memcpy(&word, data, 8);
+            data += 8;
+            nBytes -= 8;
+
+        }
+
+        swp = __bswap_64(word);
+        if(hdr->start == 0b11111111){
+            if((entry == NULL) || (entry->roach != hdr->roach) || (entry->timestamp != hdr->timestamp)){
+                if(entry != NULL)
+                    entry->nBytes = index->offset - entry->offset;
+                if(index->header.nEntries == index->nAllocated){
+                    index->nAllocated *= 2;
+                    index->entries = (BIN_INDEX_ENTRY*)realloc(index->entries, 
+                            index->nAllocated*sizeof(BIN_INDEX_ENTRY));
+
+                }
+                entry = index->entries + index->header.nEntries;
+                index->header.nEntries++;
+                entry->offset = index->offset;
+                entry->timestamp = hdr->timestamp;
+                entry->roach = hdr->roach;
+                entry->nPhotons = 0;
+                entry->nBytes = 0;
+                entry->reserved = 0;
+                if(index->header.nEntries == 1)
+                    index->header.firstTimestamp = hdr->timestamp;
+                index->header.lastTimestamp = hdr->timestamp;
+
+            }
+
+        }
+
+        else{
+            pixInd = (uint64_t)index->header.nCols*photon->ycoord + photon->xcoord;
+            if((photon->xcoord < index->header.nCols) && (pixInd < nPix)){
+                index->counts[pixInd]++;
+                if(entry != NULL)
+                    index->pixelRoach[pixInd] = entry->roach;
+
+            }
+            if(entry != NULL)
+                entry->nPhotons++;
+            index->header.nPhotons++;
+
+        }
+
+        index->offset += 8;
+
+    }
+
+}
+
+// Writes index to fname (via a temporary file, so readers never see a partial index).
+// Returns 0 on success.
+int writeBinIndex(BIN_INDEX *index, const char *fname)
+{
+    FILE *fp;
+    char tmpName[STRBUF+40];
+    uint64_t nPix = (uint64_t)index->header.nRows*index->header.nCols;
+    uint64_t zero = 0;
+    int ret = 0;
+
+    if(index->header.nEntries > 0)
+        index->entries[index->header.nEntries-1].nBytes = 
+            index->offset - index->entries[index->header.nEntries-1].offset;
+    index->header.fileBytes = index->offset + index->nCarry;
+
+    sprintf(tmpName, "%s.tmp", fname);
+    fp = fopen(tmpName, "wb");
+    if(fp == NULL)
+        return -1;
+    if(fwrite(&(index->header), sizeof(BIN_INDEX_HEADER), 1, fp) != 1)
+        ret = -1;
+    if(fwrite(index->counts, sizeof(uint32_t), nPix, fp) != nPix)
+        ret = -1;
+    if(fwrite(index->pixelRoach, 1, nPix, fp) != nPix)
+        ret = -1;
+    if(nPix % 8)
+        fwrite(&zero, 1, 8 - nPix % 8, fp);
+    if(fwrite(index->entries, sizeof(BIN_INDEX_ENTRY), index->header.nEntries, fp) != index->header.nEntries)
+        ret = -1;
+    if(fclose(fp) != 0)
+        ret = -1;
+
+    if(ret == 0)
+        ret = rename(tmpName, fname);
+    else
+        unlink(tmpName);
+    return ret;
+
+}
+
+// Writes the index for <writerPath><fileTs>.bin and resets it for the next file
+void finishBinIndex(BIN_INDEX *index, BIN_WRITER_PARAMS *params, time_t fileTs)
+{
+    char fname[STRBUF+32];
+
+    sprintf(fname, "%s%ld.idx", params->writerPath, fileTs);
+    if(writeBinIndex(index, fname) != 0){
+        printf("WRITER: error writing index %s\n", fname);
+        params->stats.nWriteErrors++;
+
+    }
+    resetBinIndex(index);
+
+}
+
 void addPacketToImage(MKID_IMAGE *sharedImage, char *photonWord, 
         unsigned int l, WAVECAL_BUFFER *wavecal)
+{
+    addPacketToFrame(sharedImage, sharedImage->image, photonWord, l, wavecal, NULL);
+
+}
+
+// Same as addPacketToImage, but into the given frame buffer of sharedImage
+void addPacketToFrame(MKID_IMAGE *sharedImage, image_t *frame, char *photonWord, 
+        unsigned int l, WAVECAL_BUFFER *wavecal, WVL_BIN_TABLE *binTable)
 {
     uint64_t i;
     PHOTON_WORD *data;
     uint64_t swp,swp1;
-    float wvl, wvlBinSpacing;
     int wvlBinInd;
+    uint32_t nCols = sharedImage->md->nCols;
+    uint32_t nRows = sharedImage->md->nRows;
+    uint8_t *bins = NULL;
+    wvlcoeff_t *coeffs = NULL;
+    uint32_t generation;
+
+    if(!sharedImage->md->takingImage)
+        return;
+
+    if(sharedImage->md->useWvl){
+        if(wavecal == NULL){
+            perror("ERROR: No wavecal buffer specified!");
+            return;
+
+        }
+
+        // use the coefficients the bin table was built from so both agree
+        if(binTable != NULL){
+            bins = binTable->bins;
+            coeffs = wavecal->tables[binTable->wavecalGeneration % 2].data;
+
+        }
+
+        else
+            coeffs = getWavecalTable(wavecal, &generation)->data;
+
+    }
 
     for(i=1;i<l/8;i++) {
        
@@ -748,62 +2113,185 @@ void addPacketToImage(MKID_IMAGE *sharedImage, char *photonWord,
         swp1 = __bswap_64(swp);
         data = (PHOTON_WORD *) (&swp1);
         
-        if( data->xcoord >= sharedImage->md->nCols || data->ycoord >= sharedImage->md->nRows ) 
+        if( data->xcoord >= nCols || data->ycoord >= nRows ) 
             continue;
 
         if((sharedImage->md->useWvl)){
-            if(wavecal == NULL){
-                perror("ERROR: No wavecal buffer specified!");
-                continue;
-
-            }
-            wvl = getWavelength(data, wavecal);
-
-            if(sharedImage->md->useEdgeBins){
-                if(wvl < sharedImage->md->wvlStart)
-                    wvlBinInd = 0;
-                else if(wvl >= sharedImage->md->wvlStop)
-                    wvlBinInd = sharedImage->md->nWvlBins + 1;
-                else{
-                    wvlBinSpacing = (double)(sharedImage->md->wvlStop - sharedImage->md->wvlStart)/sharedImage->md->nWvlBins;
-                    wvlBinInd = (int)(wvl - sharedImage->md->wvlStart)/wvlBinSpacing + 1;
+            if(bins != NULL){
+                wvlBinInd = bins[(nCols*data->ycoord + data->xcoord)*WVL_LUT_SIZE 
+                    + ((data->phase + (1<<(PHASE_BITS-1))) >> (PHASE_BITS - WVL_LUT_BITS))];
+                if(wvlBinInd == WVL_BIN_EXACT) //cell straddles a bin edge
+                    wvlBinInd = getWvlBin(getCoeffWavelength(data->phase, data->xcoord, data->ycoord, 
+                                coeffs, wavecal->nCols), sharedImage->md);
+                else if(wvlBinInd == WVL_BIN_DROP)
+                    continue;
 
-                }
             }
 
-            else{
-                if((wvl < sharedImage->md->wvlStart) || (wvl >= sharedImage->md->wvlStop))
-                    continue;
-                else{
-                    wvlBinSpacing = (double)(sharedImage->md->wvlStop - sharedImage->md->wvlStart)/sharedImage->md->nWvlBins;
-                    wvlBinInd = (int)(wvl - sharedImage->md->wvlStart)/wvlBinSpacing;
-
-                }
+            else
+                wvlBinInd = getWvlBin(getCoeffWavelength(data->phase, data->xcoord, data->ycoord, 
+                            coeffs, wavecal->nCols), sharedImage->md);
 
-            }
+            if(wvlBinInd < 0)
+                continue;
 
-            if(sharedImage->md->takingImage)
-                sharedImage->image[(sharedImage->md->nCols)*(sharedImage->md->nRows)*wvlBinInd + (sharedImage->md->nCols)*(data->ycoord) + data->xcoord]++;
+            frame[nCols*nRows*wvlBinInd + nCols*(data->ycoord) + data->xcoord]++;
 
         }
         
         else
-            if(sharedImage->md->takingImage)
-                sharedImage->image[(sharedImage->md->nCols)*(data->ycoord) + data->xcoord]++;
+            frame[nCols*(data->ycoord) + data->xcoord]++;
       
     }
 
 }
 
+// Wavelength bin of wvl in a shared image, -1 if the photon isn't counted
+int getWvlBin(float wvl, MKID_IMAGE_METADATA *md)
+{
+    float wvlBinSpacing;
+
+    if(md->useEdgeBins){
+        if(wvl < md->wvlStart)
+            return 0;
+        else if(wvl >= md->wvlStop)
+            return md->nWvlBins + 1;
+        else{
+            wvlBinSpacing = (double)(md->wvlStop - md->wvlStart)/md->nWvlBins;
+            return (int)(wvl - md->wvlStart)/wvlBinSpacing + 1;
+
+        }
+    }
+
+    else{
+        if((wvl < md->wvlStart) || (wvl >= md->wvlStop))
+            return -1;
+        else{
+            wvlBinSpacing = (double)(md->wvlStop - md->wvlStart)/md->nWvlBins;
+            return (int)(wvl - md->wvlStart)/wvlBinSpacing;
+
+        }
+
+    }
+
+}
+
+// Rebuilds binTable if the image's wavelength binning or the wavecal generation changed since
+// it was built. Returns 1 if the table was rebuilt. Images with more than WVL_LUT_MAX_BINS 
+// bins get no table (bins = NULL) and are binned photon by photon.
+int updateWvlBinTable(WVL_BIN_TABLE *binTable, MKID_IMAGE_METADATA *md, WAVECAL_BUFFER *wavecal, 
+        uint32_t generation)
+{
+    uint32_t x, y, cell;
+    int phase0, phase1, bin0, bin1;
+    int bufferInd;
+    float coeffA, coeffB, wvl0, wvl1, degPerPhase, vertex;
+    uint8_t *pixBins;
+    wvlcoeff_t *coeffs;
+    struct timespec startSpec, stopSpec;
+
+    if(!md->useWvl || (wavecal == NULL))
+        return 0;
+
+    if((binTable->bins != NULL) && (binTable->nCols == md->nCols) && (binTable->nRows == md->nRows) 
+            && (binTable->nWvlBins == md->nWvlBins) && (binTable->useEdgeBins == md->useEdgeBins) 
+            && (binTable->wvlStart == md->wvlStart) && (binTable->wvlStop == md->wvlStop)
+            && (binTable->wavecalGeneration == generation))
+        return 0;
+
+    clock_gettime(CLOCK_MONOTONIC, &startSpec);
+    freeWvlBinTable(binTable);
+    binTable->nCols = md->nCols;
+    binTable->nRows = md->nRows;
+    binTable->nWvlBins = md->nWvlBins;
+    binTable->useEdgeBins = md->useEdgeBins;
+    binTable->wvlStart = md->wvlStart;
+    binTable->wvlStop = md->wvlStop;
+    binTable->wavecalGeneration = generation;
+    if(md->nWvlBins + 2*md->useEdgeBins > WVL_LUT_MAX_BINS)
+        return 1;
+
+    binTable->bins = (uint8_t*)malloc((size_t)md->nCols*md->nRows*WVL_LUT_SIZE);
+    degPerPhase = RAD_TO_DEG/PHASE_BIN_PT;
+    coeffs = wavecal->tables[generation % 2].data;
+
+    for(y=0; y<md->nRows; y++)
+        for(x=0; x<md->nCols; x++){
+            pixBins = binTable->bins + (md->nCols*y + x)*WVL_LUT_SIZE;
+            bufferInd = 3*(wavecal->nCols*y + x);
+            coeffA = coeffs[bufferInd];
+            coeffB = coeffs[bufferInd+1];
+
+            for(cell=0; cell<WVL_LUT_SIZE; cell++){
+                phase0 = (int)(cell << (PHASE_BITS - WVL_LUT_BITS)) - (1<<(PHASE_BITS-1));
+                phase1 = phase0 + (1<<(PHASE_BITS - WVL_LUT_BITS)) - 1;
+                wvl0 = getCoeffWavelength(phase0, x, y, coeffs, wavecal->nCols);
+                wvl1 = getCoeffWavelength(phase1, x, y, coeffs, wavecal->nCols);
+                bin0 = getWvlBin(wvl0, md);
+                bin1 = getWvlBin(wvl1, md);
+
+                // wavelength is monotonic across the cell unless the energy quadratic turns 
+                // over or crosses 0 inside it, so equal bins at both ends cover the whole cell
+                vertex = (coeffA != 0) ? -coeffB/(2*coeffA)/degPerPhase : phase0 - 1;
+                if((bin0 != bin1) || (vertex >= phase0 && vertex <= phase1) || !(wvl0*wvl1 > 0))
+                    pixBins[cell] = WVL_BIN_EXACT;
+                else if(bin0 < 0)
+                    pixBins[cell] = WVL_BIN_DROP;
+                else
+                    pixBins[cell] = (uint8_t)bin0;
+
+            }
+
+        }
+
+    clock_gettime(CLOCK_MONOTONIC, &stopSpec);
+    printf("SharedImageWriter: built wavelength bin table for %s in %ld ms\n", md->name,
+            (long)(1000*(stopSpec.tv_sec - startSpec.tv_sec) + (stopSpec.tv_nsec - startSpec.tv_nsec)/1000000));
+    return 1;
+
+}
+
+void freeWvlBinTable(WVL_BIN_TABLE *binTable)
+{
+    free(binTable->bins);
+    binTable->bins = NULL;
+
+}
+
 void addPacketToEventBuffer(MKID_EVENT_BUFFER *buffer, char *photonWord, 
         unsigned int l, uint64_t headerTS, WAVECAL_BUFFER *wavecal, int nRows, int nCols)
+{
+    MKID_PHOTON_EVENT photons[MAX_PACKSIZE/8];
+    int nPhotons;
+
+    nPhotons = parsePacketToEvents(photons, photonWord, l, headerTS, tsOffset(), wavecal, buffer->md->useWvl, nRows, nCols);
+    if(nPhotons > 0)
+        MKIDShmEventBuffer_addEvents(buffer, photons, nPhotons);
+
+}
+
+int parsePacketToEvents(MKID_PHOTON_EVENT *photons, char *photonWord, unsigned int l, 
+        uint64_t headerTS, time_t tsOffs, WAVECAL_BUFFER *wavecal, int useWvl, int nRows, int nCols)
 {
     uint64_t i;
+    int nPhotons = 0;
     PHOTON_WORD *data;
-    MKID_PHOTON_EVENT photon;
     uint64_t swp,swp1;
-    float wvl, wvlBinSpacing;
-    int wvlBinInd;
+    uint64_t packetTime;
+    float wvl;
+    wvlcoeff_t *coeffs = NULL;
+    uint32_t generation;
+
+    if(useWvl && (wavecal == NULL)){
+        perror("ERROR: No wavecal buffer specified!");
+        return 0;
+
+    }
+
+    if(useWvl)
+        coeffs = getWavecalTable(wavecal, &generation)->data;
+
+    packetTime = 500*((uint64_t)2000*tsOffs + headerTS);
 
     for(i=1;i<l/8;i++) {
        
@@ -814,47 +2302,303 @@ void addPacketToEventBuffer(MKID_EVENT_BUFFER *buffer, char *photonWord,
         if( data->xcoord >= nCols || data->ycoord >= nRows ) 
             continue;
 
-        if((buffer->md->useWvl)){
-            if(wavecal == NULL){
-                perror("ERROR: No wavecal buffer specified!");
-                continue;
-
-            }
-            wvl = getWavelength(data, wavecal);
-
-        }
-            
+        if(useWvl)
+            wvl = getCoeffWavelength(data->phase, data->xcoord, data->ycoord, coeffs, wavecal->nCols);
         else
             wvl = (float)data->phase/PHASE_BIN_PT; //phase in radians
 
-        photon.time = 500*((uint64_t)2000*TSOFFS + headerTS) + data->timestamp;
-        photon.x = data->xcoord;
-        photon.y = data->ycoord;
-        photon.wvl = (wvl_t)wvl;
-
-        MKIDShmEventBuffer_addEvent(buffer, &photon);
+        photons[nPhotons].time = packetTime + data->timestamp;
+        photons[nPhotons].x = data->xcoord;
+        photons[nPhotons].y = data->ycoord;
+        photons[nPhotons].wvl = (wvl_t)wvl;
+        nPhotons++;
 
     }
 
+    return nPhotons;
 
 }
 
 float getWavelength(PHOTON_WORD *photon, WAVECAL_BUFFER *wavecal){
-    float phase = (float)photon->phase*RAD_TO_DEG/PHASE_BIN_PT;
-    int bufferInd = 3*(wavecal->nCols * photon->ycoord + photon->xcoord);
-    float energy = phase*phase*wavecal->data[bufferInd] + phase*wavecal->data[bufferInd+1]
-        + wavecal->data[bufferInd+2];
-    //printf("%f %f | ", phase, energy);
+    return getPixelWavelength(photon->phase, photon->xcoord, photon->ycoord, wavecal);
+
+}
+
+float getPixelWavelength(int phase, int x, int y, WAVECAL_BUFFER *wavecal){
+    uint32_t generation;
+
+    return getCoeffWavelength(phase, x, y, getWavecalTable(wavecal, &generation)->data, wavecal->nCols);
+
+}
+
+float getCoeffWavelength(int phase, int x, int y, wvlcoeff_t *coeffs, uint32_t nCols){
+    float phaseDeg = (float)phase*RAD_TO_DEG/PHASE_BIN_PT;
+    int bufferInd = 3*(nCols * y + x);
+    float energy = phaseDeg*phaseDeg*coeffs[bufferInd] + phaseDeg*coeffs[bufferInd+1]
+        + coeffs[bufferInd+2];
+    //printf("%f %f | ", phaseDeg, energy);
     return H_TIMES_C/energy;
 
 }
 
-void getRingBufState(RINGBUFFER* packBuf, sem_t *ringBufResetSem, uint64_t *nCycles, uint64_t *writeInd){
-    sem_wait(ringBufResetSem);
-    *nCycles = packBuf->nCycles;
-    *writeInd = packBuf->writeInd;
-    sem_post(ringBufResetSem);
-    
+// Current wavecal table and its generation. The table stays valid until the next update 
+// after the one that replaces it.
+WAVECAL_TABLE *getWavecalTable(WAVECAL_BUFFER *wavecal, uint32_t *generation){
+    *generation = atomic_load_explicit(&wavecal->generation, memory_order_acquire);
+    return wavecal->tables + (*generation % 2);
+
+}
+
+// Switches the shared images to wavecal generation: stamps it and the solution file in their
+// metadata and rebuilds the wavelength bin tables of the images that are integrating
+void pickUpWavecal(MKID_IMAGE *sharedImages, WVL_BIN_TABLE *binTables, int nSharedImages, 
+        WAVECAL_BUFFER *wavecal, uint32_t generation){
+    int i;
+
+    for(i=0; i<nSharedImages; i++){
+        sharedImages[i].md->wavecalGeneration = generation;
+        snprintf(sharedImages[i].md->wavecalID, WVLIDLEN, "%s", wavecal->tables[generation % 2].solutionFile);
+        if(sharedImages[i].md->takingImage)
+            updateWvlBinTable(binTables + i, sharedImages[i].md, wavecal, generation);
+
+    }
+
+}
+
+void initRingBuf(RINGBUFFER *packBuf){
+    atomic_init(&packBuf->writeCursor, 0);
+    atomic_init(&packBuf->packCount, 0);
+
+}
+
+uint64_t getRingBufWriteCursor(RINGBUFFER *packBuf){
+    return atomic_load_explicit(&packBuf->writeCursor, memory_order_acquire);
+
+}
+
+uint64_t getRingBufPackCount(RINGBUFFER *packBuf){
+    return atomic_load_explicit(&packBuf->packCount, memory_order_acquire);
+
+}
+
+// Cursor at the end of the first packCount packets
+uint64_t getRingBufPackEnd(RINGBUFFER *packBuf, uint64_t packCount){
+    if(packCount == 0)
+        return 0;
+    return packBuf->packEnd[(packCount - 1) % PACKINDEX_SIZE];
+
+}
+
+// Returns 1 if data at cursor may already have been clobbered by the reader. Check after
+// consuming data to make sure it wasn't overwritten while it was being used.
+int ringBufOverwritten(RINGBUFFER *packBuf, uint64_t cursor){
+    return (getRingBufWriteCursor(packBuf) + RINGBUF_WRITE_AHEAD - cursor) > RINGBUF_SIZE;
+
+}
+
+// Unparsed bytes in the rings for a consumer, summed over rings
+uint64_t consumerBacklog(RINGBUFFER *packBufs, RINGBUF_READ_STATE *readStates, int nPackBufs){
+    uint64_t backlog = 0;
+    int ringInd;
+
+    for(ringInd=0; ringInd<nPackBufs; ringInd++)
+        backlog += getRingBufWriteCursor(packBufs + ringInd) - readStates[ringInd].readCursor;
+    return backlog;
+
+}
+
+// Counts a datagram (packet points at its first byte) against the roach in its header
+void updateRoachStats(ROACH_STATS *roachStats, uint8_t *packet, uint64_t nBytes){
+    uint64_t swp;
+    STREAM_HEADER *hdr;
+    ROACH_STATS *stats;
+    uint32_t frameStep;
+
+    if(nBytes < 8)
+        return;
+    swp = __bswap_64(*((uint64_t*)packet));
+    hdr = (STREAM_HEADER*)&swp;
+    if(hdr->start != 0b11111111)
+        return;
+
+    stats = roachStats + hdr->roach;
+    stats->nPackets++;
+    stats->nPhotons += nBytes/8 - 1;
+    if(stats->seen){
+        frameStep = (hdr->frame - stats->lastFrame) % FRAME_COUNTER_MOD;
+        if((frameStep > FRAME_COUNTER_MOD/2) || ((uint64_t)hdr->timestamp < stats->lastTimestamp)){
+            stats->nOutOfOrder++;
+            return;
+
+        }
+        if(frameStep > 1){
+            stats->nFrameGaps++;
+            stats->nFramesMissed += frameStep - 1;
+
+        }
+
+    }
+    stats->seen = 1;
+    stats->lastFrame = hdr->frame;
+    stats->lastTimestamp = hdr->timestamp;
+
+}
+
+// Copies n bytes starting at cursor into dest, handling wrap around
+void ringBufCopy(RINGBUFFER *packBuf, uint64_t cursor, size_t n, char *dest){
+    uint64_t ind = cursor % RINGBUF_SIZE;
+    if(ind + n > RINGBUF_SIZE){
+        memcpy(dest, packBuf->data + ind, RINGBUF_SIZE - ind);
+        memcpy(dest + (RINGBUF_SIZE - ind), packBuf->data, n - (RINGBUF_SIZE - ind));
+
+    }
+
+    else
+        memcpy(dest, packBuf->data + ind, n);
+
+}
+
+uint64_t monotonicNs(void){
+    struct timespec spec;
+    clock_gettime(CLOCK_MONOTONIC, &spec);
+    return (uint64_t)spec.tv_sec*1000000000 + spec.tv_nsec;
+
+}
+
+//Unix time of the start of the current UTC year, which the 0.5 ms header timestamps count from
+//(binfile.tsOffset() in python)
+time_t tsOffset(void){
+    time_t now = time(NULL);
+    struct tm yearStart;
+
+    gmtime_r(&now, &yearStart);
+    yearStart.tm_mon = 0;
+    yearStart.tm_mday = 1;
+    yearStart.tm_hour = 0;
+    yearStart.tm_min = 0;
+    yearStart.tm_sec = 0;
+    return timegm(&yearStart);
+
+}
+
+void initRingBufNotifier(RINGBUF_NOTIFIER *notifier, uint64_t wakeBytes, int waitTimeoutUs){
+    atomic_init(&notifier->seq, 0);
+    atomic_init(&notifier->nWaiters, 0);
+    atomic_init(&notifier->lastWakeNs, 0);
+    notifier->wakeBytes = wakeBytes;
+    notifier->waitTimeoutUs = waitTimeoutUs;
+
+}
+
+// Called by a reader after publishing a new writeCursor
+void ringBufNotify(RINGBUF_NOTIFIER *notifier, uint64_t writeCursor, uint64_t *lastWakeCursor){
+    if(notifier == NULL)
+        return;
+
+    // order the writeCursor store before the nWaiters load; pairs with the 
+    // fetch_add in ringBufWait so a consumer can't go to sleep on data we just published
+    atomic_thread_fence(memory_order_seq_cst);
+    if(atomic_load_explicit(&notifier->nWaiters, memory_order_relaxed) == 0){
+        *lastWakeCursor = writeCursor; //consumers busy, batch from here once they go idle
+        return;
+
+    }
+
+    if(writeCursor - *lastWakeCursor < notifier->wakeBytes)
+        return;
+
+    *lastWakeCursor = writeCursor;
+    atomic_store_explicit(&notifier->lastWakeNs, monotonicNs(), memory_order_relaxed);
+    atomic_fetch_add(&notifier->seq, 1);
+    syscall(SYS_futex, &notifier->seq, FUTEX_WAKE_PRIVATE, INT_MAX, NULL, NULL, 0);
+
+}
+
+// Blocks until a reader posts new data or waitTimeoutUs elapses. Returns immediately if 
+// any ring already has at least minBytes unread.
+void ringBufWait(RINGBUF_NOTIFIER *notifier, RINGBUFFER *packBufs, RINGBUF_READ_STATE *readStates, 
+        int nPackBufs, uint64_t minBytes, WAIT_STATS *stats){
+    int i, ret;
+    int dataReady = 0;
+    uint32_t seq;
+    uint64_t sleepStart, wakeTime, latency;
+    struct timespec timeout;
+
+    if(notifier == NULL || notifier->waitTimeoutUs <= 0)
+        return;
+
+    seq = atomic_load(&notifier->seq);
+    atomic_fetch_add(&notifier->nWaiters, 1);
+    for(i=0; i<nPackBufs; i++)
+        if(getRingBufWriteCursor(packBufs + i) - readStates[i].readCursor >= minBytes){
+            dataReady = 1;
+            break;
+
+        }
+
+    if(!dataReady){
+        timeout.tv_sec = notifier->waitTimeoutUs/1000000;
+        timeout.tv_nsec = 1000*(notifier->waitTimeoutUs%1000000);
+        sleepStart = monotonicNs();
+        ret = syscall(SYS_futex, &notifier->seq, FUTEX_WAIT_PRIVATE, seq, &timeout, NULL, 0);
+        wakeTime = monotonicNs();
+
+        stats->nWaits++;
+        stats->sleepNs += wakeTime - sleepStart;
+        if(ret == 0 && atomic_load(&notifier->seq) != seq){
+            latency = wakeTime - atomic_load_explicit(&notifier->lastWakeNs, memory_order_relaxed);
+            stats->nWakes++;
+            stats->wakeLatencyNs += latency;
+            if(latency > stats->maxWakeLatencyNs)
+                stats->maxWakeLatencyNs = latency;
+
+        }
+        else if(ret == -1 && errno == ETIMEDOUT){
+            errno = 0;
+            stats->nTimeouts++;
+
+        }
+
+        updateCpuStats(stats, wakeTime);
+
+    }
+
+    atomic_fetch_sub(&notifier->nWaiters, 1);
+
+}
+
+void updateCpuStats(WAIT_STATS *stats, uint64_t nowNs){
+    struct timespec cpuSpec;
+    clock_gettime(CLOCK_THREAD_CPUTIME_ID, &cpuSpec);
+    stats->cpuNs = (uint64_t)cpuSpec.tv_sec*1000000000 + cpuSpec.tv_nsec;
+    stats->wallNs = nowNs - stats->startNs;
+
+}
+
+void initWaitStats(WAIT_STATS *stats){
+    memset(stats, 0, sizeof(WAIT_STATS));
+    stats->startNs = monotonicNs();
+
+}
+
+// Sleep for one wait timeout when a consumer has nothing to do (spins if timeout is 0)
+void idleSleep(RINGBUF_NOTIFIER *notifier, WAIT_STATS *stats){
+    struct timespec timeout;
+    uint64_t sleepStart, wakeTime;
+    if(notifier == NULL || notifier->waitTimeoutUs <= 0)
+        return;
+
+    timeout.tv_sec = notifier->waitTimeoutUs/1000000;
+    timeout.tv_nsec = 1000*(notifier->waitTimeoutUs%1000000);
+    sleepStart = monotonicNs();
+    nanosleep(&timeout, NULL);
+    wakeTime = monotonicNs();
+
+    stats->nWaits++;
+    stats->nTimeouts++;
+    stats->sleepNs += wakeTime - sleepStart;
+    updateCpuStats(stats, wakeTime);
+
 }
 
 void resetSem(const char *semName){
@@ -26,26 +26,57 @@
 #include <sys/mman.h>
 #include <sched.h>
 #include <assert.h>
+#include <stdatomic.h>
+#include <limits.h>
+#include <sys/syscall.h>
+#include <linux/futex.h>
+#include <zlib.h>
 #include "mkidshm.h"
 
 #define _POSIX_C_SOURCE 200809L
 #define BUFLEN 1504
+#define MAX_RECV_BATCH 256 //max datagrams per recvmmsg call
 #define MAX_PACKSIZE 12928
 #define DEFAULT_PORT 50000
 #define SHAREDBUF 536870912
-#define RINGBUF_SIZE 536870912
+#define RINGBUF_SIZE 536870912 //must be a power of 2
+#define RINGBUF_WRITE_AHEAD (MAX_RECV_BATCH*BUFLEN) //max bytes reader may write past writeCursor
+#define EVENT_BATCH_SIZE 4096 //photons per event buffer update (and set of sem posts)
+#define MAX_FORWARD_DESTS 8
+#define FORWARD_BATCH MAX_RECV_BATCH //max datagrams per sendmmsg call
+#define PACKINDEX_SIZE 8388608 //2^23 packet boundaries, covers the ring for packets >= 64 bytes
 #define RAD_TO_DEG 57.2957795131
 #define BINWRITER_MINSIZE 808
-#define TSOFFS 1546300800 //Jan 1 2019 UTC
+#define BINWRITER_ALIGN 4096 //O_DIRECT alignment of staging buffers, write sizes and file offsets
+#define BINWRITER_BLOCKSIZE 8388608 //default bytes per write behind staging buffer
+#define BINWRITER_NBLOCKS 16 //default number of staging buffers
+#define BIN_INDEX_MAGIC 0x49424b4d //"MKBI"
+#define BIN_INDEX_VERSION 1
+#define BIN_INDEX_NO_ROACH 0xff //pixelRoach value for pixels without photons
+#define BINZ_MAGIC 0x5a424b4d //"MKBZ"
+#define BINZ_VERSION 1
+#define BINZ_CODEC_ZLIB 1
+#define BINZ_FRAME_STORED 1 //frame holds the raw bytes
+#define BINZ_FRAME_SHUFFLED 2 //bytes of the 8 byte words were transposed before deflating
+#define BINWRITER_MAX_COMPRESS_THREADS 16
+#define MAX_ROACHES 256 //STREAM_HEADER.roach is 8 bits
+#define FRAME_COUNTER_MOD 4096 //STREAM_HEADER.frame is 12 bits
 #define STRBUF 80
 #define SHM_NAME_LEN 80
 #define ENERGY_BIN_PT 16384 //2^14
 #define PHASE_BIN_PT 32768.0 //2^14
+#define PHASE_BITS 18
+#define WVL_LUT_BITS 8 //phase cells per pixel in WVL_BIN_TABLE = 2^WVL_LUT_BITS (4 cache lines)
+#define WVL_LUT_SIZE (1<<WVL_LUT_BITS)
+#define WVL_BIN_EXACT 0xff
+#define WVL_BIN_DROP 0xfe
+#define WVL_LUT_MAX_BINS 16 //above this most cells straddle a bin edge and the table is slower than computing
 #define H_TIMES_C 1239.842 // units: eV*nm
 #define READER_THREAD 0
 #define BIN_WRITER_THREAD 1
 #define SHM_IMAGE_WRITER_THREAD 2
 #define EVENT_BUFF_WRITER_THREAD 3
+#define FORWARDER_THREAD 4
 
 //#define _TIMING_TEST //turn on when you want a ts discrepancy file
 //#define _DEBUG_OUTPUT //turns on (fairly obtrusive) debugging output
@@ -76,74 +107,380 @@ typedef struct {
     char data[SHAREDBUF];
 } READOUT_STREAM;
 
+// Single producer (reader), multi consumer ring. writeCursor is the total number of bytes 
+// ever written and never wraps; the byte at cursor c lives at data[c % RINGBUF_SIZE]. 
+// The reader only publishes writeCursor (release) after the bytes before it are in place,
+// and always at a packet boundary.
+// packEnd is a side index of datagram boundaries: packet k (counting every packet ever
+// received) ends at cursor packEnd[k % PACKINDEX_SIZE] and starts where packet k-1 ended.
+// Entries are written before packCount is published.
 typedef struct{
     uint8_t data[RINGBUF_SIZE];
-    uint64_t writeInd;
-    uint64_t nCycles;
+    _Atomic uint64_t writeCursor;
+    uint64_t packEnd[PACKINDEX_SIZE];
+    _Atomic uint64_t packCount;
 
 } RINGBUFFER;
 
+// Lets consumers sleep until a reader publishes new data. Shared by all readers and 
+// consumers so a consumer can wait on several rings at once. Readers only make the wake 
+// syscall when someone is waiting and at least wakeBytes arrived since consumers went idle.
+typedef struct{
+    _Atomic uint32_t seq; //futex word, incremented on every wake
+    _Atomic uint32_t nWaiters;
+    _Atomic uint64_t lastWakeNs; //CLOCK_MONOTONIC time of last wake, for latency stats
+    uint64_t wakeBytes;
+    int waitTimeoutUs; //max time a consumer sleeps before rechecking; if 0 consumers spin
+
+} RINGBUF_NOTIFIER;
+
+typedef struct{
+    uint64_t nWaits; //number of times consumer went to sleep
+    uint64_t nWakes; //woken by a reader
+    uint64_t nTimeouts;
+    uint64_t sleepNs; //total time asleep
+    uint64_t wakeLatencyNs; //summed over nWakes; time from reader notify to consumer running
+    uint64_t maxWakeLatencyNs;
+    uint64_t cpuNs; //thread cpu time and wall time since start, updated on each wait
+    uint64_t wallNs;
+    uint64_t startNs;
+
+} WAIT_STATS;
+
+// Consumer side position in a RINGBUFFER; one per ring when there are multiple readers
+typedef struct{
+    uint64_t readCursor;
+    uint64_t packInd; //next packet to parse, for consumers using the packet index
+
+} RINGBUF_READ_STATE;
+
 typedef struct{
     char solutionFile[STRBUF];
-    int writing;
-    uint32_t nCols;
-    uint32_t nRows;
     // Each pixel has 3 coefficients, with address given by 
     // &a = 3*(nCols*y + x); &b = &a + 1; &c = &a + 2
     wvlcoeff_t *data;
 
+} WAVECAL_TABLE;
+
+// Double buffered wavecal: tables[generation % 2] is the current solution. An update fills
+// the other table and then increments generation, so one load of generation gives a 
+// consistent table. Threads pick it up at packet boundaries (getWavecalTable) and must be 
+// done with a table before the update after next refills it.
+typedef struct{
+    _Atomic uint32_t generation; //number of solutions applied, 0 if none
+    uint32_t nCols;
+    uint32_t nRows;
+    WAVECAL_TABLE tables[2];
+
 } WAVECAL_BUFFER;
 
+// Per pixel lookup from phase to wavelength bin for one shared image. Phase (18 bits) is
+// split into WVL_LUT_SIZE cells; a cell holds the bin if every phase in it lands in the
+// same bin, WVL_BIN_DROP if they are all out of range, or WVL_BIN_EXACT if the cell 
+// straddles a bin edge and the wavelength has to be computed.
+typedef struct{
+    uint8_t *bins; //bins[(nCols*y + x)*WVL_LUT_SIZE + cell], NULL if not built
+
+    // parameters bins was built for
+    uint32_t nCols;
+    uint32_t nRows;
+    uint32_t nWvlBins;
+    uint32_t useEdgeBins;
+    uint32_t wvlStart;
+    uint32_t wvlStop;
+    uint32_t wavecalGeneration; //coefficients are from wavecal->tables[wavecalGeneration % 2]
+
+} WVL_BIN_TABLE;
+
+typedef struct{
+    uint64_t nRecvCalls; //number of recv/recvmmsg calls that returned data
+    uint64_t nFrames;
+    uint64_t nBytes;
+    uint32_t lastBatchFrames; //frames returned by most recent call
+    uint32_t lastBatchBytes;
+
+} READER_STATS;
+
+// Per roach counters, kept by the reader that receives the roach's packets. The frame counter
+// in STREAM_HEADER goes up by one per packet, so a jump means packets were lost before they
+// reached us (in the network or the socket buffer).
+typedef struct{
+    uint64_t nPackets;
+    uint64_t nPhotons;
+    uint64_t nFrameGaps; //times the frame counter skipped ahead
+    uint64_t nFramesMissed; //packets lost in those gaps
+    uint64_t nOutOfOrder; //packets with an older frame counter or header timestamp than the last one
+    uint64_t lastTimestamp; //header timestamp of the newest packet
+    uint32_t lastFrame;
+    uint32_t seen; //nonzero once a packet from this roach arrived
+
+} ROACH_STATS;
+
+// Health of a ring buffer consumer. The bin writer keeps the same numbers in BIN_WRITER_STATS.
+typedef struct{
+    uint64_t ringBacklog; //bytes received but not yet parsed, summed over rings, at the last pass
+    uint64_t maxRingBacklog;
+    uint64_t nPacketsMissed; //overwritten in the ring before they were parsed
+    uint64_t nBadPackets; //wrong size or missing header
+
+} CONSUMER_STATS;
+
+typedef struct{
+    uint64_t nFrames; //frames finished, over all shared images
+    uint64_t latencyNs; //summed over nFrames
+    uint64_t lastLatencyNs;
+    uint64_t maxLatencyNs;
+
+} IMAGE_LATENCY_STATS;
+
 typedef struct{
     int port;
+    int reusePort; //set SO_REUSEPORT so several readers can share port
     RINGBUFFER *packBuf;
+    RINGBUF_NOTIFIER *notifier; //if NULL never wake consumers
     char quitSemName[STRBUF];
-    char ringBufResetSemName[STRBUF];
+
+    int batchSize; //datagrams per recvmmsg call; if <=1 use one recv per datagram
+    READER_STATS stats;
+    ROACH_STATS roachStats[MAX_ROACHES]; //indexed by STREAM_HEADER.roach
 
     int cpu; //if cpu=-1 then don't maximize priority
 
 } READER_PARAMS;
 
+// Sidecar index written next to each <ts>.bin as <ts>.idx. The file holds the header, 
+// then uint32_t counts[nRows*nCols] (photons per pixel), uint8_t pixelRoach[nRows*nCols] 
+// (roach that sent the pixel's photons) zero padded to a multiple of 8 bytes, then 
+// nEntries BIN_INDEX_ENTRYs in file order. All little endian.
+typedef struct{
+    uint32_t magic;
+    uint32_t version;
+    uint32_t nRows;
+    uint32_t nCols;
+    uint64_t nEntries;
+    uint64_t fileBytes; //size of the indexed .bin file
+    uint64_t nPhotons;
+    uint64_t firstTimestamp; //first and last packet header timestamps
+    uint64_t lastTimestamp;
+    uint64_t reserved;
+
+} BIN_INDEX_HEADER;
+
+// A run of consecutive packets from one roach with the same header timestamp
+typedef struct{
+    uint64_t offset; //of the first packet header in the .bin file
+    uint64_t timestamp; //header timestamp (0.5 ms ticks from the start of the UTC year, see tsOffset())
+    uint32_t nBytes;
+    uint32_t nPhotons;
+    uint32_t roach;
+    uint32_t reserved;
+
+} BIN_INDEX_ENTRY;
+
+// Index being built for the open .bin file, fed the file's bytes in order
+typedef struct{
+    BIN_INDEX_HEADER header;
+    uint32_t *counts;
+    uint8_t *pixelRoach;
+    BIN_INDEX_ENTRY *entries;
+    uint64_t nAllocated; //entries
+    uint64_t offset; //bytes of the .bin file seen so far
+    uint8_t carry[8]; //partial word left over from the last call
+    int nCarry;
+
+} BIN_INDEX;
+
+// Compressed .bin files (<ts>.binz) start with a BINZ_FILE_HEADER, followed by one frame
+// per staging block: a BINZ_FRAME_HEADER and compBytes of zlib stream (or raw bytes if
+// BINZ_FRAME_STORED). Shuffled frames hold byte 0 of every word, then byte 1, ..., then 
+// the rawBytes % 8 trailing bytes as is. Frames decode independently.
+typedef struct{
+    uint32_t magic;
+    uint32_t version;
+    uint32_t codec;
+    uint32_t blockSize; //max rawBytes of a frame
+
+} BINZ_FILE_HEADER;
+
+typedef struct{
+    uint32_t rawBytes;
+    uint32_t compBytes;
+    uint32_t flags;
+    uint32_t reserved;
+
+} BINZ_FRAME_HEADER;
+
+typedef struct{
+    uint64_t nBytesWritten; //bytes that made it into .bin files
+    uint64_t nBytesMissed; //bytes overwritten in a ring before binWriter read them
+    uint64_t nFiles;
+    uint64_t lastSecondBytes; //bytes read from the rings for the last complete file (second)
+    uint64_t writeNs; //time spent in write calls (write behind only)
+    uint64_t nWriteErrors;
+    uint64_t nFsyncs;
+    uint64_t fsyncNs;
+    uint64_t lastFsyncNs;
+    uint64_t maxFsyncNs;
+    uint64_t queuedBytes; //staged but not yet written (write behind only)
+    uint64_t maxQueuedBytes;
+    uint64_t ringBacklog; //unread bytes in the rings at binWriter's last pass
+    uint64_t maxRingBacklog;
+    uint64_t nStalls; //times binWriter had to wait for the flusher to free a staging buffer
+    uint64_t stallNs;
+    uint64_t compressRawBytes; //bytes fed to the compressors
+    uint64_t compressOutBytes; //compressed frames produced from them
+    uint64_t compressNs; //summed over compression threads
+
+} BIN_WRITER_STATS;
+
 typedef struct{
     int writing;
     char writerPath[STRBUF];
-    RINGBUFFER *packBuf;
+    RINGBUFFER *packBufs; //one ring per reader thread
+    int nPackBufs;
+    RINGBUF_NOTIFIER *notifier; //if NULL spin instead of waiting for data
+    WAIT_STATS waitStats;
     char quitSemName[STRBUF];
-    char ringBufResetSemName[STRBUF];
+
+    // if writeBehind is 0 binWriter fwrites straight from the rings and opens/closes files 
+    // itself. Otherwise it only copies into large aligned staging buffers and a flusher
+    // thread does the writes, file rotation and fsyncs.
+    int writeBehind;
+    int directIO; //open files with O_DIRECT (write behind only)
+    int fsyncFiles; //fsync each file before closing it (write behind only)
+    uint64_t preallocBytes; //fallocate each file to this size, 0 to disable (write behind only)
+    uint64_t blockSize; //bytes per staging buffer, rounded up to BINWRITER_ALIGN; 0 for default
+    int nBlocks; //number of staging buffers; 0 for default
+    BIN_WRITER_STATS stats;
+
+    // if compressLevel > 0 (zlib level, 1 is fastest) write behind blocks are compressed by
+    // nCompressThreads threads into <ts>.binz files. Not compatible with directIO.
+    int compressLevel;
+    int nCompressThreads;
+
+    // write a <ts>.idx sidecar for every <ts>.bin. Built by the flusher with write behind,
+    // otherwise by binWriter itself.
+    int writeIndex;
+    int nRows;
+    int nCols;
 
     int cpu; //if cpu=-1 then don't maximize priority
 
 } BIN_WRITER_PARAMS;
 
 typedef struct{
-    RINGBUFFER *packBuf;
+    uint8_t *data; //BINWRITER_ALIGN aligned
+    uint64_t nBytes;
+    time_t fileTs; //second (file name) the data belongs to
+    int closeFile; //close the file after writing this block
+    uint8_t *compData; //BINZ frame for data if compressing
+    uint64_t compBytes;
+    int compressed; //compData is ready
+
+} BIN_WRITE_BLOCK;
+
+// Staging buffers handed from binWriter to binFlusher in order. Block k (counting every 
+// block ever submitted) is blocks[k % nBlocks]; binWriter may fill it once nFlushed > k - nBlocks.
+typedef struct{
+    BIN_WRITE_BLOCK *blocks;
+    int nBlocks;
+    uint64_t blockSize;
+    uint64_t nSubmitted;
+    uint64_t nFlushed;
+    uint64_t nCompressStarted; //blocks taken by compression threads
+    int quit; //flusher exits once everything submitted is written
+    pthread_mutex_t lock;
+    pthread_cond_t submitted;
+    pthread_cond_t flushed;
+    pthread_cond_t compressed;
+    int nCompressThreads; //0 if not compressing
+    pthread_t compressThreads[BINWRITER_MAX_COMPRESS_THREADS];
+    BIN_WRITE_BLOCK *cur; //block binWriter is filling, NULL if not writing
+    BIN_WRITER_PARAMS *params;
+
+} BIN_WRITE_QUEUE;
+
+typedef struct{
+    RINGBUFFER *packBufs; //one ring per reader thread
+    int nPackBufs;
+    RINGBUF_NOTIFIER *notifier; //if NULL spin instead of waiting for data
+    WAIT_STATS waitStats;
     int nRoach;
     int nSharedImages;
     char **sharedImageNames;
     WAVECAL_BUFFER *wavecal; //if NULL don't use wavecal
 
     char quitSemName[STRBUF];
-    char ringBufResetSemName[STRBUF];
+
+    CONSUMER_STATS stats;
+    // time from the first roach passing the end of a frame to the frame being posted, i.e. 
+    // how long the slowest board and the parsing hold up each image
+    IMAGE_LATENCY_STATS latencyStats;
 
     int cpu; //if cpu=-1 then don't maximize priority
     
 } SHM_IMAGE_WRITER_PARAMS;
 
 typedef struct{
-    RINGBUFFER *packBuf;
+    RINGBUFFER *packBufs; //one ring per reader thread
+    int nPackBufs;
+    RINGBUF_NOTIFIER *notifier; //if NULL spin instead of waiting for data
+    WAIT_STATS waitStats;
     char bufferName[STRBUF];
     WAVECAL_BUFFER *wavecal; //if NULL don't use wavecal
 
     char quitSemName[STRBUF];
-    char ringBufResetSemName[STRBUF];
 
     int nRows;
     int nCols;
 
+    uint64_t nEventsWritten;
+    uint64_t nBatches; //number of buffer updates (sem posts)
+    CONSUMER_STATS stats;
+
     int cpu; //if cpu=-1 then don't maximize priority
 
 } EVENT_BUFF_WRITER_PARAMS;
 
+// A destination for the forwarder. Packets from roaches without a nonzero roaches[] entry
+// are skipped unless allRoaches is set. With useRegion only photons with xMin <= x < xMax
+// and yMin <= y < yMax are sent, behind the original header; packets left empty are skipped.
+typedef struct{
+    char host[STRBUF];
+    int port;
+    int allRoaches;
+    uint8_t roaches[MAX_ROACHES];
+    int useRegion;
+    int xMin;
+    int xMax;
+    int yMin;
+    int yMax;
+
+    uint64_t nPacketsSent;
+    uint64_t nBytesSent;
+    uint64_t nPacketsDropped; //send failed (socket buffer full, destination unreachable) or ring overwritten mid send
+    uint64_t nPacketsFiltered; //skipped by the roach or region filter
+    uint64_t nSendCalls;
+
+} FORWARD_DEST;
+
+typedef struct{
+    RINGBUFFER *packBufs; //one ring per reader thread
+    int nPackBufs;
+    RINGBUF_NOTIFIER *notifier; //if NULL spin instead of waiting for data
+    WAIT_STATS waitStats;
+    int nDests;
+    FORWARD_DEST dests[MAX_FORWARD_DESTS];
+    int sendBufBytes; //SO_SNDBUF of each destination socket, 0 for the system default
+
+    char quitSemName[STRBUF];
+
+    CONSUMER_STATS stats;
+
+    int cpu; //if cpu=-1 then don't maximize priority
+
+} FORWARDER_PARAMS;
+
 typedef struct{
     pthread_attr_t attr;
     pthread_t thread;
@@ -154,20 +491,75 @@ int maximizePriority(int cpu);
 
 void *shmImageWriter(void *prms);
 void *binWriter(void *prms);
+void *binFlusher(void *prms);
 void *reader(void *prms);
 void *eventBuffWriter(void *prms);
+void *forwarder(void *prms);
+
+BIN_WRITE_QUEUE *initBinWriteQueue(BIN_WRITER_PARAMS *params);
+void freeBinWriteQueue(BIN_WRITE_QUEUE *queue);
+BIN_WRITE_BLOCK *acquireBinBlock(BIN_WRITE_QUEUE *queue, time_t fileTs);
+void submitBinBlock(BIN_WRITE_QUEUE *queue, int closeFile);
+void writeBinData(FILE *wp, BIN_WRITE_QUEUE *queue, BIN_INDEX *index, uint8_t *data, uint64_t nBytes, 
+        BIN_WRITER_PARAMS *params);
+void binFileName(char *fname, BIN_WRITER_PARAMS *params, time_t fileTs);
+int openBinFile(BIN_WRITER_PARAMS *params, time_t fileTs);
+uint64_t writeBinBlock(int fd, BIN_WRITE_BLOCK *block, BIN_WRITER_PARAMS *params);
+void *binCompressor(void *prms);
+void compressBinBlock(BIN_WRITE_BLOCK *block, uint8_t *shuffleBuf, int level);
+void shuffleWords(uint8_t *dest, uint8_t *src, uint64_t nBytes);
+void closeBinFile(int fd, uint64_t fileBytes, BIN_WRITER_PARAMS *params);
+int initBinIndex(BIN_INDEX *index, int nRows, int nCols);
+void resetBinIndex(BIN_INDEX *index);
+void freeBinIndex(BIN_INDEX *index);
+void addBinIndexData(BIN_INDEX *index, uint8_t *data, uint64_t nBytes);
+int writeBinIndex(BIN_INDEX *index, const char *fname);
+void finishBinIndex(BIN_INDEX *index, BIN_WRITER_PARAMS *params, time_t fileTs);
 
 void addPacketToImage(MKID_IMAGE *sharedImage, char *photonWord, 
         unsigned int l, WAVECAL_BUFFER *wavecal);
+void addPacketToFrame(MKID_IMAGE *sharedImage, image_t *frame, char *photonWord, 
+        unsigned int l, WAVECAL_BUFFER *wavecal, WVL_BIN_TABLE *binTable);
+int updateWvlBinTable(WVL_BIN_TABLE *binTable, MKID_IMAGE_METADATA *md, WAVECAL_BUFFER *wavecal, 
+        uint32_t generation);
+void freeWvlBinTable(WVL_BIN_TABLE *binTable);
+int getWvlBin(float wvl, MKID_IMAGE_METADATA *md);
 void addPacketToEventBuffer(MKID_EVENT_BUFFER *buffer, char *photonWord, 
-        unsigned int l, uint64_t headerTS, WAVECAL_BUFFER *wavecal, int nRows, int nCosl);
+        unsigned int l, uint64_t headerTS, WAVECAL_BUFFER *wavecal, int nRows, int nCols);
+int parsePacketToEvents(MKID_PHOTON_EVENT *photons, char *photonWord, unsigned int l, 
+        uint64_t headerTS, time_t tsOffs, WAVECAL_BUFFER *wavecal, int useWvl, int nRows, int nCols);
 
 int startReaderThread(READER_PARAMS *rparams, THREAD_PARAMS *tparams);
 int startBinWriterThread(BIN_WRITER_PARAMS *rparams, THREAD_PARAMS *tparams);
 int startShmImageWriterThread(SHM_IMAGE_WRITER_PARAMS *rparams, THREAD_PARAMS *tparams);
 int startEventBuffWriterThread(EVENT_BUFF_WRITER_PARAMS *rparams, THREAD_PARAMS *tparams);
+int startForwarderThread(FORWARDER_PARAMS *rparams, THREAD_PARAMS *tparams);
+int openForwardSocket(FORWARD_DEST *dest, int sendBufBytes);
+uint64_t filterForwardPacket(FORWARD_DEST *dest, char *packData, uint64_t packSize, char *out);
+void sendForwardBatch(int sock, FORWARD_DEST *dest, struct mmsghdr *msgs, int nMsgs);
 void quitAllThreads(const char *quitSemName, int nThreads);
 void resetSem(const char *quitSemName);
 float getWavelength(PHOTON_WORD *photon, WAVECAL_BUFFER *wavecal);
-void getRingBufState(RINGBUFFER* packBuf, sem_t *ringBufResetSem, uint64_t *nCycles, uint64_t *writeInd);
+float getPixelWavelength(int phase, int x, int y, WAVECAL_BUFFER *wavecal);
+float getCoeffWavelength(int phase, int x, int y, wvlcoeff_t *coeffs, uint32_t nCols);
+WAVECAL_TABLE *getWavecalTable(WAVECAL_BUFFER *wavecal, uint32_t *generation);
+void pickUpWavecal(MKID_IMAGE *sharedImages, WVL_BIN_TABLE *binTables, int nSharedImages, 
+        WAVECAL_BUFFER *wavecal, uint32_t generation);
+void initRingBuf(RINGBUFFER *packBuf);
+uint64_t getRingBufWriteCursor(RINGBUFFER *packBuf);
+uint64_t getRingBufPackCount(RINGBUFFER *packBuf);
+uint64_t getRingBufPackEnd(RINGBUFFER *packBuf, uint64_t packCount);
+int ringBufOverwritten(RINGBUFFER *packBuf, uint64_t cursor);
+void ringBufCopy(RINGBUFFER *packBuf, uint64_t cursor, size_t n, char *dest);
+void initRingBufNotifier(RINGBUF_NOTIFIER *notifier, uint64_t wakeBytes, int waitTimeoutUs);
+void ringBufNotify(RINGBUF_NOTIFIER *notifier, uint64_t writeCursor, uint64_t *lastWakeCursor);
+void ringBufWait(RINGBUF_NOTIFIER *notifier, RINGBUFFER *packBufs, RINGBUF_READ_STATE *readStates, 
+        int nPackBufs, uint64_t minBytes, WAIT_STATS *stats);
+void initWaitStats(WAIT_STATS *stats);
+void updateCpuStats(WAIT_STATS *stats, uint64_t nowNs);
+void idleSleep(RINGBUF_NOTIFIER *notifier, WAIT_STATS *stats);
+uint64_t monotonicNs(void);
+time_t tsOffset(void);
+void updateRoachStats(ROACH_STATS *roachStats, uint8_t *packet, uint64_t nBytes);
+uint64_t consumerBacklog(RINGBUFFER *packBufs, RINGBUF_READ_STATE *readStates, int nPackBufs);
 void diep(char *s);
@@ -4,15 +4,23 @@
 
 import numpy as np
 cimport numpy as np
-import datetime
-import calendar
 from mkidcore.corelog import getLogger
+from mkidreadout.readout.binfile import tsOffset
 import os
-from libc.string cimport strcpy
+from libc.string cimport strcpy, memcpy
+
+np.import_array()
 
 DEFAULT_EVENT_BUFFER_SIZE = 200000 #total number of events
 
+#matches MKID_PHOTON_EVENT in mkidshm.h
+EVENT_DTYPE = np.dtype([('time', np.uint64), ('wvl', np.float32), ('x', np.uint16), ('y', np.uint16)], align=True)
+#matches MKID_PHOTON_EVENT_V4, for buffers created by older versions of libmkidshm
+EVENT_DTYPE_V4 = np.dtype({'names': ['x', 'y', 'time', 'wvl'], 'formats': [np.uint8, np.uint8, np.uint64, np.float32],
+                           'offsets': [0, 1, 8, 16], 'itemsize': 24})
+
 cdef extern from "<stdint.h>":
+    ctypedef unsigned short uint16_t
     ctypedef unsigned int uint32_t
     ctypedef unsigned long long uint64_t
 
@@ -23,6 +31,18 @@ cdef extern from "<semaphore.h>":
 cdef extern from "mkidshm.h":
     ctypedef int image_t
     ctypedef float coeff_t
+    ctypedef float wvl_t
+    cdef int MKIDSHM_VERSION
+    cdef int MKID_EVENT_LAYOUT_AOS
+    cdef int MKID_EVENT_LAYOUT_SOA
+
+    ctypedef struct MKID_FRAME_HEADER:
+        uint64_t frameNum
+        uint64_t startTime
+        uint64_t integrationTime
+        uint64_t doneTime
+        uint32_t valid
+        uint32_t complete
 
     #PARTIAL DEFINITION, only exposing necessary attributes
     ctypedef struct MKID_IMAGE_METADATA:
@@ -37,6 +57,16 @@ cdef extern from "mkidshm.h":
         uint32_t integrationTime
         char name[80]
         char wavecalID[150]
+        uint32_t nBuffers
+        int writeBuffer
+        int readyBuffer
+        int heldBuffer
+        uint32_t continuous
+        uint64_t frameCount
+        MKID_FRAME_HEADER frameHeaders[8]
+        uint32_t wavecalGeneration
+        uint32_t frameWavecalStart[8]
+        uint32_t frameWavecalEnd[8]
 
     #PARTIAL DEFINITION, only exposing necessary attributes
     ctypedef struct MKID_IMAGE:
@@ -44,6 +74,7 @@ cdef extern from "mkidshm.h":
 
     #PARTIAL DEFINITION, only exposing necessary attributes
     ctypedef struct MKID_EVENT_BUFFER_METADATA:
+        uint32_t version
         uint32_t size
         int endInd
         int writing
@@ -54,32 +85,59 @@ cdef extern from "mkidshm.h":
         char eventBufferName[80]
         char newPhotonSemName[80]
         char wavecalID[150]
+
+        uint32_t layout
     
     #PARTIAL DEFINITION, only exposing necessary attributes
     ctypedef struct MKID_EVENT_BUFFER:
         MKID_EVENT_BUFFER_METADATA *md
+        void *buffer
+        void *bufferV4
+        uint64_t *time
+        wvl_t *wvl
+        uint16_t *x
+        uint16_t *y
     
     cdef int MKIDShmImage_open(MKID_IMAGE *imageStruct, char *imgName)
     cdef int MKIDShmImage_close(MKID_IMAGE *imageStruct)
     cdef int MKIDShmImage_create(MKID_IMAGE_METADATA *imageMetadata, char *imgName, MKID_IMAGE *outputImage)
     cdef int MKIDShmImage_populateMD(MKID_IMAGE_METADATA *imageMetadata, char *name, int nCols, int nRows, int useWvl, int nWvlBins, int useEdgeBins, int wvlStart, int wvlStop)
     cdef int MKIDShmImage_startIntegration(MKID_IMAGE *image, uint64_t startTime, uint64_t integrationTime)
+    cdef void MKIDShmImage_setContinuous(MKID_IMAGE *image, int continuous)
     cdef int MKIDShmImage_wait(MKID_IMAGE *image, int semInd)
     cdef int MKIDShmImage_timedwait(MKID_IMAGE *image, int semInd, int time, int stopImage) nogil
     cdef int MKIDShmImage_checkIfDone(MKID_IMAGE *image, int semInd)
     cdef void MKIDShmImage_copy(MKID_IMAGE *image, image_t *outputBuffer)
+    cdef size_t MKIDShmImage_frameSize(MKID_IMAGE_METADATA *imageMetadata)
+    cdef image_t *MKIDShmImage_holdReadyFrame(MKID_IMAGE *image)
 
     cdef int MKIDShmEventBuffer_open(MKID_EVENT_BUFFER *bufferStruct, const char *bufferName)
     cdef int MKIDShmEventBuffer_create(MKID_EVENT_BUFFER_METADATA *bufferMetadata, const char *bufferName, MKID_EVENT_BUFFER *outputBuffer)
     cdef int MKIDShmEventBuffer_populateMD(MKID_EVENT_BUFFER_METADATA *metadata, const char *name, int size, int useWvl)
 
 
+cdef _shmArray(void *ptr, np.npy_intp nItems, dtype, owner):
+    """
+    Read only array of nItems of dtype that points directly at shared memory (no copy).
+    owner is kept alive for as long as the array (or any view of it) exists.
+    """
+    cdef np.npy_intp nBytes = nItems*dtype.itemsize
+    cdef np.ndarray rawArr = np.PyArray_SimpleNewFromData(1, &nBytes, np.NPY_UINT8, ptr)
+    np.set_array_base(rawArr, owner)
+    arr = rawArr.view(dtype)
+    arr.flags.writeable = False
+    return arr
+
+
 cdef class ImageCube(object):
     """
     Python interface to MKID shared memory image defined in mkidshm.h (MKID_IMAGE struct)
     """
     cdef MKID_IMAGE image
     cdef int doneSemInd
+    cdef int heldFrame
+    cdef uint64_t lastFrameNum
+    cdef readonly uint64_t framesDropped
 
     def __init__(self, name, doneSemInd=0, **kwargs):
         """
@@ -101,10 +159,17 @@ cdef class ImageCube(object):
                 useEdgeBins: bool (default: False)
                 wvlStart: float (default: 0)
                 wvlStop: float (default: 0)
+                nBuffers: int (default: 3)
+                    Number of frames kept in shared memory (max 8). With 2 or more, a frame returned by
+                    receiveImage(copy=False) is never overwritten while it is held; continuous
+                    integration needs 3 so the newest finished frame also survives.
 
         """
 
         self.doneSemInd = doneSemInd
+        self.heldFrame = -1
+        self.lastFrameNum = 0
+        self.framesDropped = 0
 
         if not name.startswith('/'):
             name = '/'+name
@@ -131,11 +196,13 @@ cdef class ImageCube(object):
 
         else:
             self._create(name, kwargs.get('nCols', 100), kwargs.get('nRows', 100), kwargs.get('useWvl', False), 
-                        kwargs.get('nWvlBins', 1), kwargs.get('useEdgeBins', False), kwargs.get('wvlStart', 0), kwargs.get('wvlStop', 0))
+                        kwargs.get('nWvlBins', 1), kwargs.get('useEdgeBins', False), kwargs.get('wvlStart', 0), kwargs.get('wvlStop', 0),
+                        kwargs.get('nBuffers', 3))
 
-    def _create(self, name, nCols, nRows, useWvl, nWvlBins, useEdgeBins, wvlStart, wvlStop):
+    def _create(self, name, nCols, nRows, useWvl, nWvlBins, useEdgeBins, wvlStart, wvlStop, nBuffers):
         cdef MKID_IMAGE_METADATA imagemd
         MKIDShmImage_populateMD(&imagemd, name.encode('UTF-8'), nCols, nRows, int(useWvl), nWvlBins, int(useEdgeBins), wvlStart, wvlStop)
+        imagemd.nBuffers = nBuffers
         rval = MKIDShmImage_create(&imagemd, name.encode('UTF-8'), &(self.image));
         if rval != 0:
             raise Exception('Error opening shared memory file')
@@ -145,7 +212,7 @@ cdef class ImageCube(object):
         if rval != 0:
             raise Exception('Error opening shared memory file')
 
-    def startIntegration(self, startTime=0, integrationTime=1):
+    def startIntegration(self, startTime=0, integrationTime=1, continuous=False):
         """
         Tells packetmaster to start an integration for this image
         Parameters
@@ -155,26 +222,68 @@ cdef class ImageCube(object):
                 If 0, start immediately w/ timestamp that packetmaster is currently parsing.
             integrationTime: double
                 integration time in seconds
+            continuous: bool
+                If True packetmaster starts the next integration as soon as each one finishes,
+                rotating through the image's frame buffers with no gap between frames, until
+                stopIntegration is called. Call receiveImage in a loop to get the frames.
+                Needs nBuffers >= 2.
         """
+        if continuous and self.nBuffers < 2:
+            raise ValueError('Continuous integration needs an image with nBuffers >= 2')
         if startTime != 0:
-            curYr = datetime.datetime.utcnow().year
-            yrStart = datetime.date(curYr, 1, 1)
-            tsOffs = calendar.timegm(yrStart.timetuple())
-            startTime -= tsOffs
+            startTime -= tsOffset()
 
         startTime = int(startTime*2000)
         integrationTime = int(integrationTime*2000) #convert to half-ms
+        self.lastFrameNum = 0
+        self.framesDropped = 0
+        MKIDShmImage_setContinuous(&(self.image), int(continuous))
         MKIDShmImage_startIntegration(&(self.image), startTime, integrationTime)
 
-    def receiveImage(self):
+    def stopIntegration(self):
+        """
+        Ends continuous integration after the current frame
+        """
+        MKIDShmImage_setContinuous(&(self.image), 0)
+
+    @property
+    def continuous(self):
+        return bool(self.image.md.continuous)
+
+    def receiveImage(self, copy=True):
         """
         Waits for doneImage semaphore to be posted by packetmaster,
         then grabs the image from buffer
+
+        Parameters
+        ----------
+            copy: bool
+                If False, return a read only view of the frame in shared memory instead of a copy.
+                The frame is held (packetmaster integrates into another one) until the next call 
+                to receiveImage; don't keep the view past that. Needs nBuffers >= 2.
         """
+        cdef image_t *frame
         with nogil:
             retval = MKIDShmImage_timedwait(&(self.image), self.doneSemInd, self.image.md.integrationTime, 1)
-        flatImage = self._readImageBuffer()
-        if not self.valid:
+        if self.image.md.continuous:
+            #skip straight to the newest frame if we've fallen behind; frameHeader shows the gap
+            while MKIDShmImage_checkIfDone(&(self.image), self.doneSemInd) == 0:
+                pass
+
+        frame = MKIDShmImage_holdReadyFrame(&(self.image))
+        self.heldFrame = self.image.md.heldBuffer
+        header = self.frameHeader
+        if header is not None:
+            if self.lastFrameNum and header['frameNum'] > self.lastFrameNum + 1:
+                self.framesDropped += header['frameNum'] - self.lastFrameNum - 1
+            self.lastFrameNum = header['frameNum']
+
+        if copy:
+            flatImage = np.empty(MKIDShmImage_frameSize(self.image.md), dtype=np.intc)
+            memcpy(np.PyArray_DATA(flatImage), frame, MKIDShmImage_frameSize(self.image.md)*sizeof(image_t))
+        else:
+            flatImage = _shmArray(frame, MKIDShmImage_frameSize(self.image.md), np.dtype(np.intc), self)
+        if not (header['valid'] if header is not None else self.valid):
             raise RuntimeError('Wavecal parameters changed during integration!')
         if self.useWvl:
             return np.reshape(flatImage, self._shape).squeeze()
@@ -190,11 +299,31 @@ cdef class ImageCube(object):
         return (MKIDShmImage_checkIfDone(&(self.image), self.doneSemInd) == 0)
 
 
-    def _readImageBuffer(self):
-        imageSize = self._shape[0] * self._shape[1] * self._shape[2]
-        imageBuffer = np.empty(imageSize, dtype=np.intc)
-        MKIDShmImage_copy(&(self.image), <image_t*>np.PyArray_DATA(imageBuffer))
-        return imageBuffer
+    @property
+    def nBuffers(self):
+        return max(self.image.md.nBuffers, 1)
+
+    @property
+    def frameHeader(self):
+        """
+        Header of the frame last returned by receiveImage: frameNum (counts every frame 
+        packetmaster has completed), startTime and doneTime (seconds UTC), integrationTime 
+        (seconds), valid, wavecalGeneration (of the wavecal in use when the frame started, see
+        the wavecalGeneration property) and wavecalMixed (True if packetmaster switched to a 
+        new wavecal partway through the frame, so early photons used the previous one). None 
+        if no frame is held or the image has no frame headers.
+        """
+        cdef MKID_FRAME_HEADER header
+        if self.heldFrame < 0 or self.image.md.nBuffers == 0:
+            return None
+        header = self.image.md.frameHeaders[self.heldFrame]
+        if not header.complete:
+            return None
+        return {'frameNum': header.frameNum, 'startTime': header.startTime/2000. + tsOffset(),
+                'integrationTime': header.integrationTime/2000., 'doneTime': header.doneTime/1.e9,
+                'valid': bool(header.valid), 'wavecalGeneration': self.image.md.frameWavecalStart[self.heldFrame],
+                'wavecalMixed': self.image.md.frameWavecalStart[self.heldFrame] != 
+                                self.image.md.frameWavecalEnd[self.heldFrame]}
 
     def invalidate(self):
         """
@@ -203,6 +332,14 @@ cdef class ImageCube(object):
         """
         self.image.md.valid = 0
 
+    @property
+    def wavecalGeneration(self):
+        """
+        Number of wavelength solutions packetmaster has applied (0 for none) when it last
+        picked one up for this image. Changes between packets, without invalidating the image.
+        """
+        return self.image.md.wavecalGeneration
+
     @property
     def wavecalID(self):
         return '' if not self.useWvl else self.image.md.wavecalID.decode(encoding='UTF-8')
@@ -290,7 +427,7 @@ cdef class ImageCube(object):
 cdef class EventBuffer:
     cdef MKID_EVENT_BUFFER eventBuffer;
 
-    def __init__(self, name, size=None):
+    def __init__(self, name, size=None, layout='aos'):
         """
         Opens a photon event buffer given by name (file in /dev/shm).
         Creates it if it doesn't exist.
@@ -302,6 +439,9 @@ cdef class EventBuffer:
             size: int
                 Number of photon events stored in buffer.
                 default: 200000
+            layout: 'aos' or 'soa'
+                Layout used if the buffer is created: an array of events ('aos') or 
+                separate time, wvl, x and y arrays ('soa'). Ignored when opening.
 
         """
         
@@ -316,11 +456,14 @@ cdef class EventBuffer:
         else:
             if size is None:
                 size = DEFAULT_EVENT_BUFFER_SIZE
-            self._create(name, size)
+            self._create(name, size, layout)
 
-    def _create(self, name, size):
+    def _create(self, name, size, layout):
         cdef MKID_EVENT_BUFFER_METADATA md
+        if layout not in ('aos', 'soa'):
+            raise ValueError('layout must be aos or soa')
         MKIDShmEventBuffer_populateMD(&md, name.encode('UTF-8'), size, 0)
+        md.layout = MKID_EVENT_LAYOUT_SOA if layout == 'soa' else MKID_EVENT_LAYOUT_AOS
         rval = MKIDShmEventBuffer_create(&md, name.encode('UTF-8'), &(self.eventBuffer));
         if rval != 0:
             raise Exception('Error opening shared memory file')
@@ -334,3 +477,38 @@ cdef class EventBuffer:
     def size(self):
         return self.eventBuffer.md.size
 
+    @property
+    def version(self):
+        return self.eventBuffer.md.version
+
+    @property
+    def layout(self):
+        return 'soa' if self.eventBuffer.md.layout == MKID_EVENT_LAYOUT_SOA else 'aos'
+
+    @property
+    def endInd(self):
+        """Index of the most recently written event, -1 if the buffer is empty"""
+        return self.eventBuffer.md.endInd
+
+    @property
+    def nCycles(self):
+        """Number of times the writer has wrapped around the buffer"""
+        return self.eventBuffer.md.nCycles
+
+    @property
+    def events(self):
+        """
+        Zero copy, read only view of the whole circular buffer (events up to endInd are
+        the newest). For the 'aos' layout this is a structured array with fields time, 
+        wvl, x, y (EVENT_DTYPE, or EVENT_DTYPE_V4 for old buffers); for 'soa' it is a 
+        dict of arrays keyed by field name. Contents change as packetmaster writes.
+        """
+        cdef uint32_t size = self.eventBuffer.md.size
+        if self.eventBuffer.md.version < MKIDSHM_VERSION:
+            return _shmArray(self.eventBuffer.bufferV4, size, EVENT_DTYPE_V4, self)
+        if self.eventBuffer.md.layout == MKID_EVENT_LAYOUT_SOA:
+            return {'time': _shmArray(self.eventBuffer.time, size, np.dtype(np.uint64), self),
+                    'wvl': _shmArray(self.eventBuffer.wvl, size, np.dtype(np.float32), self),
+                    'x': _shmArray(self.eventBuffer.x, size, np.dtype(np.uint16), self),
+                    'y': _shmArray(self.eventBuffer.y, size, np.dtype(np.uint16), self)}
+        return _shmArray(self.eventBuffer.buffer, size, EVENT_DTYPE, self)
@@ -86,8 +86,8 @@ extensions = [Extension(name="mkidreadout.channelizer.roach2utils",
                                       'mkidreadout/readout/mkidshm'],
                         library_dirs=['mkidreadout/readout/mkidshm'],
                         runtime_library_dirs=[os.path.abspath('mkidreadout/readout/mkidshm')],
-                        extra_compile_args=['-O3', '-shared', '-fPIC'],
-                        extra_link_args=['-lmkidshm', '-lrt', '-lpthread'])
+                        extra_compile_args=['-O3', '-shared', '-fPIC', '-std=gnu11'],
+                        extra_link_args=['-lmkidshm', '-lrt', '-lpthread', '-lz'])
              ]
 
 with open("README.md", "r") as fh:
@@ -108,6 +108,7 @@ setuptools.setup(
     scripts=['mkidreadout/channelizer/initgui.py',
              'mkidreadout/channelizer/hightemplar.py',
              'mkidreadout/readout/dashboard.py',
+             'mkidreadout/readout/packetreplay.py',
              'mkidreadout/channelizer/reinitADCDAC.py',
              'mkidreadout/configuration/powersweep/clickthrough_hell.py',
              'mkidreadout/configuration/powersweep/ml/findResonatorsWPS.py',